@@ -0,0 +1,125 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+
+class Batch(object):
+    """
+    Items collected for a single call, and the result of that call.
+    """
+    def __init__(self):
+        self.items = {}
+        self.full = threading.Event()
+        self.future = Future()
+
+
+class MicroBatcher(object):
+    """
+    Collects the items of calls with the same key that arrive within a
+    short window, and makes a single call with all of them. The first
+    caller of a batch waits for the window to pass (or the batch to
+    fill up) and makes the call, and every caller receives its result.
+    """
+    def __init__(self, window: float, max_size: int):
+        self.window = window
+        self.max_size = max_size
+        self._batches = {}
+        self._lock = threading.Lock()
+
+    def _close(self, key: str, batch: Batch):
+        if self._batches.get(key) is batch:
+            del self._batches[key]
+
+    def submit(self, key: str, items: list, function) -> list:
+        """
+        Adds the items to the open batch for the key, and returns the
+        results of calling the function with the items of each batch they
+        were added to. Items that don't fit in a single batch are split
+        across several.
+        """
+        return [self._submit(key, _, function) for _ in self._split(items)]
+
+    def _split(self, items: list) -> list:
+        return [items[i:i + self.max_size] for i in range(0, len(items), self.max_size)]
+
+    def _submit(self, key: str, items: list, function):
+        with self._lock:
+            batch = self._batches.get(key)
+            if batch is not None and len(batch.items) + len(items) > self.max_size:
+                self._close(key, batch)
+                batch.full.set()
+                batch = None
+            leader = batch is None
+            if leader:
+                batch = self._batches[key] = Batch()
+            batch.items.update(dict.fromkeys(items))
+            if len(batch.items) >= self.max_size:
+                self._close(key, batch)
+                batch.full.set()
+
+        if not leader:
+            return batch.future.result()
+
+        batch.full.wait(self.window)
+        with self._lock:
+            self._close(key, batch)
+        try:
+            result = function(list(batch.items))
+        except BaseException as e:
+            batch.future.set_exception(e)
+            raise
+        batch.future.set_result(result)
+        return result
+
+
+class AsyncBatch(object):
+    """
+    Asynchronous version of Batch.
+    """
+    def __init__(self):
+        self.items = {}
+        self.full = asyncio.Event()
+        self.future = asyncio.get_running_loop().create_future()
+        self.task = None
+
+
+class AsyncMicroBatcher(MicroBatcher):
+    """
+    Asynchronous version of MicroBatcher. The function returns an
+    awaitable, and the call is made by a task of its own so that a
+    caller being cancelled doesn't affect the others.
+    """
+    async def _run(self, key: str, batch: AsyncBatch, function):
+        try:
+            try:
+                await asyncio.wait_for(batch.full.wait(), self.window)
+            except asyncio.TimeoutError:
+                pass
+            self._close(key, batch)
+            batch.future.set_result(await function(list(batch.items)))
+        except asyncio.CancelledError:
+            # callers waiting for the batch are cancelled along with it
+            self._close(key, batch)
+            batch.future.cancel()
+            raise
+        except Exception as e:
+            batch.future.set_exception(e)
+
+    async def submit(self, key: str, items: list, function) -> list:
+        return await asyncio.gather(*(self._submit(key, _, function) for _ in self._split(items)))
+
+    async def _submit(self, key: str, items: list, function):
+        batch = self._batches.get(key)
+        if batch is not None and len(batch.items) + len(items) > self.max_size:
+            self._close(key, batch)
+            batch.full.set()
+            batch = None
+        if batch is None:
+            batch = self._batches[key] = AsyncBatch()
+            batch.task = asyncio.ensure_future(self._run(key, batch, function))
+        batch.items.update(dict.fromkeys(items))
+        if len(batch.items) >= self.max_size:
+            self._close(key, batch)
+            batch.full.set()
+
+        return await asyncio.shield(batch.future)
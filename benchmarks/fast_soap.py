@@ -0,0 +1,144 @@
+import argparse
+import random
+import timeit
+from types import SimpleNamespace
+
+from lxml import etree
+from zeep import Client
+from zeep.helpers import serialize_object
+from zeep.wsdl.utils import etree_to_string
+
+from benchmarks.parse_shipment import formatted_shipment, raw_shipment
+from benchmarks.stub_server import ENVELOPE, element, serve, wsdl_url
+from clients import shipping_type_factory
+from envelopes import FastService
+from utilities import parse_shipment
+
+
+class Reply(object):
+    """
+    Stands in for the HTTP response of a call.
+    """
+    status_code = 200
+    headers = {"Content-Type": "text/xml; charset=utf-8"}
+    encoding = "utf-8"
+
+    def __init__(self, content: bytes):
+        self.content = content
+
+
+def create_reply(shipments: list) -> bytes:
+    """
+    A createShipment response where every tenth shipment failed.
+    """
+    details = []
+    for number, shipment in enumerate(shipments):
+        details.append("<shippingOrderDetailVO>{}{}{}</shippingOrderDetailVO>".format(
+            element("cargoKey", shipment["cargoKey"]),
+            element("invoiceKey", shipment["invoiceKey"]),
+            "<errCode> 60020 </errCode><errMessage>Mevcut &amp; kayıtlı</errMessage>"
+            if number % 10 == 0 else "<errMessage/>",
+        ))
+    return ENVELOPE.format(operation="createShipment", result=(
+        "<ShippingOrderResultVO><outFlag>0</outFlag><outResult>Başarılı</outResult>"
+        "<count>{}</count><jobId>12345678901</jobId>{}</ShippingOrderResultVO>"
+    ).format(len(shipments), "".join(details))).encode("utf-8")
+
+
+def query_reply(keys: list) -> bytes:
+    """
+    A queryShipment response with tracking details for some of the
+    deliveries and an error for others.
+    """
+    details = []
+    for number, key in enumerate(keys):
+        details.append("<shippingDeliveryDetailVO>{}{}{}{}{}</shippingDeliveryDetailVO>".format(
+            element("cargoKey", key),
+            element("invoiceKey", "I" + key),
+            element("operationStatus", "DLV" if number % 3 else "IND"),
+            element("errCode", 80859) if number % 7 == 0 else "",
+            "<shippingDeliveryItemDetailVO>"
+            "<deliveryDate xmlns:xsi=\"http://www.w3.org/2001/XMLSchema-instance\" xsi:nil=\"true\"/>"
+            "<trackingUrl>https://example.com/?k={}&amp;x=1</trackingUrl>"
+            "</shippingDeliveryItemDetailVO>".format(key) if number % 2 else "",
+        ))
+    return ENVELOPE.format(operation="queryShipment", result=(
+        "<ShippingDeliveryVO><outFlag>0</outFlag><outResult>Başarılı</outResult>"
+        "<count>{}</count>{}</ShippingDeliveryVO>"
+    ).format(len(keys), "".join(details))).encode("utf-8")
+
+
+def zeep_envelope(client, operation: str, parameters: dict) -> bytes:
+    envelope, _ = client.service._binding._create(
+        operation, (), parameters, client=client, options=client.service._binding_options)
+    return etree_to_string(envelope)
+
+
+def zeep_reply(client, operation: str, reply: Reply) -> dict:
+    binding = client.service._binding
+    return serialize_object(binding.process_reply(client, binding.get(operation), reply), target_cls=dict)
+
+
+def canonical(message: bytes) -> bytes:
+    return etree.tostring(etree.fromstring(message), method="c14n")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Checks that the fast path renders and parses the same as zeep, and times both")
+    parser.add_argument("--shipments", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    server = serve(port=0)
+    client = Client(wsdl_url(server))
+    factory = shipping_type_factory(client)
+    fast = FastService(client)
+
+    # shipments with characters that have to be escaped
+    req = SimpleNamespace(context={"formatted": False})
+    shipments = [parse_shipment(req, raw_shipment(_)) for _ in range(args.shipments // 2)]
+    req.context["formatted"] = True
+    shipments += [parse_shipment(req, formatted_shipment(_)) for _ in range(args.shipments - len(shipments))]
+    for shipment in random.sample(shipments, min(10, len(shipments))):
+        shipment["description"] = "Kitap & <dergi>\r\n"
+    keys = [_["cargoKey"] for _ in shipments]
+
+    create_parameters = {"wsUserName": "YKTEST", "wsPassword": "p&ss<>", "userLanguage": "TR"}
+    query_parameters = {"wsUserName": "YKTEST", "wsPassword": "p&ss<>", "wsLanguage": "TR",
+                        "keys": keys, "keyType": 0, "onlyTracking": False}
+    cases = (
+        ("createShipment",
+         lambda: dict(create_parameters, ShippingOrderVO=[factory.ShippingOrderVO(**_) for _ in shipments]),
+         lambda: dict(create_parameters, ShippingOrderVO=shipments),
+         create_reply(shipments)),
+        ("queryShipment",
+         lambda: dict(query_parameters, addHistoricalData=True),
+         lambda: dict(query_parameters, addHistoricalData=True),
+         query_reply(keys)),
+    )
+
+    for operation, zeep_parameters, fast_parameters, content in cases:
+        message, _ = fast.templates[operation].render(fast_parameters())
+        assert canonical(message) == canonical(zeep_envelope(client, operation, zeep_parameters())), operation
+        assert fast.parsers[operation].parse(content) == zeep_reply(client, operation, Reply(content)), operation
+    print("The envelopes and the parsed responses of both paths are the same\n")
+
+    print("{:<16}{:<8}{:>12}{:>12}".format("operation", "path", "render ms", "parse ms"))
+    for operation, zeep_parameters, fast_parameters, content in cases:
+        timings = (
+            ("zeep",
+             lambda: zeep_envelope(client, operation, zeep_parameters()),
+             lambda: zeep_reply(client, operation, Reply(content))),
+            ("fast",
+             lambda: fast.templates[operation].render(fast_parameters()),
+             lambda: fast.parsers[operation].parse(content)),
+        )
+        for path, render, parse in timings:
+            render_time = min(timeit.repeat(render, number=1, repeat=args.repeat))
+            parse_time = min(timeit.repeat(parse, number=1, repeat=args.repeat))
+            print("{:<16}{:<8}{:>12.1f}{:>12.1f}".format(operation, path, render_time * 1000, parse_time * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import argparse
+import asyncio
+import base64
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+AUTHORIZATION = "Basic " + base64.b64encode(b"YKTEST:YKTEST").decode("ascii")
+
+
+class PooledWSGIServer(WSGIServer):
+    """
+    A WSGI server handling requests on a fixed number of threads, which
+    stands in for a pool of synchronous workers.
+    """
+    threads = 8
+
+    def server_activate(self):
+        super().server_activate()
+        self.pool = ThreadPoolExecutor(self.threads)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub(latency: float, arguments: list = ()) -> tuple:
+    """
+    Runs the SOAP stub in its own process so it doesn't compete with the
+    apps for the GIL. Returns the process and the WSDL URL.
+    """
+    process = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.stub_server", "--port", "0", "--latency", str(latency)]
+        + list(arguments),
+        stdout=subprocess.PIPE, text=True,
+    )
+    return process, process.stdout.readline().split()[-1]
+
+
+def start_wsgi(threads: int) -> str:
+    from proxy import app
+
+    PooledWSGIServer.threads = threads
+    server = make_server("127.0.0.1", 0, app, server_class=PooledWSGIServer,
+                         handler_class=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return "http://127.0.0.1:{}".format(server.server_address[1])
+
+
+def start_asgi() -> str:
+    import socket
+
+    import uvicorn
+
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    server = uvicorn.Server(uvicorn.Config("proxy_asgi:app", log_level="warning"))
+    threading.Thread(target=server.run, kwargs={"sockets": [sock]}, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return "http://127.0.0.1:{}".format(sock.getsockname()[1])
+
+
+async def drive(base_url: str, concurrency: int, duration: float) -> tuple:
+    """
+    Keeps the given number of tracking requests in flight for the given
+    duration. Returns the number of completed and failed requests.
+    """
+    import httpx
+
+    completed = failed = 0
+    deadline = time.perf_counter() + duration
+    limits = httpx.Limits(max_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        async def worker(number):
+            nonlocal completed, failed
+            while time.perf_counter() < deadline:
+                try:
+                    response = await client.get("/yk/shipments", params={"shipment_id": str(number)},
+                                                headers={"Authorization": AUTHORIZATION})
+                except httpx.TransportError:
+                    failed += 1
+                    continue
+                if response.status_code == 200:
+                    completed += 1
+                else:
+                    failed += 1
+
+        await asyncio.gather(*(worker(_) for _ in range(concurrency)))
+    return completed, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares tracking throughput of the WSGI and ASGI apps")
+    parser.add_argument("--latency", type=float, default=0.1,
+                        help="simulated upstream latency in seconds")
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--wsgi-threads", type=int, default=8)
+    args = parser.parse_args()
+
+    stub, url = start_stub(args.latency)
+    os.environ["YK_TEST_WSDL_URL"] = os.environ["YK_PROD_WSDL_URL"] = url
+    os.environ.setdefault("YK_WSDL_BUNDLE_DIR", tempfile.mkdtemp())
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    print("{:<24}{:>12}{:>10}{:>10}".format("app", "req/s", "ok", "failed"))
+    for name, start in (("wsgi ({} threads)".format(args.wsgi_threads), lambda: start_wsgi(args.wsgi_threads)),
+                        ("asgi", start_asgi)):
+        base_url = start()
+        completed, failed = asyncio.run(drive(base_url, args.concurrency, args.duration))
+        print("{:<24}{:>12.1f}{:>10}{:>10}".format(name, completed / args.duration, completed, failed))
+
+    stub.terminate()
+
+
+if __name__ == "__main__":
+    main()
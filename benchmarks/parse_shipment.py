@@ -0,0 +1,129 @@
+import argparse
+import random
+import timeit
+from types import SimpleNamespace
+
+from zeep import xsd
+
+from utilities import SHIPMENT_PARAMS, parse_shipment, unpack_phone_numbers
+
+
+def legacy_generate_special_field(shipment_object: dict) -> str:
+    fields = {
+        "customer_serial_number": "2",
+        "order_number": "3",
+        "bag_number": "4",
+        "packaging_number": "5",
+        "customer_national_id": "6",
+        "customer_full_name": "7",
+        "region": "8",
+        "department_or_employee_id": "9",
+        "mobile_phone": "10",
+        "policy_number": "11",
+        "cost_center": "12",
+        "product": "13",
+        "customer_reference": "14",
+        "rma_number": "16",
+        "magazine_type": "51",
+        "representative_id": "52",
+        "waybill_number": "54",
+        "recipient_vat_id": "55",
+        "representative_team_lead_id": "56",
+    }
+    field = ""
+    for field_name, field_code in fields.items():
+        field += "{}${}#".format(field_code, shipment_object.get(field_name, "")) if field_name in shipment_object else ""
+    return field if field != "" else xsd.SkipValue
+
+
+def legacy_parse_shipment(req, shipment: dict) -> dict:
+    """
+    The benedict-based implementation parse_shipment replaced.
+    """
+    from benedict import benedict
+
+    input_object = benedict(shipment)
+    output_object = benedict()
+    key_format = int(req.context["formatted"])
+    for param, param_name in SHIPMENT_PARAMS.items():
+        output_object[param] = input_object.get(param_name[key_format], xsd.SkipValue)
+    output_object.update(unpack_phone_numbers(req, shipment))
+    output_object["specialField1"] = legacy_generate_special_field(shipment)
+    output_object["specialField2"] = xsd.SkipValue
+    output_object["specialField3"] = xsd.SkipValue
+    return dict(output_object)
+
+
+def raw_shipment(number: int) -> dict:
+    shipment = {
+        "cargoKey": "K{:08d}".format(number),
+        "invoiceKey": "I{:08d}".format(number),
+        "receiverCustName": "Ayşe Yılmaz",
+        "receiverAddress": "Bağdat Cad. No: {}".format(number),
+        "cityName": "İstanbul",
+        "townName": "Kadıköy",
+        "receiverPhone1": "5321234567",
+        "desi": "2",
+        "kg": "1.5",
+        "cargoCount": 1,
+        "waybillNo": "W{}".format(number),
+        "description": "Kitap",
+    }
+    if random.random() < 0.5:
+        shipment.update(order_number=str(number), customer_reference="REF{}".format(number))
+    return shipment
+
+
+def formatted_shipment(number: int) -> dict:
+    shipment = {
+        "shipment_id": "K{:08d}".format(number),
+        "invoice_id": "I{:08d}".format(number),
+        "to_address": {
+            "name": "Ayşe Yılmaz",
+            "street1": "Bağdat Cad. No: {}".format(number),
+            "state": "İstanbul",
+            "city": "Kadıköy",
+            "phone": ["5321234567"],
+            "email": "ayse@example.com",
+        },
+        "parcel": {"volumetric_weight": "2", "weight": "1.5"},
+        "count": 1,
+        "waybill_id": "W{}".format(number),
+        "description": "Kitap",
+    }
+    if random.random() < 0.5:
+        shipment["options"] = {"cod_method": "0", "cod_amount": "100.00"}
+        shipment.update(order_number=str(number), customer_reference="REF{}".format(number))
+    return shipment
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Times parse_shipment over a large batch")
+    parser.add_argument("--shipments", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    try:
+        import benedict  # noqa: F401
+        implementations = (("current", parse_shipment), ("benedict", legacy_parse_shipment))
+    except ImportError:
+        implementations = (("current", parse_shipment),)
+
+    print("{:<12}{:<12}{:>14}{:>16}".format("mode", "impl", "batch ms", "us/shipment"))
+    for mode, factory in (("raw", raw_shipment), ("formatted", formatted_shipment)):
+        req = SimpleNamespace(context={"formatted": mode == "formatted"})
+        batch = [factory(_) for _ in range(args.shipments)]
+
+        if len(implementations) > 1:
+            for shipment in batch:
+                assert parse_shipment(req, shipment) == legacy_parse_shipment(req, shipment)
+
+        for name, implementation in implementations:
+            elapsed = min(timeit.repeat(lambda: [implementation(req, _) for _ in batch],
+                                        number=1, repeat=args.repeat))
+            print("{:<12}{:<12}{:>14.1f}{:>16.2f}".format(
+                mode, name, elapsed * 1000, elapsed * 1e6 / args.shipments))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.load import AUTHORIZATION, start_stub
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Call(object):
+    """
+    A single request of a scenario.
+    """
+    def __init__(self, method: str, path: str, params: dict = None, body=None, headers: dict = None):
+        self.method = method
+        self.path = path
+        self.params = params
+        self.body = body if body is None or isinstance(body, (str, bytes)) else json.dumps(body)
+        self.headers = dict({"Authorization": AUTHORIZATION}, **(headers or {}))
+
+    @classmethod
+    def from_record(cls, record: dict):
+        return cls(record.get("method", "GET"), record["path"], record.get("params"),
+                   record.get("body"), record.get("headers"))
+
+    def kwargs(self) -> dict:
+        return {"params": self.params, "body": self.body, "headers": self.headers}
+
+
+class Scenario(object):
+    """
+    A set of calls made with the given number of them in flight at once.
+    """
+    def __init__(self, name: str, calls: list, concurrency: int):
+        self.name = name
+        self.calls = calls
+        self.concurrency = concurrency
+
+
+def shipments(count: int, numbers) -> list:
+    # imported late, as the configuration is read on import
+    from benchmarks.parse_shipment import raw_shipment
+
+    return [raw_shipment(next(numbers)) for _ in range(count)]
+
+def synthetic_scenarios(args) -> list:
+    """
+    Builds the standard scenarios: single shipments, large batches, and
+    a storm of tracking lookups for a limited set of keys, so that the
+    tracking cache and the coalescing of lookups come into play.
+    """
+    numbers = itertools.count()
+    keys = ["K{:08d}".format(_) for _ in range(args.poll_keys)]
+    return [
+        Scenario("single", [
+            Call("POST", "/yk/shipments", body=shipments(1, numbers)) for _ in range(args.singles)
+        ], args.concurrency),
+        Scenario("batch-{}".format(args.batch_size), [
+            Call("POST", "/yk/shipments", body=shipments(args.batch_size, numbers)) for _ in range(args.batches)
+        ], 1),
+        Scenario("poll-storm", [
+            Call("GET", "/yk/shipments", params={"shipment_id": random.sample(keys, random.randint(1, 3))})
+            for _ in range(args.polls)
+        ], args.poll_concurrency),
+    ]
+
+def recorded_scenario(path: str, concurrency: int) -> Scenario:
+    """
+    Reads recorded requests, one JSON object per line with the method,
+    path, params, body and headers of a request.
+    """
+    with open(path) as records:
+        calls = [Call.from_record(json.loads(_)) for _ in records if _.strip()]
+    return Scenario(os.path.basename(path), calls, concurrency)
+
+
+def run_wsgi(app, scenario: Scenario) -> tuple:
+    """
+    Makes the calls of the scenario against the WSGI app. Returns the
+    latency of each call, the number of failed calls and the wall time.
+    """
+    import falcon.testing
+
+    client = falcon.testing.TestClient(app)
+
+    def call(_):
+        started = time.perf_counter()
+        result = client.simulate_request(_.method, _.path, **_.kwargs())
+        return time.perf_counter() - started, result.status_code >= 400
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(scenario.concurrency) as pool:
+        results = list(pool.map(call, scenario.calls))
+    return [_[0] for _ in results], sum(_[1] for _ in results), time.perf_counter() - started
+
+def run_asgi(app, scenario: Scenario) -> tuple:
+    """
+    Asynchronous version of run_wsgi, for the ASGI app.
+    """
+    import falcon.testing
+
+    async def run():
+        in_flight = asyncio.Semaphore(scenario.concurrency)
+        async with falcon.testing.ASGIConductor(app) as conductor:
+            async def call(_):
+                async with in_flight:
+                    started = time.perf_counter()
+                    result = await conductor.simulate_request(_.method, _.path, **_.kwargs())
+                    return time.perf_counter() - started, result.status_code >= 400
+
+            started = time.perf_counter()
+            results = await asyncio.gather(*(call(_) for _ in scenario.calls))
+            return [_[0] for _ in results], sum(_[1] for _ in results), time.perf_counter() - started
+
+    return asyncio.run(run())
+
+def peak_memory(run, app, scenario: Scenario) -> float:
+    """
+    Runs the scenario again while tracing allocations, and returns the
+    peak traced memory in MB.
+    """
+    tracemalloc.start()
+    try:
+        run(app, scenario)
+        return tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replays synthetic or recorded traffic against the apps, with a local SOAP stub")
+    parser.add_argument("--app", choices=("wsgi", "asgi"), action="append",
+                        help="app to drive, both by default")
+    parser.add_argument("--record", action="append", default=[], metavar="FILE",
+                        help="NDJSON file of recorded requests to replay instead of the synthetic scenarios")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="simulated upstream latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--error", action="append", default=[], metavar="CODE=RATE",
+                        help="share of shipments or keys the stub fails with the code, e.g. 60020=0.01")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--singles", type=int, default=500)
+    parser.add_argument("--batches", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--polls", type=int, default=5000)
+    parser.add_argument("--poll-keys", type=int, default=500)
+    parser.add_argument("--poll-concurrency", type=int, default=64)
+    parser.add_argument("--no-memory", action="store_true",
+                        help="skip the second run of each scenario that measures memory")
+    args = parser.parse_args()
+
+    stub_args = ["--jitter", str(args.jitter)] + ["--error={}".format(_) for _ in args.error]
+    stub, url = start_stub(args.latency, stub_args)
+    os.environ["YK_TEST_WSDL_URL"] = os.environ["YK_PROD_WSDL_URL"] = url
+    os.environ.setdefault("YK_WSDL_BUNDLE_DIR", tempfile.mkdtemp())
+    os.environ.setdefault("YK_JOB_QUEUE_PATH", os.path.join(tempfile.mkdtemp(), "jobs.sqlite3"))
+    sys.path.insert(0, ROOT)
+
+    if args.record:
+        scenarios = [recorded_scenario(_, args.concurrency) for _ in args.record]
+    else:
+        scenarios = synthetic_scenarios(args)
+
+    print("{:<16}{:<6}{:>9}{:>8}{:>10}{:>10}{:>10}{:>10}".format(
+        "scenario", "app", "requests", "failed", "req/s", "p50 ms", "p99 ms", "peak MB"))
+    for name in args.app or ("wsgi", "asgi"):
+        if name == "wsgi":
+            from proxy import app
+            run = run_wsgi
+        else:
+            from proxy_asgi import app
+            run = run_asgi
+        for scenario in scenarios:
+            latencies, failed, elapsed = run(app, scenario)
+            percentiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+            memory = "" if args.no_memory else "{:.1f}".format(peak_memory(run, app, scenario))
+            print("{:<16}{:<6}{:>9}{:>8}{:>10.1f}{:>10.1f}{:>10.1f}{:>10}".format(
+                scenario.name, name, len(latencies), failed, len(latencies) / elapsed,
+                percentiles[49] * 1000, percentiles[98] * 1000, memory), flush=True)
+
+    stub.terminate()
+
+
+if __name__ == "__main__":
+    main()
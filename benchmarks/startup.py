@@ -0,0 +1,92 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from benchmarks.stub_server import serve, wsdl_url
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The import path used before clients were created lazily: both clients
+# are built from the WSDL URLs while the module is being imported.
+EAGER = """
+import time
+start = time.perf_counter()
+import falcon
+import utilities
+from zeep import Client
+from zeep.cache import SqliteCache
+from zeep.transports import Transport
+from reference import PROD_WSDL_URL, TEST_WSDL_URL
+transport = Transport(cache=SqliteCache(path={cache!r}))
+test_client = Client(TEST_WSDL_URL, transport=transport)
+prod_client = Client(PROD_WSDL_URL, transport=transport)
+print(time.perf_counter() - start)
+"""
+
+LAZY_IMPORT = """
+import time
+start = time.perf_counter()
+import proxy
+print(time.perf_counter() - start)
+"""
+
+LAZY_FIRST_CLIENT = """
+import time
+start = time.perf_counter()
+import proxy
+from clients import get_client
+get_client("test")
+get_client("prod")
+print(time.perf_counter() - start)
+"""
+
+
+def run(code: str, env: dict) -> float:
+    output = subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=env,
+                            check=True, capture_output=True, text=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares worker cold start times")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="simulated upstream latency in seconds")
+    args = parser.parse_args()
+
+    server = serve(port=0, latency=args.latency)
+    url = wsdl_url(server)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(os.environ, YK_TEST_WSDL_URL=url, YK_PROD_WSDL_URL=url,
+                   YK_WSDL_BUNDLE_DIR=os.path.join(workdir, "wsdl"))
+        cache = os.path.join(workdir, "zeep.db")
+
+        from clients import bundle_wsdl
+        for environment in ("test", "prod"):
+            bundle_wsdl(url, os.path.join(workdir, "wsdl", environment))
+
+        def eager_cold():
+            if os.path.exists(cache):
+                os.remove(cache)
+            return run(EAGER.format(cache=cache), env)
+
+        scenarios = [
+            ("eager, cold cache", eager_cold),
+            ("eager, warm cache", lambda: run(EAGER.format(cache=cache), env)),
+            ("lazy, import only", lambda: run(LAZY_IMPORT, env)),
+            ("lazy, both clients from bundle", lambda: run(LAZY_FIRST_CLIENT, env)),
+        ]
+        print("{:<34}{:>12}{:>12}".format("scenario", "median ms", "max ms"))
+        for name, scenario in scenarios:
+            timings = [scenario() * 1000 for _ in range(args.runs)]
+            print("{:<34}{:>12.1f}{:>12.1f}".format(name, statistics.median(timings), max(timings)))
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import threading
+from xml.sax.saxutils import escape
+
+from lxml import etree
+
+WSDL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stub.wsdl")
+SERVICE_PATH = "/KOPSWebServices/ShippingOrderDispatcherServices"
+NAMESPACE = "http://yurticikargo.com.tr/ShippingOrderDispatcherServices"
+
+ENVELOPE = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<S:Envelope xmlns:S="http://schemas.xmlsoap.org/soap/envelope/">'
+    '<S:Body><ns2:{operation}Response xmlns:ns2="' + NAMESPACE + '">'
+    '{result}'
+    '</ns2:{operation}Response></S:Body></S:Envelope>'
+)
+
+
+def element(name: str, value) -> str:
+    """
+    Renders a single unqualified XML element, or nothing if the value
+    is None.
+    """
+    if value is None:
+        return ""
+    return "<{0}>{1}</{0}>".format(name, escape(str(value)))
+
+
+def children_text(node, name: str) -> list:
+    """
+    Returns the text of every direct child of the node with the given
+    local name.
+    """
+    return [_.text or "" for _ in node if etree.QName(_).localname == name]
+
+
+def parse_errors(values: list) -> dict:
+    """
+    Parses CODE=RATE arguments into the error rates of the stub.
+    """
+    errors = {}
+    for value in values:
+        code, _, rate = value.partition("=")
+        errors[int(code)] = float(rate)
+    return errors
+
+
+class StubService(object):
+    """
+    Keeps the state of the stub service and renders responses for each
+    supported operation. Each shipment or key of a call fails with one
+    of the given error codes at the given rate, e.g. {60020: 0.01}.
+    """
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, errors: dict = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.errors = errors or {}
+        self.messages = {}
+        if self.errors:
+            # imported late, as the configuration of the app importing the
+            # stub is read on import
+            from reference import ERRORS_CREATE_SHIPMENT
+
+            self.messages = { code: ERRORS_CREATE_SHIPMENT[code][2] for code in self.errors
+                              if code in ERRORS_CREATE_SHIPMENT }
+        self.job_ids = itertools.count(1000000)
+        self.lock = threading.Lock()
+
+    def delay(self) -> float:
+        """
+        Returns how long to wait before answering a call.
+        """
+        return self.latency + random.uniform(0, self.jitter)
+
+    def error(self) -> str:
+        """
+        Picks the error of a single shipment or key, rendered as its
+        errCode and errMessage elements, or nothing if it doesn't fail.
+        """
+        draw = random.random()
+        for code, rate in self.errors.items():
+            if draw < rate:
+                return element("errCode", code) + element("errMessage", self.messages.get(code, "Hata"))
+            draw -= rate
+        return ""
+
+    def create_shipment(self, request) -> str:
+        details = []
+        with self.lock:
+            job_id = next(self.job_ids)
+        for vo in request:
+            if etree.QName(vo).localname != "ShippingOrderVO":
+                continue
+            details.append("<shippingOrderDetailVO>{}{}{}</shippingOrderDetailVO>".format(
+                element("cargoKey", (children_text(vo, "cargoKey") or [None])[0]),
+                element("invoiceKey", (children_text(vo, "invoiceKey") or [None])[0]),
+                self.error(),
+            ))
+        return "<ShippingOrderResultVO>{}{}{}{}{}</ShippingOrderResultVO>".format(
+            element("outFlag", "0"),
+            element("outResult", "Başarılı"),
+            element("count", len(details)),
+            element("jobId", job_id),
+            "".join(details),
+        )
+
+    def query_shipment(self, request) -> str:
+        keys = children_text(request, "keys")
+        key_type = (children_text(request, "keyType") or ["0"])[0]
+        details = []
+        for key in keys:
+            details.append("<shippingDeliveryDetailVO>{}{}{}{}{}{}</shippingDeliveryDetailVO>".format(
+                element("cargoKey", key if key_type == "0" else "C" + key),
+                element("invoiceKey", key if key_type == "1" else "I" + key),
+                element("operationCode", 1),
+                element("operationMessage", "Kargo teslimattadır."),
+                element("operationStatus", "IND"),
+                self.error(),
+            ))
+        return "<ShippingDeliveryVO>{}{}{}{}</ShippingDeliveryVO>".format(
+            element("outFlag", "0"),
+            element("outResult", "Başarılı"),
+            element("count", len(details)),
+            "".join(details),
+        )
+
+    def cancel_shipment(self, request) -> str:
+        details = []
+        for key in children_text(request, "cargoKeys"):
+            error = self.error()
+            details.append("<shippingOrderDetailVO>{}{}{}{}</shippingOrderDetailVO>".format(
+                element("cargoKey", key),
+                error,
+                element("operationCode", None if error else 1),
+                element("operationStatus", None if error else "CNL"),
+            ))
+        return "<ShippingOrderResultVO>{}{}{}{}</ShippingOrderResultVO>".format(
+            element("outFlag", "0"),
+            element("outResult", "Başarılı"),
+            element("count", len(details)),
+            "".join(details),
+        )
+
+    def handle(self, body: bytes) -> str:
+        envelope = etree.fromstring(body)
+        request = envelope.find("{http://schemas.xmlsoap.org/soap/envelope/}Body")[0]
+        operation = etree.QName(request).localname
+        result = getattr(self, {
+            "createShipment": "create_shipment",
+            "queryShipment": "query_shipment",
+            "cancelShipment": "cancel_shipment",
+        }[operation])(request)
+        return ENVELOPE.format(operation=operation, result=result)
+
+
+class StubServer(object):
+    """
+    A minimal HTTP/1.1 server with keep-alive, running on its own event
+    loop so that simulated latency doesn't tie up a thread per call. The
+    WSDL is served from any GET request.
+    """
+    def __init__(self, service: StubService, host: str, port: int):
+        self.service = service
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(
+            asyncio.start_server(self.handle_connection, host, port, backlog=1024))
+        self.server_address = self.server.sockets[0].getsockname()
+        with open(WSDL_PATH, "rb") as wsdl_file:
+            self.wsdl = wsdl_file.read().replace(
+                b"http://localhost:8090" + SERVICE_PATH.encode("ascii"),
+                "http://{}:{}{}".format(*self.server_address[:2], SERVICE_PATH).encode("ascii"),
+            )
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method = request_line.split(b" ", 1)[0]
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                delay = self.service.delay()
+                if delay:
+                    await asyncio.sleep(delay)
+                if method == b"GET":
+                    payload = self.wsdl
+                else:
+                    payload = self.service.handle(body).encode("utf-8")
+                writer.write(b"HTTP/1.1 200 OK\r\n"
+                             b"Content-Type: text/xml; charset=utf-8\r\n"
+                             b"Content-Length: %d\r\n\r\n" % len(payload) + payload)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def serve_forever(self):
+        self.loop.run_forever()
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def serve(host: str = "127.0.0.1", port: int = 8090, latency: float = 0.0,
+          jitter: float = 0.0, errors: dict = None) -> StubServer:
+    """
+    Starts the stub service on a background thread and returns the
+    server.
+    """
+    server = StubServer(StubService(latency, jitter, errors), host, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def wsdl_url(server: StubServer) -> str:
+    host, port = server.server_address[:2]
+    return "http://{}:{}{}?wsdl".format(host, port, SERVICE_PATH)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local Yurtiçi Kargo SOAP stub")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds to wait before answering each call")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="up to this many seconds are added to the latency at random")
+    parser.add_argument("--error", action="append", default=[], metavar="CODE=RATE",
+                        help="fail this share of shipments or keys with the error code, e.g. 60020=0.01")
+    args = parser.parse_args()
+    server = serve(args.host, args.port, args.latency, args.jitter, parse_errors(args.error))
+    print("Serving {}".format(wsdl_url(server)), flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
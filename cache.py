@@ -0,0 +1,280 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from reference import (AUTH_CACHE_SIZE, FINAL_OPERATION_STATUSES, SUCCESSFUL,
+                       TRACKING_CACHE_BACKEND, TRACKING_CACHE_SIZE,
+                       TRACKING_CACHE_STALE_TTL, TRACKING_CACHE_TTL_FINAL,
+                       TRACKING_CACHE_TTL_IN_TRANSIT)
+from utilities import (credentials_hash, delivery_key_field,
+                       parse_authorization)
+
+
+class LRUCache(object):
+    """
+    A thread-safe, size-bounded in-process cache whose entries expire
+    after their own TTL. Expired entries are kept for `retention` seconds
+    more.
+    """
+    def __init__(self, max_size: int, retention: float = 0):
+        self.max_size = max_size
+        self.retention = retention
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> tuple:
+        """
+        Returns the value and the expiry time (as a time.time() timestamp)
+        of the entry, which may have expired, or (None, None) if there 
+        isn't one.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None, None
+            if entry[1] + self.retention < time.time():
+                del self._entries[key]
+                return None, None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key: str, value: str, expires: float):
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SqliteBackend(object):
+    """
+    A cache backend that can be shared between the worker processes of
+    a host. Anything with the same get and set methods (e.g. a Redis
+    client wrapper) can be used instead.
+    """
+    PURGE_INTERVAL = 1000
+
+    def __init__(self, path: str, retention: float = 0):
+        self.retention = retention
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def get(self, key: str) -> tuple:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value, expires FROM entries WHERE key = ? AND expires >= ?",
+                (key, time.time() - self.retention)).fetchone()
+        return row if row is not None else (None, None)
+
+    def set(self, key: str, value: str, expires: float):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO entries (key, value, expires) VALUES (?, ?, ?)",
+                (key, value, expires))
+            self._writes += 1
+            if self._writes % self.PURGE_INTERVAL == 0:
+                self._connection.execute("DELETE FROM entries WHERE expires < ?",
+                                         (time.time() - self.retention,))
+
+
+class ResponseCache(object):
+    """
+    An in-process LRU cache, optionally backed by a shared backend, that
+    counts its hits and misses.
+    """
+    def __init__(self, local: LRUCache, backend=None):
+        self.local = local
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+
+    def get(self, key: str, stale: bool = False):
+        """
+        Returns the value of a live entry, or of an expired one that's
+        still retained if `stale` is set.
+        """
+        now = time.time()
+        value, expires = self.local.get(key)
+        if (value is None or expires < now) and self.backend is not None:
+            backend_value, backend_expires = self.backend.get(key)
+            if backend_value is not None and (value is None or backend_expires > expires):
+                value, expires = backend_value, backend_expires
+                self.local.set(key, value, expires)
+        if value is not None and expires < now:
+            if stale:
+                self.stale_hits += 1
+                return value
+            value = None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key: str, value: str, ttl: float):
+        expires = time.time() + ttl
+        self.local.set(key, value, expires)
+        if self.backend is not None:
+            self.backend.set(key, value, expires)
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale_hits": self.stale_hits,
+            "size": len(self.local),
+            "max_size": self.local.max_size,
+        }
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls that share a key: the first caller makes
+    the call, and callers that arrive while it's in flight wait for and
+    receive the same result.
+    """
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, function, *args):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        if not leader:
+            return future.result()
+
+        try:
+            result = function(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+class AsyncSingleFlight(object):
+    """
+    Asynchronous version of SingleFlight. A caller being cancelled
+    doesn't cancel the call for the others.
+    """
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key: str, function, *args):
+        task = self._calls.get(key)
+        if task is None:
+            task = self._calls[key] = asyncio.ensure_future(function(*args))
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        return await asyncio.shield(task)
+
+
+def cached_credentials(header: str) -> tuple:
+    """
+    Returns the username and password of an Authorization header,
+    raising ValueError if it isn't valid. Decoded headers are cached,
+    keyed by their hash.
+    """
+    key = hashlib.sha256(header.encode("utf-8")).hexdigest()
+    credentials, _ = credentials_cache.get(key)
+    if credentials is None:
+        credentials = parse_authorization(header)
+        credentials_cache.set(key, credentials, float("inf"))
+    return credentials
+
+def verification_key(req) -> str:
+    return "{}|{}".format(credentials_hash(req.context["username"], req.context["password"]),
+                          req.context["environment"])
+
+def tracking_ttl(delivery: dict) -> float:
+    """
+    Returns how long a delivery can be cached for, based on its status.
+    """
+    if delivery["operationStatus"] in FINAL_OPERATION_STATUSES:
+        return TRACKING_CACHE_TTL_FINAL
+    return TRACKING_CACHE_TTL_IN_TRANSIT
+
+
+def tracking_prefix(req, key_type: int, add_historical_data: bool,
+                    tracking_url_only: bool) -> str:
+    """
+    Returns the part of the cache key shared by every key of a lookup.
+    Credentials are only kept as a hash.
+    """
+    credentials = credentials_hash(req.context["username"], req.context["password"])
+    return "{}|{}|{}|{:d}|{:d}|".format(credentials, req.context["environment"], key_type,
+                                        add_historical_data, tracking_url_only)
+
+
+def cached_deliveries(prefix: str, keys: list, stale: bool = False) -> tuple:
+    """
+    Looks up the keys of a queryShipment call in the tracking cache,
+    including expired deliveries if `stale` is set. Returns a response 
+    object made of the cached deliveries, or None if none were cached,
+    along with the keys that weren't cached.
+    """
+    response, missing = None, []
+    for key in keys:
+        entry = tracking_cache.get(prefix + key, stale)
+        entry = json.loads(entry) if entry is not None else {}
+        # entries cached with a single delivery per key are looked up again
+        if "deliveries" not in entry:
+            missing.append(key)
+            continue
+        if response is None:
+            response = entry["header"]
+            response["shippingDeliveryDetailVO"] = []
+        response["shippingDeliveryDetailVO"].extend(entry["deliveries"])
+    if response is not None:
+        response["count"] = len(response["shippingDeliveryDetailVO"])
+    return response, missing
+
+
+def cache_deliveries(prefix: str, key_type: int, response: dict):
+    """
+    Stores the deliveries of a successful queryShipment response in the
+    tracking cache, all the deliveries of a key together, for as long as
+    the one that can be cached for the shortest time. Deliveries with
+    errors aren't cached.
+    """
+    if response["outFlag"] != SUCCESSFUL:
+        return
+    header = { k: v for k, v in response.items() if k != "shippingDeliveryDetailVO" }
+    key_field = delivery_key_field(key_type)
+    by_key = {}
+    for delivery in response["shippingDeliveryDetailVO"] or []:
+        if delivery["errCode"] is None and delivery[key_field] is not None:
+            by_key.setdefault(delivery[key_field], []).append(delivery)
+    for key, deliveries in by_key.items():
+        tracking_cache.set(prefix + key, json.dumps({"header": header, "deliveries": deliveries}),
+                           min(tracking_ttl(_) for _ in deliveries))
+
+
+tracking_cache = ResponseCache(
+    LRUCache(TRACKING_CACHE_SIZE, TRACKING_CACHE_STALE_TTL),
+    SqliteBackend(TRACKING_CACHE_BACKEND, TRACKING_CACHE_STALE_TTL) if TRACKING_CACHE_BACKEND else None,
+)
+
+# Decoded Authorization headers, and whether credentials were accepted
+# upstream
+credentials_cache = LRUCache(AUTH_CACHE_SIZE)
+verified_credentials = LRUCache(AUTH_CACHE_SIZE)
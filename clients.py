@@ -0,0 +1,453 @@
+import argparse
+import asyncio
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from urllib.parse import urljoin
+
+import requests
+from lxml import etree
+from zeep import AsyncClient, Client
+from zeep.cache import SqliteCache
+from zeep.exceptions import LookupError as ZeepLookupError
+from zeep.exceptions import NamespaceError
+from zeep.transports import AsyncTransport, Transport
+
+from envelopes import AsyncFastService, FastService
+from reference import (ENVIRONMENT_PROD, ENVIRONMENT_TEST, FAST_SOAP,
+                       PROD_WSDL_URL, TENANT_IDLE_TIMEOUT, TENANT_POOL_LIMIT,
+                       TENANT_POOL_SIZE, TEST_WSDL_URL,
+                       UPSTREAM_KEEPALIVE_EXPIRY, UPSTREAM_POOL_SIZE,
+                       UPSTREAM_THREADS, WSDL_BUNDLE_DIR)
+from scheduling import AsyncFairScheduler, FairScheduler
+
+WSDL_URLS = {
+    ENVIRONMENT_TEST: TEST_WSDL_URL,
+    ENVIRONMENT_PROD: PROD_WSDL_URL,
+}
+
+BUNDLE_ENTRY_POINT = "service.wsdl"
+
+# (connect, read) timeouts of the upstream operation being called, set
+# around each call so that calls on a shared client can have their own
+operation_timeout = ContextVar("operation_timeout", default=None)
+
+# Elements whose attribute points at another document that has to be bundled
+IMPORT_XPATH = etree.XPath(
+    "//xsd:import[@schemaLocation] | //xsd:include[@schemaLocation] | //wsdl:import[@location]",
+    namespaces={
+        "xsd": "http://www.w3.org/2001/XMLSchema",
+        "wsdl": "http://schemas.xmlsoap.org/wsdl/",
+    },
+)
+
+_clients = {}
+_async_clients = {}
+_services = {}
+_async_services = {}
+_clients_lock = threading.Lock()
+
+# Upstream calls of the tenants of an environment share its slots
+schedulers = {
+    environment: FairScheduler(UPSTREAM_POOL_SIZE, TENANT_POOL_SIZE) for environment in WSDL_URLS
+}
+async_schedulers = {
+    environment: AsyncFairScheduler(UPSTREAM_POOL_SIZE, TENANT_POOL_SIZE) for environment in WSDL_URLS
+}
+
+# Least recently used first
+_tenant_pools = OrderedDict()
+_async_tenant_pools = OrderedDict()
+_closing = set()
+_tenants_lock = threading.Lock()
+
+
+def bundle_path(environment: str) -> str:
+    """
+    Returns the path of the bundled WSDL for the given environment.
+    """
+    return os.path.join(WSDL_BUNDLE_DIR, environment, BUNDLE_ENTRY_POINT)
+
+
+def bundle_wsdl(url: str, target_dir: str) -> list:
+    """
+    Downloads the WSDL at the given URL along with every document it
+    imports, rewriting the references so that the copies written to
+    the target directory can be loaded without network access.
+    """
+    os.makedirs(target_dir, exist_ok=True)
+    session = requests.Session()
+    file_names = {}
+    pending = []
+
+    def local_name(location):
+        if location not in file_names:
+            file_names[location] = (BUNDLE_ENTRY_POINT if not file_names
+                                    else "document{}.xml".format(len(file_names)))
+            pending.append(location)
+        return file_names[location]
+
+    local_name(url)
+    while pending:
+        location = pending.pop()
+        response = session.get(location)
+        response.raise_for_status()
+        document = etree.fromstring(response.content)
+        for node in IMPORT_XPATH(document):
+            attribute = "location" if "location" in node.attrib else "schemaLocation"
+            node.set(attribute, local_name(urljoin(location, node.get(attribute))))
+        with open(os.path.join(target_dir, file_names[location]), "wb") as output:
+            output.write(etree.tostring(document, xml_declaration=True, encoding="utf-8"))
+
+    return list(file_names.values())
+
+
+class TimeoutAdapter(requests.adapters.HTTPAdapter):
+    """
+    An adapter that applies the timeouts of the operation being called.
+    """
+    def send(self, request, timeout=None, **kwargs):
+        return super().send(request, timeout=operation_timeout.get() or timeout, **kwargs)
+
+
+async def apply_operation_timeout(request):
+    """
+    httpx request hook applying the timeouts of the operation being
+    called.
+    """
+    timeout = operation_timeout.get()
+    if timeout is not None:
+        connect, read = timeout
+        request.extensions["timeout"] = {"connect": connect, "read": read,
+                                         "write": read, "pool": connect}
+
+
+def create_session(pool_size: int) -> requests.Session:
+    """
+    Creates a session that keeps up to `pool_size` connections for
+    concurrent calls.
+    """
+    session = requests.Session()
+    session.mount("https://", TimeoutAdapter(pool_maxsize=pool_size))
+    session.mount("http://", TimeoutAdapter(pool_maxsize=pool_size))
+    return session
+
+
+def create_async_transport(pool_size: int, wsdl_client=None) -> AsyncTransport:
+    """
+    Creates an asynchronous transport whose calls go through a bounded
+    pool of keep-alive connections.
+    """
+    import httpx
+
+    return AsyncTransport(client=httpx.AsyncClient(
+        timeout=None,
+        event_hooks={"request": [apply_operation_timeout]},
+        limits=httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+        ),
+    ), wsdl_client=wsdl_client)
+
+
+def create_client(environment: str) -> Client:
+    """
+    Creates a zeep client for the given environment, loading the WSDL
+    from the local bundle if there is one and from the network otherwise.
+    The session keeps enough connections for concurrent calls.
+    """
+    session = create_session(UPSTREAM_POOL_SIZE)
+    if os.path.exists(bundle_path(environment)):
+        return Client(bundle_path(environment), transport=Transport(session=session))
+    return Client(WSDL_URLS[environment], transport=Transport(cache=SqliteCache(), session=session))
+
+
+def create_async_client(environment: str) -> AsyncClient:
+    """
+    Creates an asynchronous zeep client for the given environment. The
+    WSDL itself is still loaded synchronously.
+    """
+    transport = create_async_transport(UPSTREAM_POOL_SIZE)
+    if os.path.exists(bundle_path(environment)):
+        return AsyncClient(bundle_path(environment), transport=transport)
+    transport.cache = SqliteCache()
+    return AsyncClient(WSDL_URLS[environment], transport=transport)
+
+
+def shipping_type_factory(client: Client):
+    """
+    Returns the type factory for the namespace that holds the shipping
+    types. The namespace prefix differs between the test and production
+    WSDLs, so it's looked up instead of hardcoded.
+    """
+    for prefix, namespace in client.wsdl.types.prefix_map.items():
+        try:
+            client.get_type("{{{}}}ShippingOrderVO".format(namespace))
+        except (ZeepLookupError, NamespaceError):
+            continue
+        return client.type_factory(prefix)
+    raise ZeepLookupError("ShippingOrderVO is not defined in the WSDL")
+
+
+def get_client(environment: str) -> tuple:
+    """
+    Returns the zeep client and the type factory for the given
+    environment, creating them on first use.
+    """
+    try:
+        return _clients[environment]
+    except KeyError:
+        pass
+
+    with _clients_lock:
+        if environment not in _clients:
+            client = create_client(environment)
+            _clients[environment] = (client, shipping_type_factory(client))
+        return _clients[environment]
+
+
+def get_async_client(environment: str) -> tuple:
+    """
+    Returns the asynchronous zeep client and the type factory for the
+    given environment, creating them on first use.
+    """
+    try:
+        return _async_clients[environment]
+    except KeyError:
+        pass
+
+    with _clients_lock:
+        if environment not in _async_clients:
+            client = create_async_client(environment)
+            _async_clients[environment] = (client, shipping_type_factory(client))
+        return _async_clients[environment]
+
+
+def get_service(environment: str) -> tuple:
+    """
+    Returns what createShipment and queryShipment are called on for the
+    given environment, along with the type shipments are passed to them
+    as. With FAST_SOAP set, that's a FastService taking plain dicts.
+    """
+    client, factory = get_client(environment)
+    if not FAST_SOAP:
+        return client.service, factory.ShippingOrderVO
+    with _clients_lock:
+        if environment not in _services:
+            _services[environment] = (FastService(client), dict)
+        return _services[environment]
+
+
+def get_async_service(environment: str) -> tuple:
+    """
+    Asynchronous version of get_service.
+    """
+    client, factory = get_async_client(environment)
+    if not FAST_SOAP:
+        return client.service, factory.ShippingOrderVO
+    with _clients_lock:
+        if environment not in _async_services:
+            _async_services[environment] = (AsyncFastService(client), dict)
+        return _async_services[environment]
+
+
+class Lease(object):
+    """
+    Kept in the context of each request using a pool, so that the pool
+    isn't closed while the request (or its streamed response) is alive.
+    """
+
+
+class TenantPool(object):
+    """
+    The upstream connections of a tenant in an environment, and what
+    calls are made over them. The client shares the WSDL parsed for the
+    environment. Calls are made in the slots handed out by the scheduler
+    of the environment, and concurrent calls of a request on the threads
+    of the executor. A pool is in use while the context of a request it
+    was handed to is alive, or while it has calls in flight or waiting.
+    """
+    def __init__(self, tenant: str, client, factory, service, shipment_type, scheduler,
+                 executor=None):
+        self.tenant = tenant
+        self.client = client
+        self.factory = factory
+        self.service = service
+        self.shipment_type = shipment_type
+        self.scheduler = scheduler
+        self.executor = executor
+        self.last_used = time.monotonic()
+        self.leases = weakref.WeakSet()
+
+    def context(self) -> dict:
+        """
+        Returns what a request of the tenant is made with, to be added to
+        its context, along with the lease the request holds on the pool.
+        """
+        lease = Lease()
+        self.leases.add(lease)
+        return {
+            "lease": lease,
+            "pool": self,
+            "client": self.client,
+            "factory": self.factory,
+            "service": self.service,
+            "shipment_type": self.shipment_type,
+        }
+
+    def in_use(self) -> bool:
+        return bool(self.leases) or self.scheduler.busy(self.tenant)
+
+    def idle(self, now: float) -> bool:
+        return now - self.last_used >= TENANT_IDLE_TIMEOUT and not self.in_use()
+
+    @contextmanager
+    def slot(self):
+        """
+        Waits for the turn of the tenant to make a call.
+        """
+        self.scheduler.acquire(self.tenant)
+        try:
+            yield
+        finally:
+            self.scheduler.release(self.tenant)
+            self.last_used = time.monotonic()
+
+    def close(self):
+        self.client.transport.session.close()
+        self.executor.shutdown(wait=False)
+
+class AsyncTenantPool(TenantPool):
+    """
+    Asynchronous version of TenantPool, without an executor.
+    """
+    @asynccontextmanager
+    async def slot(self):
+        await self.scheduler.acquire(self.tenant)
+        try:
+            yield
+        finally:
+            self.scheduler.release(self.tenant)
+            self.last_used = time.monotonic()
+
+    async def close(self):
+        await self.client.transport.aclose()
+
+
+def create_tenant_pool(environment: str, tenant: str) -> TenantPool:
+    """
+    Creates the pool of a tenant in the given environment.
+    """
+    base, factory = get_client(environment)
+    client = Client(base.wsdl, transport=Transport(session=create_session(TENANT_POOL_SIZE)))
+    service, shipment_type = get_service(environment)
+    service = service.bind(client) if FAST_SOAP else client.service
+    return TenantPool(tenant, client, factory, service, shipment_type, schedulers[environment],
+                      ThreadPoolExecutor(UPSTREAM_THREADS, thread_name_prefix="upstream"))
+
+
+def create_async_tenant_pool(environment: str, tenant: str) -> AsyncTenantPool:
+    """
+    Asynchronous version of create_tenant_pool.
+    """
+    base, factory = get_async_client(environment)
+    transport = create_async_transport(TENANT_POOL_SIZE, wsdl_client=base.transport.wsdl_client)
+    client = AsyncClient(base.wsdl, transport=transport)
+    service, shipment_type = get_async_service(environment)
+    service = service.bind(client) if FAST_SOAP else client.service
+    return AsyncTenantPool(tenant, client, factory, service, shipment_type,
+                           async_schedulers[environment])
+
+
+def evict_tenant_pools(pools: OrderedDict, limit: int) -> list:
+    """
+    Removes the pools that are idle, then the least recently used pools
+    that aren't in use until there are fewer than `limit` left, and
+    returns them to be closed. Pools in use are never removed.
+    """
+    now = time.monotonic()
+    evicted = [pools.pop(_) for _ in [k for k, v in pools.items() if v.idle(now)]]
+    for key in [k for k, v in pools.items() if not v.in_use()]:
+        if len(pools) < limit:
+            break
+        evicted.append(pools.pop(key))
+    return evicted
+
+
+def tenant_context(pools: OrderedDict, create, environment: str, tenant: str) -> tuple:
+    """
+    Returns the context of a request of the tenant in the given
+    environment, creating the pool of the tenant on first use, along
+    with the pools that were removed to make room for it, to be closed.
+    """
+    key = (environment, tenant)
+    evicted = []
+    with _tenants_lock:
+        pool = pools.get(key)
+        if pool is None:
+            evicted = evict_tenant_pools(pools, TENANT_POOL_LIMIT)
+            pool = pools[key] = create(environment, tenant)
+        else:
+            pools.move_to_end(key)
+        pool.last_used = time.monotonic()
+        return pool.context(), evicted
+
+
+def get_tenant_context(environment: str, tenant: str) -> dict:
+    """
+    Returns the context of a request of the tenant in the given
+    environment, with the pool of the tenant. At most TENANT_POOL_LIMIT
+    pools are kept, unless more are in use, and pools that are removed
+    are closed.
+    """
+    context, evicted = tenant_context(_tenant_pools, create_tenant_pool, environment, tenant)
+    for _ in evicted:
+        _.close()
+    return context
+
+
+def get_async_tenant_context(environment: str, tenant: str) -> dict:
+    """
+    Asynchronous version of get_tenant_context, closing removed pools in
+    the background.
+    """
+    context, evicted = tenant_context(_async_tenant_pools, create_async_tenant_pool,
+                                      environment, tenant)
+    for _ in evicted:
+        task = asyncio.ensure_future(_.close())
+        _closing.add(task)
+        task.add_done_callback(_closing.discard)
+    return context
+
+
+async def close_async_clients():
+    """
+    Closes the connection pools of every asynchronous client created so
+    far.
+    """
+    while _async_tenant_pools:
+        await _async_tenant_pools.popitem()[1].close()
+    _async_services.clear()
+    while _async_clients:
+        client, _ = _async_clients.popitem()[1]
+        await client.transport.aclose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manages the local WSDL bundle")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    bundle_parser = subparsers.add_parser("bundle", help="download the WSDLs for offline use")
+    bundle_parser.add_argument("environments", nargs="*",
+                               default=[ENVIRONMENT_TEST, ENVIRONMENT_PROD])
+    args = parser.parse_args()
+
+    for environment in args.environments:
+        target_dir = os.path.dirname(bundle_path(environment))
+        files = bundle_wsdl(WSDL_URLS[environment], target_dir)
+        print("{}: wrote {} file(s) to {}".format(environment, len(files), target_dir))
@@ -0,0 +1,285 @@
+import copy
+import re
+from io import BytesIO
+from os.path import commonprefix
+
+from lxml import etree
+from zeep import xsd
+from zeep.wsdl.utils import etree_to_string
+
+PLACEHOLDER = "@@{}@@"
+PLACEHOLDER_PATTERN = re.compile(r"@@(\w+)@@")
+# An element whose whole content is a placeholder
+FIELD_PATTERN = re.compile(r"(<[^<>]+>)@@(\w+)@@(</[^<>]+>)")
+
+SOAP_FAULT = "{http://schemas.xmlsoap.org/soap/envelope/}Fault"
+XSI_NIL = "{http://www.w3.org/2001/XMLSchema-instance}nil"
+
+# Operations with a fast path, and the parameter holding their list of items
+FAST_OPERATIONS = {
+    "createShipment": "ShippingOrderVO",
+    "queryShipment": "keys",
+}
+
+
+def escape_text(value: str) -> str:
+    """
+    Escapes text the way lxml does when zeep renders it.
+    """
+    return value.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace("\r", "&#13;")
+
+def split_placeholders(text: str) -> tuple:
+    """
+    Splits rendered XML into its literal text and the names of the
+    placeholders between them.
+    """
+    parts = PLACEHOLDER_PATTERN.split(text)
+    return tuple(parts[0::2]), tuple(parts[1::2])
+
+def is_complex(xsd_type) -> bool:
+    return bool(getattr(xsd_type, "elements", None))
+
+
+class ItemTemplate(object):
+    """
+    The XML of a single item of a list parameter. Fields of complex
+    items that are None or skipped are left out, like zeep does.
+    """
+    def __init__(self, element, xml: str):
+        if is_complex(element.type):
+            self.complex = True
+            fields = FIELD_PATTERN.findall(xml)
+            if len(fields) != len(element.type.elements):
+                raise ValueError("Not every field of {} can be templated".format(element.name))
+            self.start = xml[:xml.index(fields[0][0])]
+            self.end = xml[xml.rindex(fields[-1][2]) + len(fields[-1][2]):]
+            xmlvalues = { name: _.type.xmlvalue for name, _ in element.type.elements }
+            self.fields = tuple((name, start, end, xmlvalues[name]) for start, name, end in fields)
+        else:
+            self.complex = False
+            (self.start, self.end), _ = split_placeholders(xml)
+            self.xmlvalue = element.type.xmlvalue
+
+    def render(self, item) -> str:
+        if not self.complex:
+            return self.start + escape_text(self.xmlvalue(item)) + self.end
+        parts = [self.start]
+        for name, start, end, xmlvalue in self.fields:
+            value = item.get(name)
+            if value is None or value is xsd.SkipValue:
+                continue
+            parts.append(start)
+            parts.append(escape_text(xmlvalue(value)))
+            parts.append(end)
+        parts.append(self.end)
+        return "".join(parts)
+
+
+class EnvelopeTemplate(object):
+    """
+    The request envelope of an operation, rendered by zeep once with
+    placeholders for the values that change between calls and split
+    into literal text, so that calls can be rendered without building
+    zeep objects. Parameters whose values can't be replaced by a
+    placeholder (e.g. booleans) are rendered into the template, and a
+    template is compiled for each combination of their values.
+    """
+    def __init__(self, client, operation: str, items: str):
+        self.client = client
+        self.operation = operation
+        self.items = items
+        self.elements = dict(client.service._binding.get(operation).input.body.type.elements)
+        self.placeholders = {
+            name: element.type.xmlvalue for name, element in self.elements.items()
+            if name != items and element.type.xmlvalue(PLACEHOLDER.format(name)) == PLACEHOLDER.format(name)
+        }
+        self._compiled = {}
+
+    def render_message(self, parameters: dict, items: list) -> tuple:
+        envelope, headers = self.client.service._binding._create(
+            self.operation, (), dict(parameters, **{self.items: items}), client=self.client,
+            options=self.client.service._binding_options)
+        return etree_to_string(envelope).decode("utf-8"), headers
+
+    def compile(self, fixed: tuple) -> tuple:
+        """
+        Renders an envelope without items and one with a single item made
+        of placeholders, and splits them into the parts before, within
+        and after the item.
+        """
+        parameters = dict(fixed, **{ _: PLACEHOLDER.format(_) for _ in self.placeholders })
+        element = self.elements[self.items]
+        if is_complex(element.type):
+            item = element.type(**{ _: PLACEHOLDER.format(_) for _, _element in element.type.elements })
+        else:
+            item = PLACEHOLDER.format("item")
+        empty, headers = self.render_message(parameters, [])
+        single, _ = self.render_message(parameters, [item])
+
+        head = commonprefix([empty, single])
+        head = head[:head.rindex(">") + 1]
+        tail = commonprefix([empty[len(head):][::-1], single[len(head):][::-1]])[::-1]
+        tail = tail[tail.index("<"):]
+        return (split_placeholders(head), ItemTemplate(element, single[len(head):len(single) - len(tail)]),
+                split_placeholders(tail), headers)
+
+    def render_part(self, part: tuple, parameters: dict) -> list:
+        literals, names = part
+        rendered = [literals[0]]
+        for name, literal in zip(names, literals[1:]):
+            rendered.append(escape_text(self.placeholders[name](parameters[name])))
+            rendered.append(literal)
+        return rendered
+
+    def render(self, parameters: dict) -> tuple:
+        """
+        Returns the envelope for a call with the given parameters as
+        UTF-8 bytes, along with the HTTP headers to send it with.
+        """
+        fixed = tuple((name, parameters.get(name)) for name in self.elements
+                      if name != self.items and name not in self.placeholders)
+        compiled = self._compiled.get(fixed)
+        if compiled is None:
+            compiled = self._compiled[fixed] = self.compile(fixed)
+        head, item, tail, headers = compiled
+
+        parts = self.render_part(head, parameters)
+        parts.extend(item.render(_) for _ in parameters.get(self.items) or [])
+        parts.extend(self.render_part(tail, parameters))
+        return "".join(parts).encode("utf-8"), headers
+
+
+class TypeParser(object):
+    """
+    Converts elements of a complex type into plain dicts, the same as
+    serialize_object does with the objects zeep parses.
+    """
+    def __init__(self, xsd_type):
+        self.names = []
+        self.lists = set()
+        self.fields = {}
+        for name, element in xsd_type.elements:
+            many = element.max_occurs != 1
+            self.names.append(name)
+            if many:
+                self.lists.add(name)
+            self.fields[str(element.qname)] = (
+                name, many, TypeParser(element.type).parse if is_complex(element.type) else simple_parser(element.type))
+
+    def parse_child(self, result: dict, node):
+        field = self.fields.get(node.tag)
+        if field is None:
+            return
+        name, many, parse = field
+        value = None if node.get(XSI_NIL) == "true" else parse(node)
+        if many:
+            result[name].append(value)
+        else:
+            result[name] = value
+
+    def new(self) -> dict:
+        return { _: [] if _ in self.lists else None for _ in self.names }
+
+    def parse(self, node) -> dict:
+        result = self.new()
+        for child in node:
+            self.parse_child(result, child)
+        return result
+
+def simple_parser(xsd_type):
+    def parse(node):
+        if node.text is None:
+            return None
+        try:
+            return xsd_type.pythonvalue(node.text)
+        except (TypeError, ValueError):
+            return None
+    return parse
+
+
+class ResponseParser(object):
+    """
+    Parses the response of an operation whose body holds a single
+    result element straight into a dict, reading it with iterparse and
+    freeing each child of the result once it's converted. Returns None
+    for faults, which are left to zeep.
+    """
+    def __init__(self, client, operation: str):
+        (_, element), = client.service._binding.get(operation).output.body.type.elements
+        self.tag = str(element.qname)
+        self.parser = TypeParser(element.type)
+
+    def parse(self, content: bytes):
+        result = self.parser.new()
+        tags = [self.tag, SOAP_FAULT] + list(self.parser.fields)
+        for _, node in etree.iterparse(BytesIO(content), events=("end",), tag=tags):
+            if node.tag == SOAP_FAULT:
+                return None
+            parent = node.getparent()
+            if node.tag == self.tag:
+                return result
+            if parent is None or parent.tag != self.tag:
+                continue
+            self.parser.parse_child(result, node)
+            node.clear()
+            parent.remove(node)
+        return None
+
+
+class FastService(object):
+    """
+    Calls createShipment and queryShipment without zeep building or
+    parsing the messages, taking shipments as plain dicts and returning
+    the results as the same dicts serialize_object would. Anything but a
+    successful response is handed to zeep to raise the right error.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.address = client.service._binding_options["address"]
+        self.templates = { _: EnvelopeTemplate(client, _, items) for _, items in FAST_OPERATIONS.items() }
+        self.parsers = { _: ResponseParser(client, _) for _ in FAST_OPERATIONS }
+
+    def bind(self, client):
+        """
+        Returns a copy of the service that makes calls with the transport
+        of the given client, which has to share the WSDL, reusing the
+        compiled templates.
+        """
+        service = copy.copy(self)
+        service.client = client
+        return service
+
+    def process_reply(self, operation: str, response) -> dict:
+        result = None
+        if response.status_code == 200:
+            result = self.parsers[operation].parse(response.content)
+        if result is None:
+            binding = self.client.service._binding
+            return binding.process_reply(self.client, binding.get(operation), response)
+        return result
+
+    def call(self, operation: str, parameters: dict) -> dict:
+        message, headers = self.templates[operation].render(parameters)
+        return self.process_reply(operation, self.client.transport.post(self.address, message, headers))
+
+    def createShipment(self, **parameters) -> dict:
+        return self.call("createShipment", parameters)
+
+    def queryShipment(self, **parameters) -> dict:
+        return self.call("queryShipment", parameters)
+
+
+class AsyncFastService(FastService):
+    """
+    Asynchronous version of FastService.
+    """
+    async def call(self, operation: str, parameters: dict) -> dict:
+        message, headers = self.templates[operation].render(parameters)
+        response = await self.client.transport.post(self.address, message, headers)
+        return self.process_reply(operation, self.client.transport.new_response(response))
+
+    async def createShipment(self, **parameters) -> dict:
+        return await self.call("createShipment", parameters)
+
+    async def queryShipment(self, **parameters) -> dict:
+        return await self.call("queryShipment", parameters)
@@ -0,0 +1,286 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+import uuid
+
+import falcon
+from zeep import xsd
+
+from reference import (JOB_LEASE, JOB_POLL_INTERVAL, JOB_QUEUE_PATH,
+                       JOB_RETENTION)
+from utilities import SHIPMENT_FIELDS, connect_database, credentials_hash
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+logger = logging.getLogger(__name__)
+
+
+def dump_shipment(shipment: dict) -> dict:
+    """
+    Prepares a parsed shipment for storage, leaving out skipped fields.
+    """
+    return { k: v for k, v in shipment.items() if v is not xsd.SkipValue }
+
+def load_shipment(shipment: dict) -> dict:
+    """
+    Restores a stored shipment, skipping the fields that were left out.
+    """
+    loaded = dict.fromkeys(SHIPMENT_FIELDS, xsd.SkipValue)
+    loaded.update(shipment)
+    return loaded
+
+def sent_chunks(job: dict, shipments: list) -> tuple:
+    """
+    Given a claimed job and the shipments to send as (position in the
+    job, parsed shipment) pairs, returns the chunks that were sent
+    already as (shipments, stored result) pairs, and the pairs of the
+    shipments that are left to send.
+    """
+    by_position = dict(shipments)
+    sent = [([by_position.pop(_) for _ in chunk["positions"]], chunk["result"])
+            for chunk in job["chunks"]]
+    return sent, list(by_position.items())
+
+
+class JobRequest(object):
+    """
+    Stands in for the request that created a job when the job is
+    processed, or a subscription when its shipments are polled.
+    """
+    uri_template = "job"
+
+    def __init__(self, job: dict, context: dict):
+        self.context = {
+            "environment": job["environment"],
+            "username": job["username"],
+            "password": job["password"],
+        }
+        self.context.update(context)
+
+
+class JobQueue(object):
+    """
+    A persistent queue of createShipment jobs, kept in a SQLite database
+    that can be shared by the worker processes of a host. Credentials are
+    only kept until the job is processed, after which only their hash is
+    kept to check who can see the result.
+    """
+    PURGE_INTERVAL = 1000
+
+    def __init__(self, path: str):
+        self._connection = connect_database(path)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, status TEXT, environment TEXT, "
+            "owner TEXT, username TEXT, password TEXT, shipments TEXT, http_status TEXT, "
+            "result TEXT, created REAL, updated REAL, chunks TEXT)")
+        columns = [_[1] for _ in self._connection.execute("PRAGMA table_info(jobs)")]
+        if "chunks" not in columns:
+            # queues created before the results of chunks were kept
+            self._connection.execute("ALTER TABLE jobs ADD COLUMN chunks TEXT")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def enqueue(self, environment: str, username: str, password: str, shipments: list) -> str:
+        """
+        Stores a job for the parsed shipments and returns its ID.
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT INTO jobs (id, status, environment, owner, username, password, shipments, "
+                "created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, JOB_QUEUED, environment, credentials_hash(username, password), username,
+                 password, json.dumps([dump_shipment(_) for _ in shipments]), now, now))
+            self._writes += 1
+            if self._writes % self.PURGE_INTERVAL == 0:
+                self._connection.execute("DELETE FROM jobs WHERE status IN (?, ?) AND updated < ?",
+                                         (JOB_DONE, JOB_FAILED, now - JOB_RETENTION))
+        return job_id
+
+    def claim(self):
+        """
+        Marks the oldest queued job as running and returns it as a dict,
+        or returns None if there isn't one. Jobs whose lease wasn't renewed
+        for longer than JOB_LEASE (e.g. by a worker that crashed) are
+        claimed again, along with the results of the chunks already sent.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                "UPDATE jobs SET status = ?, updated = ? WHERE id = ("
+                "SELECT id FROM jobs WHERE status = ? OR (status = ? AND updated < ?) "
+                "ORDER BY created LIMIT 1) "
+                "RETURNING id, environment, username, password, shipments, chunks",
+                (JOB_RUNNING, now, JOB_QUEUED, JOB_RUNNING, now - JOB_LEASE)).fetchone()
+        if row is None:
+            return None
+        return {
+            "job_id": row[0],
+            "environment": row[1],
+            "username": row[2],
+            "password": row[3],
+            "shipments": json.loads(row[4]),
+            "chunks": json.loads(row[5]) if row[5] else [],
+        }
+
+    def save_chunk(self, job_id: str, positions: list, result: dict):
+        """
+        Stores the result of a chunk of a running job, given the positions
+        of its shipments in the job, so that it isn't sent again if the
+        job is claimed again, and renews the lease.
+        """
+        with self._lock:
+            self._connection.execute(
+                "UPDATE jobs SET chunks = json_insert(coalesce(chunks, '[]'), '$[#]', json(?)), "
+                "updated = ? WHERE id = ?",
+                (json.dumps({"positions": positions, "result": result}), time.time(), job_id))
+
+    def finish(self, job_id: str, status: str, http_status: str, result: dict):
+        """
+        Stores the result of a job, dropping its credentials and shipments.
+        """
+        with self._lock:
+            self._connection.execute(
+                "UPDATE jobs SET status = ?, http_status = ?, result = ?, updated = ?, "
+                "username = NULL, password = NULL, shipments = NULL, chunks = NULL WHERE id = ?",
+                (status, http_status, json.dumps(result), time.time(), job_id))
+
+    def abandon(self, job: dict, error: Exception):
+        """
+        Marks a claimed job as failed after processing it raised an error.
+        """
+        self.finish(job["job_id"], JOB_FAILED, falcon.HTTP_500, {"errMessage": repr(error)})
+
+    def get(self, job_id: str, username: str, password: str):
+        """
+        Returns the status of a job as a dict, or None if there isn't a
+        job with the ID that belongs to the credentials.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT status, http_status, result, created, updated FROM jobs "
+                "WHERE id = ? AND owner = ?",
+                (job_id, credentials_hash(username, password))).fetchone()
+        if row is None:
+            return None
+        job = {
+            "job_id": job_id,
+            "status": row[0],
+            "created": row[3],
+            "updated": row[4],
+        }
+        if row[2] is not None:
+            job["http_status"] = row[1]
+            job.update(json.loads(row[2]))
+        return job
+
+
+class JobWorkers(object):
+    """
+    Threads that take jobs off the queue and process them with the given
+    function. Queues shared with other processes are polled. Anything
+    with a `claim` method returning the next job, or None, and an
+    `abandon` method giving up on a job that couldn't be processed, can
+    be used as the queue. Errors are logged and don't stop the workers.
+    """
+    def __init__(self, queue: JobQueue, function, count: int):
+        self.queue = queue
+        self.function = function
+        self.count = count
+        self.wakeup = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts the threads, unless they're already running.
+        """
+        with self._lock:
+            if self._threads:
+                return
+            for number in range(self.count):
+                thread = threading.Thread(target=self._run, name="job-worker-{}".format(number),
+                                          daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def notify(self):
+        self.wakeup.set()
+
+    def _abandon(self, job, error: Exception):
+        logger.exception("Processing a job failed")
+        try:
+            self.queue.abandon(job, error)
+        except Exception:
+            logger.exception("Giving up on a job failed")
+
+    def _run(self):
+        while True:
+            try:
+                job = self.queue.claim()
+            except Exception:
+                logger.exception("Claiming a job failed")
+                job = None
+            if job is None:
+                self.wakeup.wait(JOB_POLL_INTERVAL)
+                self.wakeup.clear()
+                continue
+            try:
+                self.function(job)
+            except Exception as e:
+                self._abandon(job, e)
+
+
+class AsyncJobWorkers(JobWorkers):
+    """
+    Asynchronous version of JobWorkers, running as tasks on the event
+    loop of the app. The queue is used from threads, so that waiting for
+    its database doesn't block the loop.
+    """
+    def start(self):
+        if self._threads:
+            return
+        self.wakeup = asyncio.Event()
+        self._threads = [asyncio.ensure_future(self._run()) for _ in range(self.count)]
+
+    async def stop(self):
+        for task in self._threads:
+            task.cancel()
+        await asyncio.gather(*self._threads, return_exceptions=True)
+        self._threads = []
+
+    async def _abandon(self, job, error: Exception):
+        logger.exception("Processing a job failed")
+        try:
+            await asyncio.to_thread(self.queue.abandon, job, error)
+        except Exception:
+            logger.exception("Giving up on a job failed")
+
+    async def _run(self):
+        while True:
+            try:
+                job = await asyncio.to_thread(self.queue.claim)
+            except Exception:
+                logger.exception("Claiming a job failed")
+                job = None
+            if job is None:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+                continue
+            try:
+                await self.function(job)
+            except Exception as e:
+                await self._abandon(job, e)
+
+
+job_queue = JobQueue(JOB_QUEUE_PATH)
@@ -0,0 +1,234 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from cache import tracking_cache
+from clients import async_schedulers, schedulers
+from reference import METRICS_BUCKETS, SUCCESSFUL
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_labels(labels: dict) -> str:
+    return ",".join('{}="{}"'.format(k, escape_label(v)) for k, v in labels.items())
+
+
+class Histogram(object):
+    """
+    A thread-safe histogram with a fixed set of labels, rendered in the
+    Prometheus text format.
+    """
+    def __init__(self, name: str, description: str, label_names: tuple,
+                 buckets: tuple = METRICS_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(_, "")) for _ in self.label_names)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # bucket counts, then the sum and the count
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> list:
+        lines = [
+            "# HELP {} {}".format(self.name, self.description),
+            "# TYPE {} histogram".format(self.name),
+        ]
+        with self._lock:
+            series = [(key, list(values)) for key, values in self._series.items()]
+        for key, values in series:
+            labels = format_labels(dict(zip(self.label_names, key)))
+            separator = "," if labels else ""
+            for bound, count in zip(self.buckets, values):
+                lines.append('{}_bucket{{{}{}le="{}"}} {}'.format(self.name, labels, separator, bound, count))
+            lines.append('{}_bucket{{{}{}le="+Inf"}} {}'.format(self.name, labels, separator, values[-1]))
+            lines.append("{}_sum{{{}}} {}".format(self.name, labels, values[-2]))
+            lines.append("{}_count{{{}}} {}".format(self.name, labels, values[-1]))
+        return lines
+
+
+REQUEST_DURATION = Histogram(
+    "yk_proxy_request_duration_seconds",
+    "Time spent handling requests, until the responder returns.",
+    ("route", "method", "environment", "status"),
+)
+UPSTREAM_DURATION = Histogram(
+    "yk_proxy_upstream_duration_seconds",
+    "Time spent waiting for Yurtiçi Kargo, by operation and outcome (ok, the errCode, or exception).",
+    ("operation", "environment", "outcome"),
+)
+STAGE_DURATION = Histogram(
+    "yk_proxy_stage_duration_seconds",
+    "Time spent in each stage of request handling within the proxy.",
+    ("stage", "route"),
+)
+
+HISTOGRAMS = (REQUEST_DURATION, UPSTREAM_DURATION, STAGE_DURATION)
+
+
+def record_timing(req, name: str, elapsed: float):
+    """
+    Adds a timing to those reported in the Server-Timing header of the
+    response.
+    """
+    req.context.setdefault("timings", []).append((name, elapsed))
+
+def route_of(req) -> str:
+    return req.uri_template or "unmatched"
+
+def record_stage(req, stage: str, elapsed: float):
+    """
+    Records time spent in a stage of the request.
+    """
+    STAGE_DURATION.observe(elapsed, stage=stage, route=route_of(req))
+    record_timing(req, stage, elapsed)
+
+@contextmanager
+def timed(req, stage: str):
+    """
+    Records the time spent in the block as a stage of the request.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(req, stage, time.perf_counter() - started)
+
+def upstream_outcome(response) -> str:
+    """
+    Returns "ok" for successful responses, or the error code of the
+    response.
+    """
+    if response["outFlag"] == SUCCESSFUL:
+        return "ok"
+    return str(response["errCode"] or "error")
+
+class UpstreamTimer(object):
+    """
+    Records the time spent in the block as a call of an upstream
+    operation. The response is set on the timer to record its outcome.
+    """
+    def __init__(self, req, operation: str):
+        self.req = req
+        self.operation = operation
+        self.response = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.perf_counter() - self.started
+        outcome = "exception" if exc_type is not None else upstream_outcome(self.response)
+        UPSTREAM_DURATION.observe(elapsed, operation=self.operation, outcome=outcome,
+                                  environment=self.req.context["environment"])
+        record_timing(self.req, self.operation, elapsed)
+
+def server_timing(req) -> str:
+    """
+    Builds a Server-Timing header out of the timings of the request,
+    adding up the ones with the same name.
+    """
+    totals = {}
+    for name, elapsed in req.context.get("timings", []):
+        totals[name] = totals.get(name, 0.0) + elapsed
+    return ", ".join("{};dur={:.3f}".format(name, elapsed * 1000) for name, elapsed in totals.items())
+
+def render_breakers() -> list:
+    """
+    Renders the state of the circuit breaker and the retries of each
+    environment.
+    """
+    # imported here, as calls through the breakers are timed with this module
+    from resilience import CircuitBreaker, breakers, retry_budgets
+
+    lines = [
+        "# HELP yk_proxy_circuit_breaker_state Whether the circuit breaker of an environment is in a state.",
+        "# TYPE yk_proxy_circuit_breaker_state gauge",
+    ]
+    for environment, breaker in breakers.items():
+        stats = breaker.stats()
+        for state in (CircuitBreaker.CLOSED, CircuitBreaker.OPEN, CircuitBreaker.HALF_OPEN):
+            lines.append('yk_proxy_circuit_breaker_state{{environment="{}",state="{}"}} {:d}'.format(
+                environment, state, stats["state"] == state))
+    lines.extend([
+        "# HELP yk_proxy_circuit_breaker_failures Consecutive failed upstream calls.",
+        "# TYPE yk_proxy_circuit_breaker_failures gauge",
+    ])
+    lines.extend('yk_proxy_circuit_breaker_failures{{environment="{}"}} {}'.format(
+        environment, breaker.failures) for environment, breaker in breakers.items())
+    lines.extend([
+        "# HELP yk_proxy_circuit_breaker_opened_total Times the circuit breaker opened.",
+        "# TYPE yk_proxy_circuit_breaker_opened_total counter",
+    ])
+    lines.extend('yk_proxy_circuit_breaker_opened_total{{environment="{}"}} {}'.format(
+        environment, breaker.times_opened) for environment, breaker in breakers.items())
+    lines.extend([
+        "# HELP yk_proxy_upstream_retries_total Upstream calls retried.",
+        "# TYPE yk_proxy_upstream_retries_total counter",
+    ])
+    lines.extend('yk_proxy_upstream_retries_total{{environment="{}"}} {}'.format(
+        environment, budget.retries) for environment, budget in retry_budgets.items())
+    return lines
+
+SCHEDULER_GAUGES = (
+    ("in_use", "yk_proxy_upstream_calls_in_flight", "Upstream calls in flight."),
+    ("waiting", "yk_proxy_upstream_calls_waiting", "Upstream calls waiting for the turn of their tenant."),
+    ("tenants", "yk_proxy_upstream_tenants", "Tenants with upstream calls in flight."),
+)
+
+def render_schedulers() -> list:
+    """
+    Renders the upstream calls of each environment in flight and waiting
+    to be scheduled.
+    """
+    stats = {}
+    for environment in schedulers:
+        sync, asynchronous = schedulers[environment].stats(), async_schedulers[environment].stats()
+        stats[environment] = { _: sync[_] + asynchronous[_] for _ in sync }
+    lines = []
+    for key, name, description in SCHEDULER_GAUGES:
+        lines.extend(["# HELP {} {}".format(name, description), "# TYPE {} gauge".format(name)])
+        lines.extend('{}{{environment="{}"}} {}'.format(name, environment, _[key])
+                     for environment, _ in stats.items())
+    return lines
+
+def render_metrics() -> str:
+    """
+    Renders the histograms, the tracking cache counters, the state of
+    the circuit breakers and the scheduled upstream calls in the
+    Prometheus text format.
+    """
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    stats = tracking_cache.stats()
+    lines.extend([
+        "# HELP yk_proxy_tracking_cache_hits_total Tracking cache hits.",
+        "# TYPE yk_proxy_tracking_cache_hits_total counter",
+        "yk_proxy_tracking_cache_hits_total {}".format(stats["hits"]),
+        "# HELP yk_proxy_tracking_cache_misses_total Tracking cache misses.",
+        "# TYPE yk_proxy_tracking_cache_misses_total counter",
+        "yk_proxy_tracking_cache_misses_total {}".format(stats["misses"]),
+        "# HELP yk_proxy_tracking_cache_size Deliveries in the in-process tracking cache.",
+        "# TYPE yk_proxy_tracking_cache_size gauge",
+        "yk_proxy_tracking_cache_size {}".format(stats["size"]),
+        "# HELP yk_proxy_tracking_cache_stale_hits_total Expired deliveries served while the upstream was unavailable.",
+        "# TYPE yk_proxy_tracking_cache_stale_hits_total counter",
+        "yk_proxy_tracking_cache_stale_hits_total {}".format(stats["stale_hits"]),
+    ])
+    lines.extend(render_breakers())
+    lines.extend(render_schedulers())
+    return "\n".join(lines) + "\n"
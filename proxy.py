@@ -1,24 +1,76 @@
 import base64
-import json
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
 
 import falcon
-from zeep import Client, xsd
-from zeep.cache import SqliteCache
 from zeep.helpers import serialize_object
-from zeep.transports import Transport
 
-from reference import (ERRORS_CREATE_SHIPMENT, IDENTIFIER_INVOICE_ID,
-                       IDENTIFIER_SHIPMENT_ID, PROD_WSDL_URL, SUCCESSFUL,
-                       TEST_WSDL_URL)
-from utilities import (extract_credentials, generate_zpl_label,
-                       parameter_as_list, parse_shipment, unpack_phone_numbers)
+from batching import MicroBatcher
+from cache import (SingleFlight, cache_deliveries, cached_credentials,
+                   cached_deliveries, tracking_cache, tracking_prefix,
+                   verification_key, verified_credentials)
+from clients import get_tenant_context
+from jobs import (JOB_DONE, JOB_FAILED, JOB_QUEUED, JobRequest, JobWorkers,
+                  job_queue, load_shipment, sent_chunks)
+from metrics import (REQUEST_DURATION, STAGE_DURATION, record_timing,
+                     render_metrics, route_of, server_timing, timed)
+from reference import (AUTH_FAILURE_CODES, AUTH_PROBE_KEY, AUTH_REJECT_TTL,
+                       AUTH_VERIFY, AUTH_VERIFY_TTL,
+                       CANCEL_SHIPMENT_BATCH_SIZE, CANCEL_SHIPMENT_CONCURRENCY,
+                       CREATE_SHIPMENT_BATCH_SIZE, CREATE_SHIPMENT_CONCURRENCY,
+                       IDENTIFIER_INVOICE_ID, IDENTIFIER_SHIPMENT_ID,
+                       JOB_WORKERS, KEY_NOT_FOUND_CODES, METRICS_CONTENT_TYPE,
+                       METRICS_PATH, NDJSON_CONTENT_TYPE, SERVER_TIMING,
+                       STALE_WARNING, SUBSCRIPTION_BATCH_SIZE,
+                       SUBSCRIPTION_CONCURRENCY, SUBSCRIPTION_WORKERS,
+                       SUCCESSFUL, TRACKING_BATCH_SIZE, TRACKING_BATCH_WINDOW,
+                       ZPL_CONTENT_TYPE)
+from resilience import call_upstream
+from subscriptions import (callback_body, callback_session, group_by_account,
+                           poll_results, retry_results, send_all_changes,
+                           sent_results, subscription_store,
+                           tracked_deliveries)
+from utilities import (ShipmentValidator, as_dict, build_cancellation_response,
+                       build_shipment_response, build_shipments, chunk_results,
+                       chunked, decode_json, describe_failed_shipment,
+                       describe_shipment_failures, encode_json, failed_chunk,
+                       iter_chunked, label_timestamp, merge_query_responses,
+                       ndjson_line, parameter_as_list, parse_cancellation,
+                       parse_query, parse_shipment, parse_subscription,
+                       peek_ndjson, read_lines, read_ndjson, read_shipments,
+                       resolve_invoice_keys, select_batched_deliveries,
+                       select_environment, select_locale, shipment_labels)
 
-transport = Transport(cache=SqliteCache())
+# Identical tracking lookups in flight are coalesced, or batched together
+# if a batching window is set
+tracking_flights = SingleFlight()
+tracking_batcher = MicroBatcher(TRACKING_BATCH_WINDOW, TRACKING_BATCH_SIZE)
 
-test_client = Client(TEST_WSDL_URL, transport=transport)
-test_factory = test_client.type_factory("ns1")
-prod_client = Client(PROD_WSDL_URL, transport=transport)
-prod_factory = prod_client.type_factory("ns0")
+# Concurrent requests with the same unverified credentials share a check
+verification_flights = SingleFlight()
+
+class TimingMiddleware(object):
+    """
+    Records how long requests take, and how much of it is spent in the
+    middleware before the resource is called. Should come first.
+    """
+    def process_request(self, req, resp):
+        req.context["started"] = time.perf_counter()
+
+    def process_resource(self, req, resp, resource, params):
+        elapsed = time.perf_counter() - req.context["started"]
+        STAGE_DURATION.observe(elapsed, stage="middleware", route=route_of(req))
+        record_timing(req, "middleware", elapsed)
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        elapsed = time.perf_counter() - req.context["started"]
+        REQUEST_DURATION.observe(elapsed, route=route_of(req), method=req.method,
+                                 environment=req.context.get("environment", ""),
+                                 status=falcon.http_status_to_code(resp.status))
+        if SERVER_TIMING:
+            record_timing(req, "total", elapsed)
+            resp.set_header("Server-Timing", server_timing(req))
 
 class AuthMiddleware(object):
     """
@@ -26,40 +78,61 @@ class AuthMiddleware(object):
     and makes them available to functions further down the line.
     """
     def process_request(self, req, resp):
+        if req.path == METRICS_PATH:
+            return
         try:
-            parsed_auth = req.auth.split(" ")
-        except AttributeError:
+            req.context["username"], req.context["password"] = cached_credentials(req.auth)
+        except (AttributeError, ValueError):
             raise falcon.HTTPUnauthorized(title="401 Unauthorized",
                                           description="The provided credentials are not valid")
-        else:
-            if len(parsed_auth) == 2 and parsed_auth[0] == "Basic":
-                req.context["username"], req.context["password"] = extract_credentials(parsed_auth[1])
-            else:
-                raise falcon.HTTPUnauthorized(title="401 Unauthorized",
-                                            description="The provided credentials are not valid")
 
 class EnvironmentMiddleware(object):
     """
     Extracts environment information from the request and sets the
-    API endpoint based on it. 
+    API endpoint based on it, using the connections of the tenant whose
+    credentials are used. Clients are created on first use.
     """
     def process_request(self, req, resp):
-        if (req.context["username"] == "YKTEST" 
-                or req.params.get("environment", None) == "test"):
-            req.context["client"] = test_client
-            req.context["factory"] = test_factory
+        if req.path == METRICS_PATH:
+            return
+        req.context["environment"] = select_environment(req)
+        req.context.update(get_tenant_context(req.context["environment"], req.context["username"]))
 
-        else:
-            req.context["client"] = prod_client
-            req.context["factory"] = prod_factory
+class VerificationMiddleware(object):
+    """
+    If verification is enabled, checks credentials with Yurtiçi Kargo
+    the first time they're used in an environment, and rejects the ones
+    it doesn't accept without calling it again until the result expires.
+    Should come after EnvironmentMiddleware.
+    """
+    def process_request(self, req, resp):
+        if not AUTH_VERIFY or req.path == METRICS_PATH:
+            return
+        key = verification_key(req)
+        accepted, _ = verified_credentials.get(key)
+        if accepted is None:
+            accepted = verification_flights.do(key, verify_credentials, req, key)
+        if not accepted:
+            raise falcon.HTTPUnauthorized(title="401 Unauthorized",
+                                          description="The provided credentials were rejected")
 
 class LocaleMiddleware(object):
     """
-    Sets locale for error messages.
+    Sets locale for error messages, from the `locale` parameter or the
+    Accept-Language header.
+    """
+    def process_request(self, req, resp):
+        req.context["locale"] = select_locale(req)
+
+class JobWorkerMiddleware(object):
+    """
+    Starts the workers that process createShipment jobs and poll
+    subscriptions on the first request, as WSGI apps don't have a
+    startup hook.
     """
     def process_request(self, req, resp):
-        # NOT IMPLEMENTED
-        pass
+        job_workers.start()
+        subscription_workers.start()
 
 class FormatMiddleware(object):
     """
@@ -69,138 +142,595 @@ class FormatMiddleware(object):
     def process_request(self, req, resp):
         req.context["formatted"] = req.get_param_as_bool("formatted", default=False)
 
+def run_concurrently(req, function, arguments: list, limit: int) -> list:
+    """
+    Calls the function with each tuple of arguments on the threads of
+    the tenant of the request, with at most `limit` calls in flight at
+    once. Returns the results in order.
+    """
+    in_flight = threading.BoundedSemaphore(limit)
+    futures = []
+    for args in arguments:
+        in_flight.acquire()
+        future = req.context["pool"].executor.submit(function, *args)
+        future.add_done_callback(lambda _: in_flight.release())
+        futures.append(future)
+    return [_.result() for _ in futures]
+
+def stream_concurrently(req, function, arguments, limit: int):
+    """
+    Calls the function with each tuple of arguments on the threads of
+    the tenant of the request, with at most `limit` calls in flight at once. Yields 
+    (arguments, result) pairs as the calls complete. The arguments are
+    only read as calls are made, so they can be a generator.
+    """
+    pending = {}
+    for args in arguments:
+        if len(pending) >= limit:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+        pending[req.context["pool"].executor.submit(function, *args)] = args
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield pending.pop(future), future.result()
+
+def send_chunk(function, req, chunk: list) -> dict:
+    """
+    Calls the function for a chunk of a batch. If the call fails, returns
+    a response rejecting the whole chunk with the error instead, so that
+    the results of the chunks that were sent aren't lost.
+    """
+    try:
+        return function(req, chunk)
+    except Exception as e:
+        return failed_chunk(e)
+
+def create_shipment(req, shipments: list) -> dict:
+    """
+    Calls createShipment with the credentials and client of the request
+    and returns the serialized response.
+    """
+    response = call_upstream(
+        req, "createShipment", req.context["service"].createShipment,
+        wsUserName=req.context["username"],
+        wsPassword=req.context["password"],
+        userLanguage="TR", # Fixed value
+        ShippingOrderVO=shipments,
+    )
+    with timed(req, "serialize"):
+        return as_dict(response)
+
+def cancel_shipment(req, cargo_keys: list) -> dict:
+    """
+    Calls cancelShipment with the credentials and client of the request
+    and returns the serialized response.
+    """
+    response = call_upstream(
+        req, "cancelShipment", req.context["client"].service.cancelShipment,
+        wsUserName=req.context["username"],
+        wsPassword=req.context["password"],
+        userLanguage="TR", # Fixed value
+        cargoKeys=cargo_keys,
+    )
+    with timed(req, "serialize"):
+        return serialize_object(response, target_cls=dict)
+
+def credentials_accepted(response) -> bool:
+    """
+    Returns whether a queryShipment call for the probe key was made with
+    credentials Yurtiçi Kargo accepts. The key not being found doesn't 
+    count as a failure.
+    """
+    return response["outFlag"] == SUCCESSFUL or response["errCode"] in KEY_NOT_FOUND_CODES
+
+def credentials_rejected(response) -> bool:
+    """
+    Returns whether a queryShipment call for the probe key was answered
+    with one of the errors Yurtiçi Kargo rejects credentials with.
+    """
+    return response["errCode"] in AUTH_FAILURE_CODES
+
+def record_verification(key: str, response) -> bool:
+    """
+    Returns whether to let through the credentials the probe was made
+    with, caching the result if the response tells whether Yurtiçi Kargo
+    accepts them. Other errors let them through without caching.
+    """
+    if credentials_accepted(response):
+        accepted = True
+    elif credentials_rejected(response):
+        accepted = False
+    else:
+        return True
+    verified_credentials.set(key, accepted,
+                             time.time() + (AUTH_VERIFY_TTL if accepted else AUTH_REJECT_TTL))
+    return accepted
+
+def verify_credentials(req, key: str) -> bool:
+    """
+    Checks the credentials of the request with a queryShipment call and
+    caches the result. Credentials are let through if the upstream is
+    unavailable, without caching.
+    """
+    try:
+        response = call_upstream(
+            req, "queryShipment", req.context["client"].service.queryShipment,
+            wsUserName=req.context["username"],
+            wsPassword=req.context["password"],
+            wsLanguage="TR", # Fixed value
+            keys=[AUTH_PROBE_KEY],
+            keyType=IDENTIFIER_SHIPMENT_ID,
+            addHistoricalData=False,
+            onlyTracking=True,
+        )
+    except falcon.HTTPServiceUnavailable:
+        return True
+    return record_verification(key, response)
+
+def fetch_deliveries(req, keys: list, key_type: int, add_historical_data: bool,
+                     tracking_url_only: bool, prefix: str) -> dict:
+    """
+    Calls queryShipment with the credentials and client of the request,
+    caching and returning the serialized response.
+    """
+    response = call_upstream(
+        req, "queryShipment", req.context["service"].queryShipment,
+        wsUserName=req.context["username"],
+        wsPassword=req.context["password"],
+        wsLanguage="TR", # Fixed value
+        keys=keys,
+        keyType=key_type,
+        addHistoricalData=add_historical_data,
+        onlyTracking=tracking_url_only,
+    )
+    with timed(req, "serialize"):
+        response = as_dict(response)
+    cache_deliveries(prefix, key_type, response)
+    return response
+
+def query_shipment(req, keys: list, key_type: int, add_historical_data: bool,
+                   tracking_url_only: bool) -> dict:
+    """
+    Calls queryShipment with the credentials and client of the request
+    for the keys that aren't in the tracking cache, and returns the 
+    serialized response merged with the cached deliveries. Identical
+    lookups in flight at the same time share a single upstream call, and
+    with a batching window set, lookups arriving within the window are
+    sent together. If the upstream is unavailable, expired deliveries
+    are served if all of the keys have one.
+    """
+    prefix = tracking_prefix(req, key_type, add_historical_data, tracking_url_only)
+    cached, missing = cached_deliveries(prefix, keys)
+    if not missing:
+        return cached
+
+    try:
+        if TRACKING_BATCH_WINDOW:
+            response = select_batched_deliveries(tracking_batcher.submit(
+                prefix, missing,
+                lambda keys: fetch_deliveries(req, keys, key_type, add_historical_data,
+                                              tracking_url_only, prefix),
+            ), missing, key_type)
+        else:
+            response = tracking_flights.do(prefix + ",".join(missing), fetch_deliveries, req, missing,
+                                           key_type, add_historical_data, tracking_url_only, prefix)
+    except falcon.HTTPServiceUnavailable:
+        response, still_missing = cached_deliveries(prefix, missing, stale=True)
+        if still_missing:
+            raise
+        req.context["stale"] = True
+    return merge_query_responses([response, cached]) if cached else response
+
+def rejected_lines(req, validator: ShipmentValidator):
+    """
+    Yields an NDJSON line for each shipment the validator has rejected
+    since it was last asked.
+    """
+    for shipment in validator.drain():
+        yield ndjson_line("failed", describe_failed_shipment(shipment, req.context["locale"]))
+
+def chunk_lines(req, chunk: list, yk_resp: dict, timestamp: tuple) -> list:
+    """
+    Returns an NDJSON line with the result of each shipment of a chunk.
+    If the results can't be built, each shipment gets a failed line with
+    the error instead, so that none of them is left out of the stream.
+    """
+    try:
+        results = list(chunk_results(chunk, yk_resp, timestamp))
+    except Exception as e:
+        results = list(chunk_results(chunk, failed_chunk(e), timestamp))
+    lines = []
+    for created, shipment in results:
+        shipment["jobId"] = yk_resp["jobId"]
+        if not created:
+            describe_failed_shipment(shipment, req.context["locale"])
+        lines.append(ndjson_line("successful" if created else "failed", shipment))
+    return lines
+
+def accepted_shipments(req, objects, validator: ShipmentValidator, failures: list):
+    """
+    Yields the shipments read from an NDJSON body that the validator
+    accepts. Reading stops if a shipment can't be parsed or the body
+    can't be read, and the error is added to the list of failures.
+    """
+    try:
+        for obj in objects:
+            shipment = req.context["shipment_type"](**parse_shipment(req, obj))
+            if validator.accepts(shipment):
+                yield shipment
+    except Exception as e:
+        failures.append(e)
+
+def unread_lines(errors: list, failures: list):
+    """
+    Yields a failed NDJSON line for each line that wasn't valid JSON, and
+    each error that stopped reading.
+    """
+    for line in errors:
+        yield ndjson_line("failed", {
+            "line": line,
+            "errCode": None,
+            "errMessage": "Invalid JSON",
+        })
+    for error in failures:
+        yield ndjson_line("failed", {
+            "errCode": None,
+            "errMessage": failed_chunk(error)["errMessage"],
+        })
+
+def stream_shipments(req, objects, errors: list):
+    """
+    Sends the shipments read from an NDJSON request body in chunks as
+    they're read, yielding an NDJSON line with the result of each
+    shipment as its chunk completes. Only the chunks in flight are kept
+    in memory.
+    """
+    validator, failures = ShipmentValidator(), []
+    shipments = accepted_shipments(req, objects, validator, failures)
+    calls = ((create_shipment, req, _) for _ in iter_chunked(shipments, CREATE_SHIPMENT_BATCH_SIZE))
+
+    timestamp = label_timestamp()
+    for (_, _, chunk), yk_resp in stream_concurrently(req, send_chunk, calls,
+                                                      CREATE_SHIPMENT_CONCURRENCY):
+        yield from chunk_lines(req, chunk, yk_resp, timestamp)
+        yield from rejected_lines(req, validator)
+    yield from rejected_lines(req, validator)
+
+    # shipments after an invalid line, or one that couldn't be read,
+    # aren't sent
+    yield from unread_lines(errors, failures)
+
+def send_job_chunk(job_id: str, req, chunk: list) -> dict:
+    """
+    Sends a chunk of (position in the job, shipment) pairs and stores its
+    result with the job, renewing the lease of the job.
+    """
+    yk_resp = send_chunk(create_shipment, req, [shipment for _, shipment in chunk])
+    job_queue.save_chunk(job_id, [position for position, _ in chunk], yk_resp)
+    return yk_resp
+
+def process_job(job: dict):
+    """
+    Sends the shipments of a queued job, and stores the response once
+    they're all sent. Chunks sent before the job was claimed again aren't
+    sent twice.
+    """
+    try:
+        req = JobRequest(job, get_tenant_context(job["environment"], job["username"]))
+        validator = ShipmentValidator()
+        shipments = [
+            (position, shipment) for position, shipment in enumerate(
+                req.context["shipment_type"](**load_shipment(_)) for _ in job["shipments"])
+            if validator.accepts(shipment)
+        ]
+
+        sent, shipments = sent_chunks(job, shipments)
+        chunks = chunked(shipments, CREATE_SHIPMENT_BATCH_SIZE)
+        yk_resps = run_concurrently(req, send_job_chunk,
+                                    [(job["job_id"], req, _) for _ in chunks],
+                                    CREATE_SHIPMENT_CONCURRENCY)
+        sent += [([shipment for _, shipment in chunk], yk_resp)
+                 for chunk, yk_resp in zip(chunks, yk_resps)]
+        status, resp_obj = build_shipment_response(sent,
+                                                   rejected=validator.rejected)
+    except falcon.HTTPError as e:
+        job_queue.finish(job["job_id"], JOB_FAILED, e.status, {"errMessage": e.description})
+    except Exception as e:
+        job_queue.finish(job["job_id"], JOB_FAILED, falcon.HTTP_500, {"errMessage": repr(e)})
+    else:
+        job_queue.finish(job["job_id"], JOB_DONE if status == falcon.HTTP_OK else JOB_FAILED,
+                         status, resp_obj)
+
+def poll_subscriptions(shipments: list):
+    """
+    Looks up claimed subscribed shipments in batches, with the
+    credentials they were subscribed with, and sends the ones that have
+    changed to the callbacks of their subscriptions, several at once.
+    Shipments that couldn't be looked up, or whose changes couldn't be
+    sent, are polled again after their interval.
+    """
+    results, callbacks, changes_sent = [], [], []
+    with callback_session() as session:
+        for (environment, username, password), group in group_by_account(shipments).items():
+            try:
+                req = JobRequest({"environment": environment, "username": username, "password": password},
+                                 get_tenant_context(environment, username))
+                keys = list(dict.fromkeys(_["cargo_key"] for _ in group))
+                responses = run_concurrently(req, query_shipment, [
+                    (req, _, IDENTIFIER_SHIPMENT_ID, False, False) for _ in chunked(keys, SUBSCRIPTION_BATCH_SIZE)
+                ], SUBSCRIPTION_CONCURRENCY)
+            except Exception:
+                results.extend(retry_results(group))
+                continue
+
+            changes, unchanged = poll_results(group, tracked_deliveries(responses))
+            results.extend(unchanged)
+            for (subscription_id, callback_url), changed in changes.items():
+                callbacks.append((callback_url, callback_body(subscription_id, environment, changed)))
+                changes_sent.append(changed)
+        accepted = send_all_changes(session, callbacks)
+
+    for changed, sent in zip(changes_sent, accepted):
+        if sent:
+            results.extend(sent_results(changed))
+        else:
+            results.extend(retry_results([shipment for shipment, _ in changed]))
+    subscription_store.update(results)
+
+def enqueue_shipments(req, body) -> dict:
+    """
+    Queues the shipments in the request body as a job, returning the
+    handle of the job.
+    """
+    job_id = job_queue.enqueue(
+        req.context["environment"], req.context["username"], req.context["password"],
+        [parse_shipment(req, _) for _ in parameter_as_list(body)],
+    )
+    return {
+        "job_id": job_id,
+        "status": JOB_QUEUED,
+        "href": "/yk/jobs/{}".format(job_id),
+    }
+
 class Shipment(object):
     """
 
     """
     def on_post(self, req, resp):
         """
-        createShipment
+        createShipment. NDJSON bodies are answered with an NDJSON stream
+        of results.
         """
-        body = json.load(req.bounded_stream)
-        shipments = []
-        resp_obj = {
-            "successful": [],
-            "failed": [],
-        }
-        for shipment in parameter_as_list(body):
-            soap_object = req.context["factory"].ShippingOrderVO(
-                **parse_shipment(req, shipment)
-            )
-            shipments.append(soap_object)
-
-
-        query = req.context["client"].service.createShipment(
-            wsUserName=req.context["username"],
-            wsPassword=req.context["password"],
-            userLanguage="TR", # Fixed value
-            ShippingOrderVO=shipments,
-        )
-        yk_resp = serialize_object(query, target_cls=dict)
-
-        if yk_resp["outFlag"] == "0":
-            shipments_by_key = { _["cargoKey"]: serialize_object(_, target_cls=dict) for _ in shipments }
-            response_by_key = { _["cargoKey"]: _ for _ in yk_resp["shippingOrderDetailVO"] }
-            resp_obj["outFlag"] = str(yk_resp["outFlag"])
-            resp_obj["count"] = yk_resp["count"]
-            resp_obj["jobId"] = yk_resp["jobId"]
-            # strip SkipValues
-            for skey, shipment in shipments_by_key.items():
-                for ikey, ival in shipment.items():
-                    if ival == xsd.SkipValue:
-                        shipments_by_key[skey][ikey] = ""
-
-            for skey, shipment  in response_by_key.items():
-                # if there aren't any errors
-                if shipment["errCode"] is None:
-                    # generate label and add to the main shipment object
-                    shipments_by_key[shipment["cargoKey"]]["label"] = generate_zpl_label(
-                        shipments_by_key[shipment["cargoKey"]], str(yk_resp["jobId"]))
-                    resp_obj["successful"].append(shipments_by_key[shipment["cargoKey"]])
-                else:
-                    # add data from the response object to the main shipment object
-                    shipments_by_key[shipment["cargoKey"]]["errCode"] = shipment["errCode"]
-                    shipments_by_key[shipment["cargoKey"]]["errMessage"] = shipment["errMessage"]
-                    resp_obj["failed"].append(shipments_by_key[shipment["cargoKey"]])
+        if req.content_type and req.content_type.startswith(NDJSON_CONTENT_TYPE):
+            errors = []
+            objects = peek_ndjson(read_ndjson(read_lines(req.bounded_stream), errors), errors)
             resp.status = falcon.HTTP_OK
-            resp.body = json.dumps(resp_obj)
-        elif yk_resp["outFlag"] == "1":
-            resp.status = falcon.HTTP_500
-            resp.body = json.dumps(yk_resp)
+            resp.content_type = NDJSON_CONTENT_TYPE
+            resp.stream = stream_shipments(req, objects, errors)
+            return
+
+        # jobs are sent in the background, and their results are fetched
+        # from the job resource
+        if req.get_param_as_bool("async", default=False):
+            with timed(req, "parse"):
+                job = enqueue_shipments(req, read_shipments(req.bounded_stream.read()))
+            job_workers.notify()
+            resp.status = falcon.HTTP_ACCEPTED
+            resp.location = job["href"]
+            resp.data = encode_json(job)
+            return
+
+        with timed(req, "parse"):
+            validator = ShipmentValidator()
+            shipments = validator.validate(build_shipments(req, read_shipments(req.bounded_stream.read())))
+
+        # large batches are sent as several concurrent calls
+        chunks = chunked(shipments, CREATE_SHIPMENT_BATCH_SIZE)
+        yk_resps = run_concurrently(req, send_chunk, [(create_shipment, req, _) for _ in chunks],
+                                    CREATE_SHIPMENT_CONCURRENCY)
+
+        with timed(req, "labels"):
+            resp.status, resp_obj = build_shipment_response(list(zip(chunks, yk_resps)),
+                                                            req.context["locale"],
+                                                            validator.rejected)
+        with timed(req, "encode"):
+            resp.data = encode_json(resp_obj)
+
+    def on_post_labels(self, req, resp):
+        """
+        createShipment, streaming only the ZPL labels of the shipments
+        that were created as each chunk completes. The response is only
+        started once a label was created: if none is, the errors are
+        answered as they would be without streaming.
+        """
+        with timed(req, "parse"):
+            validator = ShipmentValidator()
+            shipments = validator.validate(
+                build_shipments(req, read_shipments(req.bounded_stream.read())))
+        chunks = chunked(shipments, CREATE_SHIPMENT_BATCH_SIZE)
+
+        timestamp = label_timestamp()
+        calls = [(create_shipment, req, _) for _ in chunks]
+        completed = stream_concurrently(req, send_chunk, calls, CREATE_SHIPMENT_CONCURRENCY)
+        results = []
+        for (_, _, chunk), yk_resp in completed:
+            results.append((chunk, yk_resp))
+            first = list(shipment_labels(chunk, yk_resp, timestamp))
+            if first:
+                break
+        else:
+            resp.status, resp_obj = build_shipment_response(results, req.context["locale"],
+                                                            validator.rejected)
+            resp.data = encode_json(resp_obj)
+            return
+
+        def labels():
+            for label in first:
+                yield label.encode("utf-8")
+            for (_, _, chunk), yk_resp in completed:
+                for label in shipment_labels(chunk, yk_resp, timestamp):
+                    yield label.encode("utf-8")
+
+        resp.status = falcon.HTTP_OK
+        resp.content_type = ZPL_CONTENT_TYPE
+        resp.stream = labels()
 
     def on_get(self, req, resp):
         """
         queryShipment
         """
-        shipment_id = req.get_param_as_list("shipment_id", None)
-        invoice_id = req.get_param_as_list("invoice_id", None)
-        add_historical_data = req.get_param_as_bool("add_historical_data", default=True)
-        tracking_url_only = req.get_param_as_bool("tracking_url_only", default=False)
-
-        response_content = {}
-
-        if not any((shipment_id, invoice_id)):
-            raise falcon.HTTPBadRequest(title="400 Bad Request",
-                                        description="No identifier was provided")
-
-        if shipment_id is not None:
-            query_by_shipment_id = req.context["client"].service.queryShipment(
-                wsUserName=req.context["username"],
-                wsPassword=req.context["password"],
-                wsLanguage="TR", # Fixed value
-                keys=shipment_id,
-                keyType=IDENTIFIER_SHIPMENT_ID,
-                addHistoricalData=add_historical_data,
-                onlyTracking=tracking_url_only,
-            )
-            # Error handling is not implemented yet
-            if query_by_shipment_id.outFlag == SUCCESSFUL:
-                response_content = serialize_object(query_by_shipment_id, target_cls=dict)
-
-        if invoice_id is not None:
-            query_by_invoice_id = req.context["client"].service.queryShipment(
-                wsUserName=req.context["username"],
-                wsPassword=req.context["password"],
-                wsLanguage="TR", # Fixed value
-                keys=invoice_id,
-                keyType=IDENTIFIER_INVOICE_ID,
-                addHistoricalData=add_historical_data,
-                onlyTracking=tracking_url_only,
-            )
-            # Error handling is not implemented yet
-            if query_by_invoice_id.outFlag == SUCCESSFUL:
-                if response_content == {}:
-                    response_content = serialize_object(query_by_invoice_id, target_cls=dict)
-                else:
-                    response_content["count"] += query_by_invoice_id.count
-                    response_content["shippingDeliveryDetailVO"].extend(
-                        serialize_object(query_by_invoice_id, target_cls=dict)["shippingDeliveryDetailVO"])
+        lookups, add_historical_data, tracking_url_only = parse_query(req)
+
+        # lookups are made concurrently
+        futures = [
+            req.context["pool"].executor.submit(query_shipment, req, keys, key_type,
+                                                add_historical_data, tracking_url_only)
+            for keys, key_type in lookups
+        ]
+        responses = [_.result() for _ in futures]
 
         resp.status = falcon.HTTP_OK
-        resp.body = json.dumps(response_content)
+        if req.context.get("stale"):
+            resp.set_header("Warning", STALE_WARNING)
+        with timed(req, "encode"):
+            resp.data = encode_json(merge_query_responses(responses))
 
     def on_delete(self, req, resp):
         """
-        cancelShipment
+        cancelShipment. Shipments can be cancelled by invoice ID, which
+        are looked up first.
         """
-        # NOT IMPLEMENTED
-        pass
+        with timed(req, "parse"):
+            body = req.bounded_stream.read()
+            shipment_ids, invoice_ids = parse_cancellation(req, decode_json(body) if body else None)
+
+        invoice_keys, failures = {}, []
+        if invoice_ids:
+            invoice_keys, failures = resolve_invoice_keys(
+                query_shipment(req, invoice_ids, IDENTIFIER_INVOICE_ID, False, False), invoice_ids)
+        cargo_keys = list(dict.fromkeys(shipment_ids + list(invoice_keys)))
+
+        # large batches are sent as several concurrent calls
+        chunks = chunked(cargo_keys, CANCEL_SHIPMENT_BATCH_SIZE)
+        yk_resps = run_concurrently(req, send_chunk, [(cancel_shipment, req, _) for _ in chunks],
+                                    CANCEL_SHIPMENT_CONCURRENCY)
+
+        resp.status, resp_obj = build_cancellation_response(list(zip(chunks, yk_resps)),
+                                                            invoice_keys, failures,
+                                                            req.context["locale"])
+        with timed(req, "encode"):
+            resp.data = encode_json(resp_obj)
+
+class Job(object):
+    """
+    Reports the status of a createShipment job, along with the same
+    results as a synchronous request once it's done. Errors are described
+    in the locale of this request rather than the one the job was posted
+    with.
+    """
+    def on_get(self, req, resp, job_id):
+        job = job_queue.get(job_id, req.context["username"], req.context["password"])
+        if job is None:
+            raise falcon.HTTPNotFound(title="404 Not Found",
+                                      description="There isn't a job with this ID")
+        if "failed" in job:
+            describe_shipment_failures(job, req.context["locale"])
+        resp.status = falcon.HTTP_OK
+        resp.data = encode_json(job)
+
+class Subscriptions(object):
+    """
+    Subscribes to the tracking status changes of shipments, which are
+    POSTed to a callback URL.
+    """
+    def on_post(self, req, resp):
+        with timed(req, "parse"):
+            cargo_keys, callback_url = parse_subscription(decode_json(req.bounded_stream.read()))
+        subscription_id = subscription_store.subscribe(
+            req.context["environment"], req.context["username"], req.context["password"],
+            callback_url, cargo_keys)
+        subscription_workers.notify()
+        resp.status = falcon.HTTP_CREATED
+        resp.location = "/yk/subscriptions/{}".format(subscription_id)
+        resp.data = encode_json({
+            "subscription_id": subscription_id,
+            "href": resp.location,
+            "count": len(cargo_keys),
+        })
+
+class Subscription(object):
+    """
+    Reports the last known status of the shipments of a subscription,
+    and removes subscriptions.
+    """
+    def on_get(self, req, resp, subscription_id):
+        subscription = subscription_store.get(subscription_id, req.context["username"],
+                                              req.context["password"])
+        if subscription is None:
+            raise falcon.HTTPNotFound(title="404 Not Found",
+                                      description="There isn't a subscription with this ID")
+        resp.status = falcon.HTTP_OK
+        resp.data = encode_json(subscription)
+
+    def on_delete(self, req, resp, subscription_id):
+        if not subscription_store.unsubscribe(subscription_id, req.context["username"],
+                                              req.context["password"]):
+            raise falcon.HTTPNotFound(title="404 Not Found",
+                                      description="There isn't a subscription with this ID")
+        resp.status = falcon.HTTP_NO_CONTENT
+
+class CacheStats(object):
+    """
+    Exposes the hit and miss counters of the tracking cache.
+    """
+    def on_get(self, req, resp):
+        resp.status = falcon.HTTP_OK
+        resp.data = encode_json(tracking_cache.stats())
+
+class Metrics(object):
+    """
+    Serves request timings and cache counters in the Prometheus format.
+    Doesn't require credentials.
+    """
+    def on_get(self, req, resp):
+        resp.status = falcon.HTTP_OK
+        resp.content_type = METRICS_CONTENT_TYPE
+        resp.text = render_metrics()
 
 
 
 
+job_workers = JobWorkers(job_queue, process_job, JOB_WORKERS)
+subscription_workers = JobWorkers(subscription_store, poll_subscriptions, SUBSCRIPTION_WORKERS)
 
 shipment = Shipment()
+job = Job()
+subscriptions = Subscriptions()
+subscription = Subscription()
+cache_stats = CacheStats()
+metrics = Metrics()
 
 app = falcon.API(
     media_type="application/json",
     middleware=[
+        TimingMiddleware(),
         AuthMiddleware(),
         FormatMiddleware(),
+        LocaleMiddleware(),
         EnvironmentMiddleware(),
+        VerificationMiddleware(),
+        JobWorkerMiddleware(),
     ],
 )
 
 app.req_options.auto_parse_form_urlencoded = True
 
 app.add_route("/yk/shipments", shipment)
+app.add_route("/yk/shipments/labels", shipment, suffix="labels")
+app.add_route("/yk/jobs/{job_id}", job)
+app.add_route("/yk/subscriptions", subscriptions)
+app.add_route("/yk/subscriptions/{subscription_id}", subscription)
+app.add_route("/yk/cache", cache_stats)
+app.add_route(METRICS_PATH, metrics)
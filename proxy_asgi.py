@@ -0,0 +1,675 @@
+import asyncio
+
+import falcon
+import falcon.asgi
+from zeep.helpers import serialize_object
+
+from batching import AsyncMicroBatcher
+from cache import (AsyncSingleFlight, cache_deliveries, cached_deliveries,
+                   tracking_cache, tracking_prefix, verification_key,
+                   verified_credentials)
+from clients import close_async_clients, get_async_tenant_context
+from jobs import (AsyncJobWorkers, JOB_DONE, JOB_FAILED, JobRequest, job_queue,
+                  load_shipment, sent_chunks)
+from metrics import render_metrics, timed
+from proxy import (AuthMiddleware, FormatMiddleware, LocaleMiddleware,
+                   TimingMiddleware, chunk_lines, enqueue_shipments,
+                   record_verification, rejected_lines, unread_lines)
+from reference import (AUTH_PROBE_KEY, AUTH_VERIFY, CANCEL_SHIPMENT_BATCH_SIZE,
+                       CANCEL_SHIPMENT_CONCURRENCY, CREATE_SHIPMENT_BATCH_SIZE,
+                       CREATE_SHIPMENT_CONCURRENCY, IDENTIFIER_INVOICE_ID,
+                       IDENTIFIER_SHIPMENT_ID, JOB_WORKERS,
+                       METRICS_CONTENT_TYPE, METRICS_PATH, NDJSON_CONTENT_TYPE,
+                       STALE_WARNING, SUBSCRIPTION_BATCH_SIZE,
+                       SUBSCRIPTION_CALLBACK_CONCURRENCY,
+                       SUBSCRIPTION_CONCURRENCY, SUBSCRIPTION_WORKERS,
+                       TRACKING_BATCH_SIZE, TRACKING_BATCH_WINDOW,
+                       ZPL_CONTENT_TYPE)
+from resilience import async_call_upstream
+from subscriptions import (async_send_changes, callback_body, group_by_account,
+                           poll_results, retry_results, sent_results,
+                           subscription_store, tracked_deliveries)
+from utilities import (ShipmentValidator, as_dict, build_cancellation_response,
+                       build_shipment_response, build_shipments, chunked,
+                       decode_json, describe_shipment_failures, encode_json,
+                       failed_chunk, label_timestamp, merge_query_responses,
+                       no_shipments, parse_cancellation, parse_query,
+                       parse_shipment, parse_subscription, read_shipments,
+                       resolve_invoice_keys, select_batched_deliveries,
+                       select_environment, shipment_labels)
+
+# Identical tracking lookups in flight are coalesced, or batched together
+# if a batching window is set
+tracking_flights = AsyncSingleFlight()
+tracking_batcher = AsyncMicroBatcher(TRACKING_BATCH_WINDOW, TRACKING_BATCH_SIZE)
+
+# Concurrent requests with the same unverified credentials share a check
+verification_flights = AsyncSingleFlight()
+
+class AsyncTimingMiddleware(TimingMiddleware):
+    """
+    Asynchronous version of TimingMiddleware.
+    """
+    async def process_request(self, req, resp):
+        super().process_request(req, resp)
+
+    async def process_resource(self, req, resp, resource, params):
+        super().process_resource(req, resp, resource, params)
+
+    async def process_response(self, req, resp, resource, req_succeeded):
+        super().process_response(req, resp, resource, req_succeeded)
+
+class AsyncAuthMiddleware(AuthMiddleware):
+    """
+    Asynchronous version of AuthMiddleware.
+    """
+    async def process_request(self, req, resp):
+        super().process_request(req, resp)
+
+class AsyncEnvironmentMiddleware(object):
+    """
+    Extracts environment information from the request and sets the
+    asynchronous API client based on it, using the connections of the
+    tenant whose credentials are used. Connection pools are closed on
+    shutdown.
+    """
+    async def process_request(self, req, resp):
+        if req.path == METRICS_PATH:
+            return
+        req.context["environment"] = select_environment(req)
+        req.context.update(
+            get_async_tenant_context(req.context["environment"], req.context["username"]))
+
+    async def process_shutdown(self, scope, event):
+        await close_async_clients()
+
+class AsyncVerificationMiddleware(object):
+    """
+    Asynchronous version of VerificationMiddleware.
+    """
+    async def process_request(self, req, resp):
+        if not AUTH_VERIFY or req.path == METRICS_PATH:
+            return
+        key = verification_key(req)
+        accepted, _ = verified_credentials.get(key)
+        if accepted is None:
+            accepted = await verification_flights.do(key, verify_credentials, req, key)
+        if not accepted:
+            raise falcon.HTTPUnauthorized(title="401 Unauthorized",
+                                          description="The provided credentials were rejected")
+
+class AsyncJobWorkerMiddleware(object):
+    """
+    Starts the workers that process createShipment jobs and poll
+    subscriptions with the app, and stops them on shutdown.
+    """
+    async def process_startup(self, scope, event):
+        job_workers.start()
+        subscription_workers.start()
+
+    async def process_shutdown(self, scope, event):
+        await job_workers.stop()
+        await subscription_workers.stop()
+
+class AsyncFormatMiddleware(FormatMiddleware):
+    """
+    Asynchronous version of FormatMiddleware.
+    """
+    async def process_request(self, req, resp):
+        super().process_request(req, resp)
+
+class AsyncLocaleMiddleware(LocaleMiddleware):
+    """
+    Asynchronous version of LocaleMiddleware.
+    """
+    async def process_request(self, req, resp):
+        super().process_request(req, resp)
+
+async def gather_bounded(coroutines: list, limit: int) -> list:
+    """
+    Awaits the coroutines with at most `limit` of them running at once.
+    Returns the results in order.
+    """
+    in_flight = asyncio.Semaphore(limit)
+
+    async def bounded(coroutine):
+        async with in_flight:
+            return await coroutine
+
+    return await asyncio.gather(*(bounded(_) for _ in coroutines))
+
+async def send_chunk(call) -> dict:
+    """
+    Asynchronous version of proxy.send_chunk, awaiting the call.
+    """
+    try:
+        return await call
+    except Exception as e:
+        return failed_chunk(e)
+
+async def iterate(items):
+    """
+    Iterates over an iterable or an asynchronous iterable.
+    """
+    if hasattr(items, "__aiter__"):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+async def stream_bounded(calls, limit: int):
+    """
+    Runs the coroutines of (key, coroutine) pairs with at most `limit`
+    of them running at once, yielding (key, result) pairs as they
+    complete. The pairs are only read as coroutines are started, so they
+    can come from an asynchronous generator.
+    """
+    pending = {}
+    async for key, coroutine in iterate(calls):
+        if len(pending) >= limit:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield pending.pop(task), task.result()
+        pending[asyncio.ensure_future(coroutine)] = key
+    while pending:
+        done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            yield pending.pop(task), task.result()
+
+async def read_lines(stream):
+    """
+    Yields the lines of a request body as its chunks arrive.
+    """
+    remainder = b""
+    async for data in stream:
+        *lines, remainder = (remainder + data).split(b"\n")
+        for line in lines:
+            yield line
+    if remainder:
+        yield remainder
+
+async def read_ndjson(stream, errors: list):
+    """
+    Asynchronous version of utilities.read_ndjson.
+    """
+    number = 0
+    async for line in read_lines(stream):
+        number += 1
+        if not line.strip():
+            continue
+        try:
+            obj = decode_json(line)
+        except ValueError:
+            obj = None
+        if not isinstance(obj, dict):
+            errors.append(number)
+            return
+        yield obj
+
+async def accepted_shipments(req, objects, validator: ShipmentValidator, failures: list):
+    """
+    Asynchronous version of proxy.accepted_shipments.
+    """
+    try:
+        async for obj in objects:
+            shipment = req.context["shipment_type"](**parse_shipment(req, obj))
+            if validator.accepts(shipment):
+                yield shipment
+    except Exception as e:
+        failures.append(e)
+
+async def peek_ndjson(objects, errors: list):
+    """
+    Asynchronous version of utilities.peek_ndjson.
+    """
+    try:
+        first = await anext(objects)
+    except StopAsyncIteration:
+        raise no_shipments(errors)
+
+    async def chained():
+        yield first
+        async for obj in objects:
+            yield obj
+
+    return chained()
+
+async def iter_chunked(items, size: int):
+    """
+    Asynchronous version of utilities.iter_chunked.
+    """
+    chunk = []
+    async for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+async def create_shipment(req, shipments: list) -> dict:
+    """
+    Asynchronous version of proxy.create_shipment.
+    """
+    response = await async_call_upstream(
+        req, "createShipment", req.context["service"].createShipment,
+        wsUserName=req.context["username"],
+        wsPassword=req.context["password"],
+        userLanguage="TR", # Fixed value
+        ShippingOrderVO=shipments,
+    )
+    with timed(req, "serialize"):
+        return as_dict(response)
+
+async def cancel_shipment(req, cargo_keys: list) -> dict:
+    """
+    Asynchronous version of proxy.cancel_shipment.
+    """
+    response = await async_call_upstream(
+        req, "cancelShipment", req.context["client"].service.cancelShipment,
+        wsUserName=req.context["username"],
+        wsPassword=req.context["password"],
+        userLanguage="TR", # Fixed value
+        cargoKeys=cargo_keys,
+    )
+    with timed(req, "serialize"):
+        return serialize_object(response, target_cls=dict)
+
+async def verify_credentials(req, key: str) -> bool:
+    """
+    Asynchronous version of proxy.verify_credentials.
+    """
+    try:
+        response = await async_call_upstream(
+            req, "queryShipment", req.context["client"].service.queryShipment,
+            wsUserName=req.context["username"],
+            wsPassword=req.context["password"],
+            wsLanguage="TR", # Fixed value
+            keys=[AUTH_PROBE_KEY],
+            keyType=IDENTIFIER_SHIPMENT_ID,
+            addHistoricalData=False,
+            onlyTracking=True,
+        )
+    except falcon.HTTPServiceUnavailable:
+        return True
+    return record_verification(key, response)
+
+async def fetch_deliveries(req, keys: list, key_type: int, add_historical_data: bool,
+                           tracking_url_only: bool, prefix: str) -> dict:
+    """
+    Asynchronous version of proxy.fetch_deliveries.
+    """
+    response = await async_call_upstream(
+        req, "queryShipment", req.context["service"].queryShipment,
+        wsUserName=req.context["username"],
+        wsPassword=req.context["password"],
+        wsLanguage="TR", # Fixed value
+        keys=keys,
+        keyType=key_type,
+        addHistoricalData=add_historical_data,
+        onlyTracking=tracking_url_only,
+    )
+    with timed(req, "serialize"):
+        response = as_dict(response)
+    cache_deliveries(prefix, key_type, response)
+    return response
+
+async def query_shipment(req, keys: list, key_type: int, add_historical_data: bool,
+                         tracking_url_only: bool) -> dict:
+    """
+    Asynchronous version of proxy.query_shipment.
+    """
+    prefix = tracking_prefix(req, key_type, add_historical_data, tracking_url_only)
+    cached, missing = cached_deliveries(prefix, keys)
+    if not missing:
+        return cached
+
+    try:
+        if TRACKING_BATCH_WINDOW:
+            response = select_batched_deliveries(await tracking_batcher.submit(
+                prefix, missing,
+                lambda keys: fetch_deliveries(req, keys, key_type, add_historical_data,
+                                              tracking_url_only, prefix),
+            ), missing, key_type)
+        else:
+            response = await tracking_flights.do(prefix + ",".join(missing), fetch_deliveries, req,
+                                                 missing, key_type, add_historical_data,
+                                                 tracking_url_only, prefix)
+    except falcon.HTTPServiceUnavailable:
+        response, still_missing = cached_deliveries(prefix, missing, stale=True)
+        if still_missing:
+            raise
+        req.context["stale"] = True
+    return merge_query_responses([response, cached]) if cached else response
+
+async def stream_shipments(req, objects, errors: list):
+    """
+    Asynchronous version of proxy.stream_shipments.
+    """
+    validator, failures = ShipmentValidator(), []
+
+    async def calls():
+        shipments = accepted_shipments(req, objects, validator, failures)
+        async for chunk in iter_chunked(shipments, CREATE_SHIPMENT_BATCH_SIZE):
+            yield chunk, send_chunk(create_shipment(req, chunk))
+
+    timestamp = label_timestamp()
+    async for chunk, yk_resp in stream_bounded(calls(), CREATE_SHIPMENT_CONCURRENCY):
+        for line in chunk_lines(req, chunk, yk_resp, timestamp):
+            yield line
+        for line in rejected_lines(req, validator):
+            yield line
+    for line in rejected_lines(req, validator):
+        yield line
+
+    # shipments after an invalid line, or one that couldn't be read,
+    # aren't sent
+    for line in unread_lines(errors, failures):
+        yield line
+
+async def send_job_chunk(job_id: str, req, chunk: list) -> dict:
+    """
+    Asynchronous version of proxy.send_job_chunk.
+    """
+    yk_resp = await send_chunk(create_shipment(req, [shipment for _, shipment in chunk]))
+    await asyncio.to_thread(job_queue.save_chunk, job_id, [position for position, _ in chunk],
+                            yk_resp)
+    return yk_resp
+
+async def process_job(job: dict):
+    """
+    Asynchronous version of proxy.process_job.
+    """
+    try:
+        req = JobRequest(job, get_async_tenant_context(job["environment"], job["username"]))
+        validator = ShipmentValidator()
+        shipments = [
+            (position, shipment) for position, shipment in enumerate(
+                req.context["shipment_type"](**load_shipment(_)) for _ in job["shipments"])
+            if validator.accepts(shipment)
+        ]
+
+        sent, shipments = sent_chunks(job, shipments)
+        chunks = chunked(shipments, CREATE_SHIPMENT_BATCH_SIZE)
+        yk_resps = await gather_bounded([send_job_chunk(job["job_id"], req, _) for _ in chunks],
+                                        CREATE_SHIPMENT_CONCURRENCY)
+        sent += [([shipment for _, shipment in chunk], yk_resp)
+                 for chunk, yk_resp in zip(chunks, yk_resps)]
+        status, resp_obj = build_shipment_response(sent,
+                                                   rejected=validator.rejected)
+    except falcon.HTTPError as e:
+        await asyncio.to_thread(job_queue.finish, job["job_id"], JOB_FAILED, e.status,
+                                {"errMessage": e.description})
+    except Exception as e:
+        await asyncio.to_thread(job_queue.finish, job["job_id"], JOB_FAILED, falcon.HTTP_500,
+                                {"errMessage": repr(e)})
+    else:
+        await asyncio.to_thread(job_queue.finish, job["job_id"],
+                                JOB_DONE if status == falcon.HTTP_OK else JOB_FAILED, status, resp_obj)
+
+async def poll_subscriptions(shipments: list):
+    """
+    Asynchronous version of proxy.poll_subscriptions.
+    """
+    import httpx
+
+    results, callbacks, changes_sent = [], [], []
+    async with httpx.AsyncClient() as client:
+        for (environment, username, password), group in group_by_account(shipments).items():
+            try:
+                req = JobRequest({"environment": environment, "username": username, "password": password},
+                                 get_async_tenant_context(environment, username))
+                keys = list(dict.fromkeys(_["cargo_key"] for _ in group))
+                responses = await gather_bounded([
+                    query_shipment(req, _, IDENTIFIER_SHIPMENT_ID, False, False)
+                    for _ in chunked(keys, SUBSCRIPTION_BATCH_SIZE)
+                ], SUBSCRIPTION_CONCURRENCY)
+            except Exception:
+                results.extend(retry_results(group))
+                continue
+
+            changes, unchanged = poll_results(group, tracked_deliveries(responses))
+            results.extend(unchanged)
+            for (subscription_id, callback_url), changed in changes.items():
+                callbacks.append(async_send_changes(
+                    client, callback_url, callback_body(subscription_id, environment, changed)))
+                changes_sent.append(changed)
+        accepted = await gather_bounded(callbacks, SUBSCRIPTION_CALLBACK_CONCURRENCY)
+
+    for changed, sent in zip(changes_sent, accepted):
+        if sent:
+            results.extend(sent_results(changed))
+        else:
+            results.extend(retry_results([shipment for shipment, _ in changed]))
+    await asyncio.to_thread(subscription_store.update, results)
+
+class AsyncShipment(object):
+    """
+    Asynchronous version of the Shipment resource.
+    """
+    async def on_post(self, req, resp):
+        """
+        createShipment
+        """
+        if req.content_type and req.content_type.startswith(NDJSON_CONTENT_TYPE):
+            errors = []
+            objects = await peek_ndjson(read_ndjson(req.stream, errors), errors)
+            resp.status = falcon.HTTP_OK
+            resp.content_type = NDJSON_CONTENT_TYPE
+            resp.stream = stream_shipments(req, objects, errors)
+            return
+
+        body = await req.stream.read()
+
+        # jobs are sent in the background, and their results are fetched
+        # from the job resource
+        if req.get_param_as_bool("async", default=False):
+            with timed(req, "parse"):
+                job = await asyncio.to_thread(enqueue_shipments, req, read_shipments(body))
+            job_workers.notify()
+            resp.status = falcon.HTTP_ACCEPTED
+            resp.location = job["href"]
+            resp.data = encode_json(job)
+            return
+
+        with timed(req, "parse"):
+            validator = ShipmentValidator()
+            shipments = validator.validate(build_shipments(req, read_shipments(body)))
+
+        # large batches are sent as several concurrent calls
+        chunks = chunked(shipments, CREATE_SHIPMENT_BATCH_SIZE)
+        yk_resps = await gather_bounded([send_chunk(create_shipment(req, _)) for _ in chunks],
+                                        CREATE_SHIPMENT_CONCURRENCY)
+
+        with timed(req, "labels"):
+            resp.status, resp_obj = build_shipment_response(list(zip(chunks, yk_resps)),
+                                                            req.context["locale"],
+                                                            validator.rejected)
+        with timed(req, "encode"):
+            resp.data = encode_json(resp_obj)
+
+    async def on_post_labels(self, req, resp):
+        """
+        createShipment, streaming only the ZPL labels
+        """
+        body = await req.stream.read()
+        with timed(req, "parse"):
+            validator = ShipmentValidator()
+            shipments = validator.validate(build_shipments(req, read_shipments(body)))
+        chunks = chunked(shipments, CREATE_SHIPMENT_BATCH_SIZE)
+
+        timestamp = label_timestamp()
+        calls = ((chunk, send_chunk(create_shipment(req, chunk))) for chunk in chunks)
+        completed = stream_bounded(calls, CREATE_SHIPMENT_CONCURRENCY)
+        results = []
+        async for chunk, yk_resp in completed:
+            results.append((chunk, yk_resp))
+            first = list(shipment_labels(chunk, yk_resp, timestamp))
+            if first:
+                break
+        else:
+            resp.status, resp_obj = build_shipment_response(results, req.context["locale"],
+                                                            validator.rejected)
+            resp.data = encode_json(resp_obj)
+            return
+
+        async def labels():
+            for label in first:
+                yield label.encode("utf-8")
+            async for chunk, yk_resp in completed:
+                for label in shipment_labels(chunk, yk_resp, timestamp):
+                    yield label.encode("utf-8")
+
+        resp.status = falcon.HTTP_OK
+        resp.content_type = ZPL_CONTENT_TYPE
+        resp.stream = labels()
+
+    async def on_get(self, req, resp):
+        """
+        queryShipment
+        """
+        lookups, add_historical_data, tracking_url_only = parse_query(req)
+
+        # lookups are made concurrently
+        responses = await asyncio.gather(*(
+            query_shipment(req, keys, key_type, add_historical_data, tracking_url_only)
+            for keys, key_type in lookups
+        ))
+
+        resp.status = falcon.HTTP_OK
+        if req.context.get("stale"):
+            resp.set_header("Warning", STALE_WARNING)
+        with timed(req, "encode"):
+            resp.data = encode_json(merge_query_responses(responses))
+
+    async def on_delete(self, req, resp):
+        """
+        cancelShipment
+        """
+        body = await req.stream.read()
+        with timed(req, "parse"):
+            shipment_ids, invoice_ids = parse_cancellation(req, decode_json(body) if body else None)
+
+        invoice_keys, failures = {}, []
+        if invoice_ids:
+            invoice_keys, failures = resolve_invoice_keys(
+                await query_shipment(req, invoice_ids, IDENTIFIER_INVOICE_ID, False, False),
+                invoice_ids)
+        cargo_keys = list(dict.fromkeys(shipment_ids + list(invoice_keys)))
+
+        # large batches are sent as several concurrent calls
+        chunks = chunked(cargo_keys, CANCEL_SHIPMENT_BATCH_SIZE)
+        yk_resps = await gather_bounded([send_chunk(cancel_shipment(req, _)) for _ in chunks],
+                                        CANCEL_SHIPMENT_CONCURRENCY)
+
+        resp.status, resp_obj = build_cancellation_response(list(zip(chunks, yk_resps)),
+                                                            invoice_keys, failures,
+                                                            req.context["locale"])
+        with timed(req, "encode"):
+            resp.data = encode_json(resp_obj)
+
+class AsyncJob(object):
+    """
+    Asynchronous version of the Job resource.
+    """
+    async def on_get(self, req, resp, job_id):
+        job = await asyncio.to_thread(job_queue.get, job_id, req.context["username"],
+                                      req.context["password"])
+        if job is None:
+            raise falcon.HTTPNotFound(title="404 Not Found",
+                                      description="There isn't a job with this ID")
+        if "failed" in job:
+            describe_shipment_failures(job, req.context["locale"])
+        resp.status = falcon.HTTP_OK
+        resp.data = encode_json(job)
+
+class AsyncSubscriptions(object):
+    """
+    Asynchronous version of the Subscriptions resource.
+    """
+    async def on_post(self, req, resp):
+        body = await req.stream.read()
+        with timed(req, "parse"):
+            cargo_keys, callback_url = parse_subscription(decode_json(body))
+        subscription_id = await asyncio.to_thread(
+            subscription_store.subscribe,
+            req.context["environment"], req.context["username"], req.context["password"],
+            callback_url, cargo_keys)
+        subscription_workers.notify()
+        resp.status = falcon.HTTP_CREATED
+        resp.location = "/yk/subscriptions/{}".format(subscription_id)
+        resp.data = encode_json({
+            "subscription_id": subscription_id,
+            "href": resp.location,
+            "count": len(cargo_keys),
+        })
+
+class AsyncSubscription(object):
+    """
+    Asynchronous version of the Subscription resource.
+    """
+    async def on_get(self, req, resp, subscription_id):
+        subscription = await asyncio.to_thread(subscription_store.get, subscription_id,
+                                               req.context["username"], req.context["password"])
+        if subscription is None:
+            raise falcon.HTTPNotFound(title="404 Not Found",
+                                      description="There isn't a subscription with this ID")
+        resp.status = falcon.HTTP_OK
+        resp.data = encode_json(subscription)
+
+    async def on_delete(self, req, resp, subscription_id):
+        if not await asyncio.to_thread(subscription_store.unsubscribe, subscription_id,
+                                       req.context["username"], req.context["password"]):
+            raise falcon.HTTPNotFound(title="404 Not Found",
+                                      description="There isn't a subscription with this ID")
+        resp.status = falcon.HTTP_NO_CONTENT
+
+class AsyncCacheStats(object):
+    """
+    Asynchronous version of the CacheStats resource.
+    """
+    async def on_get(self, req, resp):
+        resp.status = falcon.HTTP_OK
+        resp.data = encode_json(tracking_cache.stats())
+
+class AsyncMetrics(object):
+    """
+    Asynchronous version of the Metrics resource.
+    """
+    async def on_get(self, req, resp):
+        resp.status = falcon.HTTP_OK
+        resp.content_type = METRICS_CONTENT_TYPE
+        resp.text = render_metrics()
+
+
+job_workers = AsyncJobWorkers(job_queue, process_job, JOB_WORKERS)
+subscription_workers = AsyncJobWorkers(subscription_store, poll_subscriptions, SUBSCRIPTION_WORKERS)
+
+shipment = AsyncShipment()
+job = AsyncJob()
+subscriptions = AsyncSubscriptions()
+subscription = AsyncSubscription()
+cache_stats = AsyncCacheStats()
+metrics = AsyncMetrics()
+
+app = falcon.asgi.App(
+    media_type="application/json",
+    middleware=[
+        AsyncTimingMiddleware(),
+        AsyncAuthMiddleware(),
+        AsyncFormatMiddleware(),
+        AsyncLocaleMiddleware(),
+        AsyncEnvironmentMiddleware(),
+        AsyncVerificationMiddleware(),
+        AsyncJobWorkerMiddleware(),
+    ],
+)
+
+app.add_route("/yk/shipments", shipment)
+app.add_route("/yk/shipments/labels", shipment, suffix="labels")
+app.add_route("/yk/jobs/{job_id}", job)
+app.add_route("/yk/subscriptions", subscriptions)
+app.add_route("/yk/subscriptions/{subscription_id}", subscription)
+app.add_route("/yk/cache", cache_stats)
+app.add_route(METRICS_PATH, metrics)
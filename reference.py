@@ -1,15 +1,185 @@
+import ipaddress
 import os
 
 import falcon
 
 # WSDL URLs
 # TEST_WSDL_URL = "http://testwebservices.yurticikargo.com:9090/KOPSWebServices/ShippingOrderDispatcherServices?wsdl"
-TEST_WSDL_URL = "https://testwebservices.yurticikargo.com/KOPSWebServices/ShippingOrderDispatcherServices?wsdl"
-PROD_WSDL_URL = "https://ws.yurticikargo.com/KOPSWebServices/ShippingOrderDispatcherServices?wsdl"
+TEST_WSDL_URL = os.getenv("YK_TEST_WSDL_URL", "https://testwebservices.yurticikargo.com/KOPSWebServices/ShippingOrderDispatcherServices?wsdl")
+PROD_WSDL_URL = os.getenv("YK_PROD_WSDL_URL", "https://ws.yurticikargo.com/KOPSWebServices/ShippingOrderDispatcherServices?wsdl")
+
+# Environments
+ENVIRONMENT_TEST = "test"
+ENVIRONMENT_PROD = "prod"
+
+# Local copies of the WSDLs, written by `python clients.py bundle`
+WSDL_BUNDLE_DIR = os.getenv("YK_WSDL_BUNDLE_DIR",
+                            os.path.join(os.path.dirname(os.path.abspath(__file__)), "wsdl"))
+
+# Upstream calls made at once per environment, shared among tenants (the
+# Yurtiçi Kargo accounts of the credentials) in turn. Each tenant has its
+# own pool of at most TENANT_POOL_SIZE connections per environment, and
+# in the WSGI app its own UPSTREAM_THREADS threads to make concurrent
+# calls with. Pools unused for TENANT_IDLE_TIMEOUT seconds are closed, and
+# the least recently used ones once there are TENANT_POOL_LIMIT of them,
+# as long as no request is using them.
+UPSTREAM_POOL_SIZE = int(os.getenv("YK_UPSTREAM_POOL_SIZE", "100"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("YK_UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+UPSTREAM_THREADS = int(os.getenv("YK_UPSTREAM_THREADS", "16"))
+TENANT_POOL_SIZE = int(os.getenv("YK_TENANT_POOL_SIZE", "16"))
+TENANT_IDLE_TIMEOUT = float(os.getenv("YK_TENANT_IDLE_TIMEOUT", "300"))
+TENANT_POOL_LIMIT = int(os.getenv("YK_TENANT_POOL_LIMIT", "32"))
+
+# With FAST_SOAP set, createShipment and queryShipment envelopes are
+# rendered from templates and their responses parsed straight into dicts,
+# instead of going through zeep objects
+FAST_SOAP = os.getenv("YK_FAST_SOAP", "0").lower() in ("1", "true", "yes")
+
+# Connect timeout of upstream calls, and read timeouts per operation
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("YK_UPSTREAM_CONNECT_TIMEOUT", "3"))
+UPSTREAM_READ_TIMEOUTS = {
+    "createShipment": float(os.getenv("YK_CREATE_SHIPMENT_READ_TIMEOUT", "30")),
+    "queryShipment": float(os.getenv("YK_QUERY_SHIPMENT_READ_TIMEOUT", "10")),
+    "cancelShipment": float(os.getenv("YK_CANCEL_SHIPMENT_READ_TIMEOUT", "15")),
+}
+
+# Failed calls of operations that are safe to repeat are retried, after
+# a random delay of up to UPSTREAM_RETRY_BACKOFF seconds doubled on each
+# attempt. Retries are limited to UPSTREAM_RETRY_BUDGET_RATIO of the calls
+# made, with UPSTREAM_RETRY_BUDGET_MINIMUM saved up for quiet periods.
+IDEMPOTENT_OPERATIONS = ("queryShipment",)
+UPSTREAM_RETRIES = int(os.getenv("YK_UPSTREAM_RETRIES", "2"))
+UPSTREAM_RETRY_BACKOFF = float(os.getenv("YK_UPSTREAM_RETRY_BACKOFF", "0.2"))
+UPSTREAM_RETRY_BACKOFF_MAX = float(os.getenv("YK_UPSTREAM_RETRY_BACKOFF_MAX", "2"))
+UPSTREAM_RETRY_BUDGET_RATIO = float(os.getenv("YK_UPSTREAM_RETRY_BUDGET_RATIO", "0.1"))
+UPSTREAM_RETRY_BUDGET_MINIMUM = float(os.getenv("YK_UPSTREAM_RETRY_BUDGET_MINIMUM", "10"))
+
+# After this many consecutive failed calls to an environment, calls to it
+# fail fast for BREAKER_RESET_TIMEOUT seconds, after which a single call
+# is let through to probe it
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("YK_BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("YK_BREAKER_RESET_TIMEOUT", "30"))
+
+# createShipment batches are split into chunks of this size, of which at
+# most CREATE_SHIPMENT_CONCURRENCY are sent at once for each request
+CREATE_SHIPMENT_BATCH_SIZE = int(os.getenv("YK_CREATE_SHIPMENT_BATCH_SIZE", "100"))
+CREATE_SHIPMENT_CONCURRENCY = int(os.getenv("YK_CREATE_SHIPMENT_CONCURRENCY", "4"))
+
+# cancelShipment keys are sent in chunks of this size, of which at most
+# CANCEL_SHIPMENT_CONCURRENCY are sent at once for each request
+CANCEL_SHIPMENT_BATCH_SIZE = int(os.getenv("YK_CANCEL_SHIPMENT_BATCH_SIZE", "100"))
+CANCEL_SHIPMENT_CONCURRENCY = int(os.getenv("YK_CANCEL_SHIPMENT_CONCURRENCY", "4"))
+
+# queryShipment responses are cached per key, for longer once a shipment
+# has reached a final status. The backend, if set, is the path of a
+# SQLite database shared by the workers of a host.
+TRACKING_CACHE_SIZE = int(os.getenv("YK_TRACKING_CACHE_SIZE", "10000"))
+TRACKING_CACHE_BACKEND = os.getenv("YK_TRACKING_CACHE_BACKEND", "")
+TRACKING_CACHE_TTL_FINAL = float(os.getenv("YK_TRACKING_CACHE_TTL_FINAL", "86400"))
+TRACKING_CACHE_TTL_IN_TRANSIT = float(os.getenv("YK_TRACKING_CACHE_TTL_IN_TRANSIT", "300"))
+# Expired deliveries are kept this long, to be served while the
+# upstream is unavailable
+TRACKING_CACHE_STALE_TTL = float(os.getenv("YK_TRACKING_CACHE_STALE_TTL", "86400"))
+STALE_WARNING = '110 - "Response is Stale"'
+# Delivered and cancelled. No statuses are assumed final for returns,
+# so a shipment being returned is cached for the in-transit TTL and
+# polled by subscriptions until it reaches one of these; add the return
+# statuses your account gets to cache and stop polling them sooner.
+FINAL_OPERATION_STATUSES = tuple(os.getenv("YK_FINAL_OPERATION_STATUSES", "DLV,CNL").split(","))
+
+# When the window is set (in seconds), tracking lookups with the same
+# credentials, environment and flags that arrive within it are sent as a
+# single queryShipment call of at most TRACKING_BATCH_SIZE keys
+TRACKING_BATCH_WINDOW = float(os.getenv("YK_TRACKING_BATCH_WINDOW", "0"))
+TRACKING_BATCH_SIZE = int(os.getenv("YK_TRACKING_BATCH_SIZE", "100"))
+
+# Decoded Authorization headers are cached, keyed by their hash. If
+# AUTH_VERIFY is set, credentials are checked with a queryShipment call
+# the first time they're used in an environment, and rejected locally
+# for AUTH_REJECT_TTL seconds if Yurtiçi Kargo rejects them with one of
+# AUTH_FAILURE_CODES. Other errors don't tell whether the credentials are
+# valid, so they're let through and checked again on the next request.
+AUTH_CACHE_SIZE = int(os.getenv("YK_AUTH_CACHE_SIZE", "10000"))
+AUTH_VERIFY = os.getenv("YK_AUTH_VERIFY", "0").lower() in ("1", "true", "yes")
+AUTH_VERIFY_TTL = float(os.getenv("YK_AUTH_VERIFY_TTL", "3600"))
+AUTH_REJECT_TTL = float(os.getenv("YK_AUTH_REJECT_TTL", "300"))
+AUTH_PROBE_KEY = os.getenv("YK_AUTH_PROBE_KEY", "YKPROXYPROBE")
+AUTH_FAILURE_CODES = tuple(int(_) for _ in os.getenv("YK_AUTH_FAILURE_CODES", "").split(",") if _.strip())
+
+# Jobs and subscriptions are kept in SQLite databases in DATA_DIR, which
+# should be set to a persistent directory the proxy can write to, shared
+# by the worker processes of a host. It defaults to yk-proxy in the data
+# directory of the user, and is created if it doesn't exist.
+DATA_DIR = os.getenv("YK_DATA_DIR", os.path.join(
+    os.getenv("XDG_DATA_HOME") or os.path.join(os.path.expanduser("~"), ".local", "share"), "yk-proxy"))
+
+# createShipment jobs posted with ?async=true are kept in a SQLite
+# database, which the worker processes of a host can share, and sent by
+# JOB_WORKERS workers per process. The lease of a running job is renewed
+# whenever one of its chunks is sent, and jobs whose lease wasn't renewed
+# for JOB_LEASE seconds are picked up again, without sending the chunks
+# that were sent already. Finished jobs are kept for JOB_RETENTION seconds.
+JOB_QUEUE_PATH = os.getenv("YK_JOB_QUEUE_PATH", os.path.join(DATA_DIR, "jobs.sqlite3"))
+JOB_WORKERS = int(os.getenv("YK_JOB_WORKERS", "2"))
+JOB_POLL_INTERVAL = float(os.getenv("YK_JOB_POLL_INTERVAL", "1"))
+JOB_LEASE = float(os.getenv("YK_JOB_LEASE", "600"))
+JOB_RETENTION = float(os.getenv("YK_JOB_RETENTION", "604800"))
+
+# Tracking subscriptions are kept in a SQLite database, which the worker
+# processes of a host can share, and polled by SUBSCRIPTION_WORKERS
+# workers per process. Workers claim up to SUBSCRIPTION_CLAIM_SIZE due
+# shipments at a time (claimed again if they aren't polled within
+# SUBSCRIPTION_LEASE seconds) and look them up in calls of up to
+# SUBSCRIPTION_BATCH_SIZE keys, SUBSCRIPTION_CONCURRENCY at once. A
+# shipment is polled again after SUBSCRIPTION_INTERVAL seconds once it
+# has changed, doubling up to SUBSCRIPTION_INTERVAL_MAX while it doesn't,
+# and isn't polled once it has reached a final status. Changes are
+# POSTed to the callback URL with a timeout of
+# SUBSCRIPTION_CALLBACK_TIMEOUT seconds, to at most
+# SUBSCRIPTION_CALLBACK_CONCURRENCY callbacks at once. Callbacks can only
+# be sent to public addresses, or those in SUBSCRIPTION_CALLBACK_NETWORKS
+# (e.g. "10.0.0.0/8,fd00::/8").
+SUBSCRIPTION_DB_PATH = os.getenv("YK_SUBSCRIPTION_DB_PATH", os.path.join(DATA_DIR, "subscriptions.sqlite3"))
+SUBSCRIPTION_WORKERS = int(os.getenv("YK_SUBSCRIPTION_WORKERS", "1"))
+SUBSCRIPTION_CLAIM_SIZE = int(os.getenv("YK_SUBSCRIPTION_CLAIM_SIZE", "1000"))
+SUBSCRIPTION_BATCH_SIZE = int(os.getenv("YK_SUBSCRIPTION_BATCH_SIZE", "100"))
+SUBSCRIPTION_CONCURRENCY = int(os.getenv("YK_SUBSCRIPTION_CONCURRENCY", "2"))
+SUBSCRIPTION_INTERVAL = float(os.getenv("YK_SUBSCRIPTION_INTERVAL", "300"))
+SUBSCRIPTION_INTERVAL_MAX = float(os.getenv("YK_SUBSCRIPTION_INTERVAL_MAX", "3600"))
+SUBSCRIPTION_LEASE = float(os.getenv("YK_SUBSCRIPTION_LEASE", "600"))
+SUBSCRIPTION_CALLBACK_TIMEOUT = float(os.getenv("YK_SUBSCRIPTION_CALLBACK_TIMEOUT", "10"))
+SUBSCRIPTION_CALLBACK_CONCURRENCY = int(os.getenv("YK_SUBSCRIPTION_CALLBACK_CONCURRENCY", "10"))
+SUBSCRIPTION_CALLBACK_NETWORKS = tuple(ipaddress.ip_network(_) for _ in os.getenv(
+    "YK_SUBSCRIPTION_CALLBACK_NETWORKS", "").split(",") if _)
+
+# Request timings are served on METRICS_PATH in the Prometheus format,
+# and sent in a Server-Timing header of each response if SERVER_TIMING
+# is set
+METRICS_PATH = os.getenv("YK_METRICS_PATH", "/metrics")
+METRICS_BUCKETS = tuple(float(_) for _ in os.getenv(
+    "YK_METRICS_BUCKETS", "0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30").split(","))
+SERVER_TIMING = os.getenv("YK_SERVER_TIMING", "0").lower() in ("1", "true", "yes")
+
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+ZPL_CONTENT_TYPE = "application/zpl"
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
 
 SENDER_NAME = os.getenv("YK_SENDER_NAME", "")
 SENDER_TELEPHONE = os.getenv("YK_SENDER_TELEPHONE", "")
 
+# Shipments are checked before they're sent, and the ones Yurtiçi Kargo
+# would reject are rejected locally with the same error codes. Shipment
+# and invoice IDs can be at most this long.
+CARGO_KEY_MAX_LENGTH = int(os.getenv("YK_CARGO_KEY_MAX_LENGTH", "20"))
+INVOICE_KEY_MAX_LENGTH = int(os.getenv("YK_INVOICE_KEY_MAX_LENGTH", "20"))
+
+# Errors are described in the locale of the `locale` parameter, or else
+# the one the Accept-Language header prefers, falling back to
+# DEFAULT_LOCALE. Locales are in the order of the messages of the error
+# tables below.
+LOCALES = ("en", "tr")
+DEFAULT_LOCALE = os.getenv("YK_DEFAULT_LOCALE", "en")
+
 # Error messages for the shipment creation endpoint
 ERRORS_CREATE_SHIPMENT = {
     936: (
@@ -113,6 +283,7 @@ ERRORS_CREATE_SHIPMENT = {
         "Hatalı ödeme tipi",
     ),
     82514: (
+        falcon.HTTP_NOT_ACCEPTABLE,
         "COD - Invalid invoice preference",
         "Hatalı fatura tipi",
     ),
@@ -138,9 +309,30 @@ ERRORS_CREATE_SHIPMENT = {
     ),
 }
 
+# Error messages for the shipment cancellation endpoint
+ERRORS_CANCEL_SHIPMENT = {
+    code: ERRORS_CREATE_SHIPMENT[code] for code in (936, 80859, 60017, 82500, 82501)
+}
+
+# The error tables above as (status, description) pairs keyed by (code,
+# locale), so that errors are described without going through the tables
+ERROR_DESCRIPTIONS_CREATE_SHIPMENT = {
+    (code, locale): (status, messages[index])
+    for code, (status, *messages) in ERRORS_CREATE_SHIPMENT.items()
+    for index, locale in enumerate(LOCALES)
+}
+ERROR_DESCRIPTIONS_CANCEL_SHIPMENT = {
+    (code, locale): (status, messages[index])
+    for code, (status, *messages) in ERRORS_CANCEL_SHIPMENT.items()
+    for index, locale in enumerate(LOCALES)
+}
+
 IDENTIFIER_SHIPMENT_ID = 0
 IDENTIFIER_INVOICE_ID = 1
 
+# Errors of lookups for keys that don't exist
+KEY_NOT_FOUND_CODES = (80859, 60017)
+
 COD_PAYMENT_METHOD_CASH = 0
 COD_PAYMENT_METHOD_CREDIT_CARD = 1
 
@@ -0,0 +1,281 @@
+import asyncio
+import random
+import threading
+import time
+
+import falcon
+import requests
+from zeep.exceptions import Fault, TransportError
+
+from clients import operation_timeout
+from metrics import UpstreamTimer, record_stage, timed
+from reference import (BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT,
+                       ENVIRONMENT_PROD, ENVIRONMENT_TEST,
+                       IDEMPOTENT_OPERATIONS, UPSTREAM_CONNECT_TIMEOUT,
+                       UPSTREAM_READ_TIMEOUTS, UPSTREAM_RETRIES,
+                       UPSTREAM_RETRY_BACKOFF, UPSTREAM_RETRY_BACKOFF_MAX,
+                       UPSTREAM_RETRY_BUDGET_MINIMUM,
+                       UPSTREAM_RETRY_BUDGET_RATIO)
+
+# httpx is only used by the ASGI app
+try:
+    import httpx
+    ASYNC_TRANSPORT_ERRORS = (httpx.TransportError,)
+    ASYNC_READ_TIMEOUTS = (httpx.ReadTimeout,)
+except ImportError:
+    ASYNC_TRANSPORT_ERRORS = ASYNC_READ_TIMEOUTS = ()
+
+
+class CircuitBreaker(object):
+    """
+    Stops calls to an upstream that keeps failing. After
+    `failure_threshold` consecutive failures the breaker opens and calls
+    fail fast. Once `reset_timeout` seconds have passed, a single call is
+    let through (and another one every `reset_timeout` seconds until one
+    completes): the breaker closes if it succeeds, and opens again if it
+    fails.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.times_opened = 0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """
+        Returns whether a call can be made now.
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.monotonic()
+            if now - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.opened_at = now
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (
+                    self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.times_opened += 1
+
+    def retry_after(self) -> int:
+        """
+        Returns the number of seconds until the breaker lets a call
+        through again.
+        """
+        if self.opened_at is None:
+            return 0
+        return max(0, int(self.reset_timeout - (time.monotonic() - self.opened_at)) + 1)
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "times_opened": self.times_opened,
+        }
+
+
+class RetryBudget(object):
+    """
+    Limits retries to a fraction of the calls made, so that retrying
+    doesn't multiply the load on an upstream that is already
+    struggling. Each call adds `ratio` of a retry, up to `maximum`.
+    """
+    def __init__(self, ratio: float, maximum: float):
+        self.ratio = ratio
+        self.maximum = maximum
+        self.tokens = maximum
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.maximum, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        """
+        Takes a retry from the budget, returning False if there isn't
+        one left.
+        """
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            self.retries += 1
+            return True
+
+
+breakers = {
+    environment: CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+    for environment in (ENVIRONMENT_TEST, ENVIRONMENT_PROD)
+}
+retry_budgets = {
+    environment: RetryBudget(UPSTREAM_RETRY_BUDGET_RATIO, UPSTREAM_RETRY_BUDGET_MINIMUM)
+    for environment in (ENVIRONMENT_TEST, ENVIRONMENT_PROD)
+}
+
+
+def is_upstream_failure(exception: Exception) -> bool:
+    """
+    Returns whether an exception raised by a call means the upstream
+    failed: the connection failed or timed out, or it answered with a 5xx
+    status without a SOAP fault. Faults are answers to the request, which
+    a single tenant can cause, so they don't count, and neither do
+    invalid requests.
+    """
+    if isinstance(exception, TransportError):
+        return exception.status_code >= 500
+    return isinstance(exception, (requests.ConnectionError, requests.Timeout) + ASYNC_TRANSPORT_ERRORS)
+
+def is_outcome_unknown(exception: Exception) -> bool:
+    """
+    Returns whether a call that raised an exception may still have been
+    carried out: the request was sent, but the answer didn't arrive in
+    time.
+    """
+    return isinstance(exception, (requests.ReadTimeout,) + ASYNC_READ_TIMEOUTS)
+
+def backoff(attempt: int) -> float:
+    """
+    Returns a random delay before the given retry.
+    """
+    return random.uniform(0, min(UPSTREAM_RETRY_BACKOFF_MAX, UPSTREAM_RETRY_BACKOFF * 2 ** attempt))
+
+def unavailable(environment: str, breaker: CircuitBreaker, exception=None):
+    """
+    Returns the error raised when a call can't be made or has failed.
+    """
+    if exception is None:
+        description = "Yurtiçi Kargo ({}) is unavailable, calls to it are paused".format(environment)
+    else:
+        description = "Yurtiçi Kargo ({}) failed to respond: {}".format(
+            environment, type(exception).__name__)
+    return falcon.HTTPServiceUnavailable(
+        title="503 Service Unavailable",
+        description=description,
+        retry_after=breaker.retry_after() or None,
+    )
+
+def outcome_unknown(environment: str, exception: Exception):
+    """
+    Returns the error raised when a call that isn't safe to repeat may
+    have been carried out without an answer.
+    """
+    return falcon.HTTPGatewayTimeout(
+        title="504 Gateway Timeout",
+        description="Yurtiçi Kargo ({}) didn't answer in time ({}), it isn't known whether "
+                    "the call was carried out".format(environment, type(exception).__name__),
+    )
+
+def fault(environment: str, exception: Fault):
+    """
+    Returns the error raised when a call is answered with a SOAP fault.
+    """
+    return falcon.HTTPBadGateway(
+        title="502 Bad Gateway",
+        description="Yurtiçi Kargo ({}) answered with a fault: {}".format(environment, exception.message),
+    )
+
+def call_upstream(req, operation: str, function, **kwargs):
+    """
+    Calls an upstream operation through the circuit breaker of the
+    environment, with the timeouts of the operation, once it's the turn
+    of the tenant. Operations that are safe to repeat are retried within
+    the retry budget. Raises 503 if the call can't be made or fails, 504
+    if a call to any other operation times out waiting for the answer, as
+    it may have been carried out, and 502 if it's answered with a SOAP
+    fault. Only the calls themselves are timed as upstream calls; waiting
+    for the turn of the tenant and between retries are recorded as
+    stages of the request.
+    """
+    environment = req.context["environment"]
+    breaker, budget = breakers[environment], retry_budgets[environment]
+    retries = UPSTREAM_RETRIES if operation in IDEMPOTENT_OPERATIONS else 0
+    token = operation_timeout.set((UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUTS[operation]))
+    try:
+        budget.deposit()
+        for attempt in range(retries + 1):
+            if not breaker.allow():
+                raise unavailable(environment, breaker)
+            try:
+                waiting = time.perf_counter()
+                with req.context["pool"].slot():
+                    record_stage(req, "upstream_wait", time.perf_counter() - waiting)
+                    with UpstreamTimer(req, operation) as timer:
+                        response = timer.response = function(**kwargs)
+            except Fault as e:
+                # the upstream answered, so it isn't failing
+                breaker.record_success()
+                raise fault(environment, e) from e
+            except Exception as e:
+                if not is_upstream_failure(e):
+                    raise
+                breaker.record_failure()
+                if operation not in IDEMPOTENT_OPERATIONS and is_outcome_unknown(e):
+                    raise outcome_unknown(environment, e) from e
+                if attempt == retries or not budget.withdraw():
+                    raise unavailable(environment, breaker, e) from e
+                with timed(req, "retry_backoff"):
+                    time.sleep(backoff(attempt))
+            else:
+                breaker.record_success()
+                return response
+    finally:
+        operation_timeout.reset(token)
+
+async def async_call_upstream(req, operation: str, function, **kwargs):
+    """
+    Asynchronous version of call_upstream.
+    """
+    environment = req.context["environment"]
+    breaker, budget = breakers[environment], retry_budgets[environment]
+    retries = UPSTREAM_RETRIES if operation in IDEMPOTENT_OPERATIONS else 0
+    token = operation_timeout.set((UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUTS[operation]))
+    try:
+        budget.deposit()
+        for attempt in range(retries + 1):
+            if not breaker.allow():
+                raise unavailable(environment, breaker)
+            try:
+                waiting = time.perf_counter()
+                async with req.context["pool"].slot():
+                    record_stage(req, "upstream_wait", time.perf_counter() - waiting)
+                    with UpstreamTimer(req, operation) as timer:
+                        response = timer.response = await function(**kwargs)
+            except Fault as e:
+                # the upstream answered, so it isn't failing
+                breaker.record_success()
+                raise fault(environment, e) from e
+            except Exception as e:
+                if not is_upstream_failure(e):
+                    raise
+                breaker.record_failure()
+                if operation not in IDEMPOTENT_OPERATIONS and is_outcome_unknown(e):
+                    raise outcome_unknown(environment, e) from e
+                if attempt == retries or not budget.withdraw():
+                    raise unavailable(environment, breaker, e) from e
+                with timed(req, "retry_backoff"):
+                    await asyncio.sleep(backoff(attempt))
+            else:
+                breaker.record_success()
+                return response
+    finally:
+        operation_timeout.reset(token)
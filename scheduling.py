@@ -0,0 +1,122 @@
+import asyncio
+import threading
+from collections import OrderedDict, deque
+
+
+class FairScheduler(object):
+    """
+    Shares `slots` concurrent upstream calls among tenants, each of
+    which can hold at most `tenant_slots` of them. When a slot frees up
+    it goes to the next tenant in line with a call waiting, and that
+    tenant moves to the back of the line, so a tenant with many calls
+    queued waits behind one call of every other tenant rather than
+    ahead of all of them.
+    """
+    def __init__(self, slots: int, tenant_slots: int):
+        self.slots = slots
+        self.tenant_slots = tenant_slots
+        self.in_use = 0
+        self.active = {}
+        self.waiting = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _take(self, tenant: str):
+        self.in_use += 1
+        self.active[tenant] = self.active.get(tenant, 0) + 1
+
+    def _can_take(self, tenant: str) -> bool:
+        return self.in_use < self.slots and self.active.get(tenant, 0) < self.tenant_slots
+
+    def _give(self, tenant: str):
+        self.active[tenant] -= 1
+        if not self.active[tenant]:
+            del self.active[tenant]
+        self.in_use -= 1
+
+    def _next_waiter(self):
+        """
+        Takes a slot for the first tenant in line that can have one and
+        returns its oldest waiter, or returns None if there isn't one.
+        """
+        for tenant, waiters in self.waiting.items():
+            if self._can_take(tenant):
+                break
+        else:
+            return None
+        waiter = waiters.popleft()
+        del self.waiting[tenant]
+        if waiters:
+            self.waiting[tenant] = waiters
+        self._take(tenant)
+        return tenant, waiter
+
+    def _enqueue(self, tenant: str, waiter) -> bool:
+        """
+        Takes a slot for the tenant if it can have one now, and queues
+        the waiter otherwise. Returns whether the slot was taken.
+        """
+        if tenant not in self.waiting and self._can_take(tenant):
+            self._take(tenant)
+            return True
+        self.waiting.setdefault(tenant, deque()).append(waiter)
+        return False
+
+    def acquire(self, tenant: str):
+        waiter = threading.Event()
+        with self._lock:
+            if self._enqueue(tenant, waiter):
+                return
+        waiter.wait()
+
+    def release(self, tenant: str):
+        with self._lock:
+            self._give(tenant)
+            next_waiter = self._next_waiter()
+            if next_waiter is not None:
+                self._wake(*next_waiter)
+
+    def _wake(self, tenant: str, waiter):
+        waiter.set()
+
+    def busy(self, tenant: str) -> bool:
+        """
+        Returns whether the tenant has calls in flight or waiting.
+        """
+        with self._lock:
+            return tenant in self.active or tenant in self.waiting
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "in_use": self.in_use,
+                "tenants": len(self.active),
+                "waiting": sum(len(_) for _ in self.waiting.values()),
+            }
+
+
+class AsyncFairScheduler(FairScheduler):
+    """
+    Asynchronous version of FairScheduler. Waiters that are cancelled
+    are skipped, and give their slot back if they had been handed one.
+    """
+    def _next_waiter(self):
+        while True:
+            next_waiter = super()._next_waiter()
+            if next_waiter is None or not next_waiter[1].done():
+                return next_waiter
+            self._give(next_waiter[0])
+
+    async def acquire(self, tenant: str):
+        waiter = asyncio.get_running_loop().create_future()
+        with self._lock:
+            if self._enqueue(tenant, waiter):
+                return
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release(tenant)
+            raise
+
+    def _wake(self, tenant: str, waiter):
+        waiter.set_result(None)
@@ -0,0 +1,399 @@
+import asyncio
+import json
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import NewConnectionError
+
+from reference import (FINAL_OPERATION_STATUSES,
+                       SUBSCRIPTION_CALLBACK_CONCURRENCY,
+                       SUBSCRIPTION_CALLBACK_TIMEOUT, SUBSCRIPTION_CLAIM_SIZE,
+                       SUBSCRIPTION_DB_PATH, SUBSCRIPTION_INTERVAL,
+                       SUBSCRIPTION_INTERVAL_MAX, SUBSCRIPTION_LEASE,
+                       SUCCESSFUL)
+from utilities import (callback_address_allowed, connect_database,
+                       credentials_hash, encode_json)
+
+CALLBACK_HEADERS = {"Content-Type": "application/json"}
+
+
+def delivery_state(delivery: dict) -> str:
+    """
+    Returns the state of a delivery as it's stored and compared.
+    """
+    return json.dumps(delivery, sort_keys=True, default=str)
+
+
+class SubscriptionStore(object):
+    """
+    Tracking subscriptions, kept in a SQLite database that can be shared
+    by the worker processes of a host. Each subscribed shipment has its
+    own polling schedule, and keeps the state last sent to the callback
+    of its subscription. Like jobs, subscriptions can only be seen by
+    the credentials they were made with, but their credentials are kept
+    for as long as they're polled.
+    """
+    def __init__(self, path: str):
+        self._connection = connect_database(path)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS subscriptions (id TEXT PRIMARY KEY, environment TEXT, "
+            "owner TEXT, username TEXT, password TEXT, callback_url TEXT, created REAL)")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS subscribed_shipments (subscription_id TEXT, "
+            "cargo_key TEXT, state TEXT, interval REAL, next_poll REAL, final INTEGER, "
+            "PRIMARY KEY (subscription_id, cargo_key))")
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS subscribed_shipments_due ON subscribed_shipments "
+            "(final, next_poll)")
+        self._lock = threading.Lock()
+
+    def _write(self, statements: list):
+        """
+        Executes (statement, parameters) pairs in a single transaction.
+        """
+        with self._lock:
+            self._connection.execute("BEGIN")
+            try:
+                for statement, parameters in statements:
+                    self._connection.executemany(statement, parameters)
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+    def subscribe(self, environment: str, username: str, password: str, callback_url: str,
+                  cargo_keys: list) -> str:
+        """
+        Stores a subscription for the shipment IDs and returns its ID. The
+        shipments are due to be polled right away.
+        """
+        subscription_id = uuid.uuid4().hex
+        now = time.time()
+        self._write([
+            ("INSERT INTO subscriptions (id, environment, owner, username, password, callback_url, "
+             "created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+             [(subscription_id, environment, credentials_hash(username, password), username,
+               password, callback_url, now)]),
+            ("INSERT INTO subscribed_shipments (subscription_id, cargo_key, interval, next_poll, "
+             "final) VALUES (?, ?, ?, ?, 0)",
+             [(subscription_id, _, SUBSCRIPTION_INTERVAL, now) for _ in cargo_keys]),
+        ])
+        return subscription_id
+
+    def get(self, subscription_id: str, username: str, password: str):
+        """
+        Returns a subscription and the last known status of its shipments
+        as a dict, or None if there isn't a subscription with the ID that
+        belongs to the credentials.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT environment, callback_url, created FROM subscriptions "
+                "WHERE id = ? AND owner = ?",
+                (subscription_id, credentials_hash(username, password))).fetchone()
+            if row is None:
+                return None
+            shipments = self._connection.execute(
+                "SELECT cargo_key, state, next_poll, final FROM subscribed_shipments "
+                "WHERE subscription_id = ? ORDER BY rowid", (subscription_id,)).fetchall()
+        return {
+            "subscription_id": subscription_id,
+            "environment": row[0],
+            "callback_url": row[1],
+            "created": row[2],
+            "shipments": [{
+                "cargoKey": cargo_key,
+                "operationStatus": json.loads(state)["operationStatus"] if state else None,
+                "final": bool(final),
+                "next_poll": None if final else next_poll,
+            } for cargo_key, state, next_poll, final in shipments],
+        }
+
+    def unsubscribe(self, subscription_id: str, username: str, password: str) -> bool:
+        """
+        Removes a subscription, returning False if there isn't one with
+        the ID that belongs to the credentials.
+        """
+        with self._lock:
+            deleted = self._connection.execute(
+                "DELETE FROM subscriptions WHERE id = ? AND owner = ?",
+                (subscription_id, credentials_hash(username, password))).rowcount
+            if deleted:
+                self._connection.execute(
+                    "DELETE FROM subscribed_shipments WHERE subscription_id = ?", (subscription_id,))
+        return bool(deleted)
+
+    def claim(self):
+        """
+        Leases up to SUBSCRIPTION_CLAIM_SIZE shipments that are due to be
+        polled, and returns them as dicts along with their subscription,
+        or returns None if none are due.
+        """
+        now = time.time()
+        with self._lock:
+            rows = self._connection.execute(
+                "UPDATE subscribed_shipments SET next_poll = ? WHERE rowid IN ("
+                "SELECT rowid FROM subscribed_shipments WHERE final = 0 AND next_poll <= ? "
+                "ORDER BY next_poll LIMIT ?) "
+                "RETURNING subscription_id, cargo_key, state, interval",
+                (now + SUBSCRIPTION_LEASE, now, SUBSCRIPTION_CLAIM_SIZE)).fetchall()
+            if not rows:
+                return None
+            ids = list({ _[0] for _ in rows })
+            subscriptions = { _[0]: _[1:] for _ in self._connection.execute(
+                "SELECT id, environment, username, password, callback_url FROM subscriptions "
+                "WHERE id IN ({})".format(",".join("?" * len(ids))), ids) }
+        return [{
+            "subscription_id": subscription_id,
+            "cargo_key": cargo_key,
+            "state": state,
+            "interval": interval,
+            "environment": subscriptions[subscription_id][0],
+            "username": subscriptions[subscription_id][1],
+            "password": subscriptions[subscription_id][2],
+            "callback_url": subscriptions[subscription_id][3],
+        } for subscription_id, cargo_key, state, interval in rows if subscription_id in subscriptions]
+
+    def update(self, results: list):
+        """
+        Stores the results of polling claimed shipments, given as
+        (shipment, state, interval, final) tuples, and schedules their
+        next poll.
+        """
+        now = time.time()
+        self._write([(
+            "UPDATE subscribed_shipments SET state = ?, interval = ?, next_poll = ?, final = ? "
+            "WHERE subscription_id = ? AND cargo_key = ?",
+            [(state, interval, now + interval, final, shipment["subscription_id"], shipment["cargo_key"])
+             for shipment, state, interval, final in results],
+        )])
+
+    def abandon(self, shipments: list, error: Exception):
+        """
+        Schedules claimed shipments to be polled again after their
+        interval, after polling them raised an error.
+        """
+        self.update(retry_results(shipments))
+
+
+def group_by_account(shipments: list) -> dict:
+    """
+    Groups claimed shipments by the environment and the credentials
+    they're looked up with.
+    """
+    groups = {}
+    for shipment in shipments:
+        account = (shipment["environment"], shipment["username"], shipment["password"])
+        groups.setdefault(account, []).append(shipment)
+    return groups
+
+def tracked_deliveries(responses: list) -> dict:
+    """
+    Returns the deliveries found by serialized queryShipment responses,
+    keyed by their shipment ID. Deliveries with errors (e.g. shipments
+    that don't exist yet) are left out.
+    """
+    deliveries = {}
+    for response in responses:
+        if response.get("outFlag") != SUCCESSFUL:
+            continue
+        for delivery in response["shippingDeliveryDetailVO"] or []:
+            if delivery["errCode"] is None and delivery["cargoKey"] is not None:
+                deliveries[delivery["cargoKey"]] = delivery
+    return deliveries
+
+def retry_results(shipments: list) -> list:
+    """
+    Returns the results of shipments that couldn't be polled, or whose
+    changes couldn't be sent, to be polled again after their interval.
+    """
+    return [(_, _["state"], _["interval"], False) for _ in shipments]
+
+def poll_results(shipments: list, deliveries: dict) -> tuple:
+    """
+    Compares claimed shipments with their deliveries. Returns the changed
+    shipments and their deliveries grouped by subscription, as
+    {(subscription_id, callback_url): [(shipment, delivery)]}, and the
+    results of the shipments that haven't changed, which are polled
+    half as often as before.
+    """
+    changes, unchanged = {}, []
+    for shipment in shipments:
+        delivery = deliveries.get(shipment["cargo_key"])
+        if delivery is None or delivery_state(delivery) == shipment["state"]:
+            unchanged.append((shipment, shipment["state"],
+                              min(shipment["interval"] * 2, SUBSCRIPTION_INTERVAL_MAX), False))
+        else:
+            subscription = (shipment["subscription_id"], shipment["callback_url"])
+            changes.setdefault(subscription, []).append((shipment, delivery))
+    return changes, unchanged
+
+def sent_results(changes: list) -> list:
+    """
+    Returns the results of shipments whose changes were sent. They're
+    polled again after SUBSCRIPTION_INTERVAL, unless they've reached a
+    final status.
+    """
+    return [
+        (shipment, delivery_state(delivery), SUBSCRIPTION_INTERVAL,
+         delivery["operationStatus"] in FINAL_OPERATION_STATUSES)
+        for shipment, delivery in changes
+    ]
+
+def callback_body(subscription_id: str, environment: str, changes: list) -> bytes:
+    """
+    Returns what's POSTed to the callback of a subscription: the current
+    deliveries of the shipments that have changed.
+    """
+    return encode_json({
+        "subscription_id": subscription_id,
+        "environment": environment,
+        "shipments": [delivery for _, delivery in changes],
+    })
+
+def resolved_allowed(addresses: list) -> bool:
+    """
+    Returns whether all the addresses a callback host resolved to, as
+    returned by getaddrinfo, are allowed.
+    """
+    try:
+        return bool(addresses) and all(callback_address_allowed(_[4][0]) for _ in addresses)
+    except ValueError:
+        return False
+
+async def pinned_callback(callback_url: str):
+    """
+    Resolves the host of a callback. If all of its addresses are allowed,
+    returns the URL to POST to with the host replaced by the first
+    address, so that the address that was checked is the one connected
+    to, along with the headers and extensions that keep the original host
+    for the Host header and TLS. Returns None otherwise.
+    """
+    import httpx
+
+    try:
+        url = httpx.URL(callback_url)
+        host = url.raw_host.decode("ascii")
+        addresses = await asyncio.get_running_loop().getaddrinfo(
+            host, url.port or (443 if url.scheme == "https" else 80), type=socket.SOCK_STREAM)
+    except (OSError, UnicodeError, ValueError, httpx.InvalidURL):
+        return None
+    if not resolved_allowed(addresses):
+        return None
+    headers = dict(CALLBACK_HEADERS, Host=url.netloc.decode("ascii"))
+    extensions = {"sni_hostname": host} if url.scheme == "https" else {}
+    return url.copy_with(host=addresses[0][4][0]), headers, extensions
+
+
+class CheckedConnection(object):
+    """
+    Refuses a connection once it's made to an address that callbacks
+    can't be sent to, so that the address that's checked is the one
+    the request is sent to, whatever the host resolves to.
+    """
+    def _new_conn(self):
+        sock = super()._new_conn()
+        address = sock.getpeername()[0]
+        try:
+            allowed = callback_address_allowed(address)
+        except ValueError:
+            allowed = False
+        if not allowed:
+            sock.close()
+            raise NewConnectionError(self, "Callbacks can't be sent to {}".format(address))
+        return sock
+
+
+class CheckedHTTPConnection(CheckedConnection, HTTPConnection):
+    pass
+
+
+class CheckedHTTPSConnection(CheckedConnection, HTTPSConnection):
+    pass
+
+
+class CheckedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = CheckedHTTPConnection
+
+
+class CheckedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = CheckedHTTPSConnection
+
+
+class CallbackAdapter(requests.adapters.HTTPAdapter):
+    """
+    A transport adapter whose connections are checked.
+    """
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": CheckedHTTPConnectionPool,
+            "https": CheckedHTTPSConnectionPool,
+        }
+
+
+def callback_session() -> requests.Session:
+    """
+    Returns a session with a checked connection for each callback sent
+    at once. Proxies from the environment aren't used, as the address
+    they connect to can't be checked.
+    """
+    session = requests.Session()
+    session.trust_env = False
+    adapter = CallbackAdapter(pool_maxsize=SUBSCRIPTION_CALLBACK_CONCURRENCY)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def send_changes(session: requests.Session, callback_url: str, body: bytes) -> bool:
+    """
+    POSTs changes to a callback with a session from callback_session,
+    returning whether it accepted them. Changes aren't sent if the host
+    of the callback resolves to an address that isn't allowed. Redirects
+    aren't followed.
+    """
+    try:
+        response = session.post(callback_url, data=body, headers=CALLBACK_HEADERS,
+                                timeout=SUBSCRIPTION_CALLBACK_TIMEOUT, allow_redirects=False)
+    except requests.RequestException:
+        return False
+    return 200 <= response.status_code < 300
+
+def send_all_changes(session: requests.Session, callbacks: list) -> list:
+    """
+    POSTs the bodies of (callback_url, body) pairs, to at most
+    SUBSCRIPTION_CALLBACK_CONCURRENCY callbacks at once. Returns whether
+    each callback accepted its changes, in order.
+    """
+    if not callbacks:
+        return []
+    with ThreadPoolExecutor(max_workers=min(SUBSCRIPTION_CALLBACK_CONCURRENCY, len(callbacks)),
+                            thread_name_prefix="callback") as executor:
+        return list(executor.map(lambda _: send_changes(session, *_), callbacks))
+
+async def async_send_changes(client, callback_url: str, body: bytes) -> bool:
+    """
+    Asynchronous version of send_changes, with an httpx client. The
+    changes are sent to the address that was checked by pinned_callback.
+    """
+    import httpx
+
+    pinned = await pinned_callback(callback_url)
+    if pinned is None:
+        return False
+    url, headers, extensions = pinned
+    try:
+        response = await client.post(url, content=body, headers=headers, extensions=extensions,
+                                     timeout=SUBSCRIPTION_CALLBACK_TIMEOUT)
+    except httpx.HTTPError:
+        return False
+    return response.is_success
+
+
+subscription_store = SubscriptionStore(SUBSCRIPTION_DB_PATH)
@@ -1,19 +1,121 @@
 import base64
+import hashlib
+import ipaddress
+import json
+import os
+import sqlite3
+import string
+from collections import Counter
 from datetime import datetime
+from functools import lru_cache
+from itertools import chain, islice
+from urllib.parse import urlsplit
 
-from benedict import benedict
+import falcon
 from zeep import xsd
+from zeep.helpers import serialize_object
 
-from reference import SENDER_NAME, SENDER_TELEPHONE
+from reference import (CARGO_KEY_MAX_LENGTH, DEFAULT_LOCALE, ENVIRONMENT_PROD,
+                       ENVIRONMENT_TEST, ERRORS_CREATE_SHIPMENT,
+                       ERROR_DESCRIPTIONS_CANCEL_SHIPMENT,
+                       ERROR_DESCRIPTIONS_CREATE_SHIPMENT,
+                       IDENTIFIER_INVOICE_ID, IDENTIFIER_SHIPMENT_ID,
+                       INVOICE_KEY_MAX_LENGTH, LOCALES, SENDER_NAME,
+                       SENDER_TELEPHONE, SUBSCRIPTION_CALLBACK_NETWORKS,
+                       SUCCESSFUL)
+
+# orjson is used for JSON bodies if it's installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 def extract_credentials(encoded_string: str) -> tuple:
     """
     Given the base64-encoded part of the authentication header, 
-    decodes and separates the username and password.
+    decodes and separates the username and password. Passwords can
+    contain colons. Raises ValueError if the string isn't valid.
+    """
+    decoded = base64.b64decode(encoded_string, validate=True).decode("utf-8")
+    username, separator, password = decoded.partition(":")
+    if not separator:
+        raise ValueError("Credentials don't contain a colon")
+    return (username, password)
+
+def parse_authorization(header: str) -> tuple:
+    """
+    Returns the username and password of an HTTP Basic authentication
+    header. Raises ValueError if the header isn't valid.
+    """
+    parsed_auth = header.split(" ")
+    if len(parsed_auth) != 2 or parsed_auth[0] != "Basic":
+        raise ValueError("Not an HTTP Basic authentication header")
+    return extract_credentials(parsed_auth[1])
+
+def connect_database(path: str) -> sqlite3.Connection:
+    """
+    Opens a SQLite database that the worker processes of a host can
+    share, creating its directory if needed. Raises RuntimeError if it
+    can't be opened, as the proxy can't run without it.
+    """
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+    except (OSError, sqlite3.Error) as e:
+        raise RuntimeError("The database at {} can't be opened ({}), set YK_DATA_DIR to a "
+                           "directory the proxy can write to".format(path, e)) from e
+    return connection
+
+def credentials_hash(username: str, password: str) -> str:
+    """
+    Hashes a pair of credentials, for when they're needed as a key.
+    """
+    return hashlib.sha256("{}:{}".format(username, password).encode("utf-8")).hexdigest()
+
+def select_environment(req) -> str:
+    """
+    Determines which Yurtiçi Kargo environment the request is meant for.
+    """
+    if (req.context["username"] == "YKTEST" 
+            or req.params.get("environment", None) == "test"):
+        return ENVIRONMENT_TEST
+    return ENVIRONMENT_PROD
+
+def select_locale(req) -> str:
+    """
+    Determines which locale errors are described in.
     """
-    decoded = base64.b64decode(encoded_string).decode("utf-8").split(":")
-    return (decoded[0], decoded[1])
+    locale = req.get_param("locale")
+    if locale is None:
+        return preferred_locale(req.get_header("Accept-Language") or "")
+    if locale.lower() not in LOCALES:
+        raise falcon.HTTPBadRequest(title="400 Bad Request",
+                                    description="locale should be one of: {}".format(", ".join(LOCALES)))
+    return locale.lower()
+
+@lru_cache(maxsize=256)
+def preferred_locale(accept_language: str) -> str:
+    """
+    Returns the locale an Accept-Language header prefers, or
+    DEFAULT_LOCALE if it doesn't accept any of them.
+    """
+    locale, preference = DEFAULT_LOCALE, 0.0
+    for language in accept_language.split(","):
+        tag, *parameters = language.split(";")
+        quality = 1.0
+        for parameter in parameters:
+            name, _, value = parameter.strip().partition("=")
+            if name == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        tag = tag.strip().lower().split("-")[0]
+        if tag in LOCALES and quality > preference:
+            locale, preference = tag, quality
+    return locale
 
 def parameter_as_list(parameter) -> list:
     """
@@ -25,41 +127,40 @@ def parameter_as_list(parameter) -> list:
     elif type(parameter) in (str, dict):
         return [parameter]
 
+# specialField1 codes of the fields it's built from
+SPECIAL_FIELDS = (
+    ("customer_serial_number", "2"),
+    ("order_number", "3"),
+    ("bag_number", "4"),
+    ("packaging_number", "5"),
+    ("customer_national_id", "6"),
+    ("customer_full_name", "7"),
+    ("region", "8"),
+    ("department_or_employee_id", "9"),
+    ("mobile_phone", "10"),
+    ("policy_number", "11"),
+    ("cost_center", "12"),
+    ("product", "13"),
+    ("customer_reference", "14"),
+    ("rma_number", "16"),
+    ("magazine_type", "51"),
+    ("representative_id", "52"),
+    ("waybill_number", "54"),
+    ("recipient_vat_id", "55"),
+    ("representative_team_lead_id", "56"),
+)
+
 def generate_special_field(shipment_object=None, **kwargs) -> str:
     """
     Given a set of keyword arguments, generates the specialField1 string 
     for a shipment.
     """
-    fields = {
-        "customer_serial_number": "2",
-        "order_number": "3",
-        "bag_number": "4",
-        "packaging_number": "5",
-        "customer_national_id": "6",
-        "customer_full_name": "7",
-        "region": "8",
-        "department_or_employee_id": "9",
-        "mobile_phone": "10",
-        "policy_number": "11",
-        "cost_center": "12",
-        "product": "13",
-        "customer_reference": "14",
-        "rma_number": "16",
-        "magazine_type": "51",
-        "representative_id": "52",
-        "waybill_number": "54",
-        "recipient_vat_id": "55",
-        "representative_team_lead_id": "56",
-    }
-    field = ""
-    if shipment_object is not None:
-        for field_name, field_code in fields.items():
-            field += "{}${}#".format(field_code, shipment_object.get(field_name, "")) if field_name in shipment_object else ""
-        return field if field != "" else xsd.SkipValue
-    else:
-        for field_name, field_code in fields.items():
-            field += "{}${}#".format(field_code, kwargs.get(field_name, "")) if field_name in kwargs else ""
-        return field if field != "" else xsd.SkipValue
+    source = shipment_object if shipment_object is not None else kwargs
+    field = "".join([
+        "{}${}#".format(field_code, source[field_name])
+        for field_name, field_code in SPECIAL_FIELDS if field_name in source
+    ])
+    return field if field != "" else xsd.SkipValue
 
 def unpack_phone_numbers(req, shipment: dict) -> dict:
     """
@@ -90,77 +191,725 @@ def read_formatted_address(req, shipment: dict) -> dict:
     """
     pass
 
+# ShippingOrderVO parameters and the keys they're read from in raw and
+# formatted shipments, with dots separating the keys of nested objects
+SHIPMENT_PARAMS = {
+    "cargoKey": ("cargoKey", "shipment_id"),
+    "invoiceKey": ("invoiceKey", "invoice_id"),
+    "receiverCustName": ("receiverCustName", "to_address.name"),
+    "receiverAddress": ("receiverAddress", "to_address.street1"),
+    # Phone numbers
+    "cityName": ("cityName", "to_address.state"),
+    "townName": ("townName", "to_address.city"),
+    "custProdId": ("custProdId", "custProdId"), # deprecated
+    "desi": ("desi", "parcel.volumetric_weight"),
+    "kg": ("kg", "parcel.weight"),
+    "cargoCount": ("cargoCount", "count"),
+    "waybillNo": ("waybillNo", "waybill_id"),
+    # Special fields
+    "ttCollectionType": ("ttCollectionType", "options.cod_method"),
+    "ttInvoiceAmount": ("ttInvoiceAmount", "options.cod_amount"),
+    "ttDocumentId": ("ttDocumentId", "options.cod_invoice_id"),
+    "ttDocumentSaveType": ("ttDocumentSaveType", "ttDocumentSaveType"), # not implemented here
+    "orgReceiverCustId": ("orgReceiverCustId", "orgReceiverCustId"), # not implemented here
+    "description": ("description", "description"),
+    "taxNumber": ("taxNumber", "to_address.tr_tax_id"),
+    "taxOfficeId": ("taxOfficeId", "to_address.tr_tax_office_id"),
+    "taxOfficeName": ("taxOfficeName", "to_address.tr_tax_office"),
+    "orgGeoCode": ("orgGeoCode", "orgGeoCode"), # deprecated
+    "privilegeOrder": ("privilegeOrder", "privilegeOrder"), # deprecated
+    "dcSelectedCredit": ("dcSelectedCredit", "dcSelectedCredit"), # not implemented here
+    "dcCreditRule": ("dcCreditRule", "dcCreditRule"), # not implemented here
+    "emailAddress": ("emailAddress", "to_address.email"),
+}
+
+# SHIPMENT_PARAMS resolved into (parameter, key, key path) tuples for raw
+# and formatted shipments. The key path is None for top-level keys.
+SHIPMENT_ACCESSORS = tuple(
+    tuple(
+        (param, names[key_format], tuple(names[key_format].split(".")) if "." in names[key_format] else None)
+        for param, names in SHIPMENT_PARAMS.items()
+    )
+    for key_format in (0, 1)
+)
+
+# Parameters of the shipments returned by parse_shipment
+SHIPMENT_FIELDS = tuple(SHIPMENT_PARAMS) + (
+    "receiverPhone1", "receiverPhone2", "receiverPhone3",
+    "specialField1", "specialField2", "specialField3",
+)
+
+def get_keypath(obj: dict, keypath: tuple):
+    """
+    Returns the value at the given path of keys in nested objects, or 
+    SkipValue if there isn't one.
+    """
+    for key in keypath:
+        try:
+            obj = obj[key]
+        except (KeyError, TypeError, IndexError):
+            return xsd.SkipValue
+    return obj
+
 def parse_shipment(req, shipment: dict) -> dict:
     """
     Parses a request and prepares a formatted shipment object for
     further use.
     """
-    param_keys = {
-        "cargoKey": ("cargoKey", "shipment_id"),
-        "invoiceKey": ("invoiceKey", "invoice_id"),
-        "receiverCustName": ("receiverCustName", "to_address.name"),
-        "receiverAddress": ("receiverAddress", "to_address.street1"),
-        # Phone numbers
-        "cityName": ("cityName", "to_address.state"),
-        "townName": ("townName", "to_address.city"),
-        "custProdId": ("custProdId", "custProdId"), # deprecated
-        "desi": ("desi", "parcel.volumetric_weight"),
-        "kg": ("kg", "parcel.weight"),
-        "cargoCount": ("cargoCount", "count"),
-        "waybillNo": ("waybillNo", "waybill_id"),
-        # Special fields
-        "ttCollectionType": ("ttCollectionType", "options.cod_method"),
-        "ttInvoiceAmount": ("ttInvoiceAmount", "options.cod_amount"),
-        "ttDocumentId": ("ttDocumentId", "options.cod_invoice_id"),
-        "ttDocumentSaveType": ("ttDocumentSaveType", "ttDocumentSaveType"), # not implemented here
-        "orgReceiverCustId": ("orgReceiverCustId", "orgReceiverCustId"), # not implemented here
-        "description": ("description", "description"),
-        "taxNumber": ("taxNumber", "to_address.tr_tax_id"),
-        "taxOfficeId": ("taxOfficeId", "to_address.tr_tax_office_id"),
-        "taxOfficeName": ("taxOfficeName", "to_address.tr_tax_office"),
-        "orgGeoCode": ("orgGeoCode", "orgGeoCode"), # deprecated
-        "privilegeOrder": ("privilegeOrder", "privilegeOrder"), # deprecated
-        "dcSelectedCredit": ("dcSelectedCredit", "dcSelectedCredit"), # not implemented here
-        "dcCreditRule": ("dcCreditRule", "dcCreditRule"), # not implemented here
-        "emailAddress": ("emailAddress", "to_address.email"),
-    }
-
-    input_object = benedict(shipment)
-    output_object = benedict()
-
-    key_format = int(req.context["formatted"])
-
-    for param, param_name in param_keys.items():
-            output_object[param] = input_object.get(param_name[key_format], xsd.SkipValue)
+    output_object = {}
+    for param, key, keypath in SHIPMENT_ACCESSORS[int(req.context["formatted"])]:
+        if keypath is None:
+            output_object[param] = shipment.get(key, xsd.SkipValue)
+        else:
+            output_object[param] = get_keypath(shipment, keypath)
 
     # add phone numbers
     output_object.update(unpack_phone_numbers(req, shipment))
-    # add special fields
+    # add special fields
     output_object["specialField1"] = generate_special_field(shipment)
-    # special fields 2 and 3 are deprecated
+    # special fields 2 and 3 are deprecated
     output_object["specialField2"] = xsd.SkipValue
     output_object["specialField3"] = xsd.SkipValue
 
-    return dict(output_object)
+    return output_object
 
-def generate_zpl_label(shipment: dict, job_id: str) -> dict:
+class LabelTemplate(object):
+    """
+    A str.format template split once into its literal text and fields,
+    with the fields whose values never change filled in up front.
+    """
+    def __init__(self, template: str, **constants):
+        self.literals = []
+        self.fields = []
+        literal = ""
+        for text, field, _, _ in string.Formatter().parse(template):
+            literal += text
+            if field is None:
+                continue
+            if field in constants:
+                literal += str(constants[field])
+            else:
+                self.literals.append(literal)
+                self.fields.append(field)
+                literal = ""
+        self.literals.append(literal)
+
+    def render(self, values: dict) -> str:
+        parts = [self.literals[0]]
+        for field, literal in zip(self.fields, self.literals[1:]):
+            parts.append(values[field])
+            parts.append(literal)
+        return "".join(parts)
+
+# really rudimentary string formatting for now
+ZPL_LABEL = LabelTemplate(
+    "^XA^CI28^PON^MUm^FO0,21.75^GB777,0.25,0.25^FS^FO0,66.75^GB777,0.25,0.25^FS^FO0,0^LRY^GB187.5,2.5,6.25^FS^FO3,1.25^A0N,5^FDYURTİÇİ KARGO                                   GÖ^FS^LRN^FO80,6.75^A0N,2.25^FD{date}-{time}^FS^FO5,8.75^A0N,3.125^FDGÖNDEREN^FS^FO7,12.75^A0N,4^FD{sender_name}^FS^FO7,16.75^A0N,4^FDTEL: {sender_telephone}^FS^FO5,24.75^A0N,3.125^FDALICI^FS^FO7,29.625^A0N,4.75^FD{recipient_name}^FS^FO7,35^A0N,4.75^FB700,3,4,^FD{recipient_address}^FS^FO7,54.75^A0N,4^FDTEL: {recipient_telephone}^FS^FO50,59.75^A0N,5^FB400,1,0,R^FD{recipient_town} ({recipient_city})^FS^FO5,69.75^A0N,3.125^FDİÇERİK^FS^FO7,73.75^A0N,4^FD{contents}^FS^FO64,82.125^A0N,3,3^FDTALEP#^FS^FO48,82.125^A0N,6.625,5^FB400,1,0,R^FD{job_id}^FS^FO3,89.125^A0N,3,3^FDREF#^FS^FO12.875,89.125^A0N,6.625,5^FD{reference}^FS^FO64,89.125^A0N,3,3^FDİRSALİYE#^FS^FO48,89.125^A0N,6.625,5^FB400,1,0,R^FD{waybill_number}^FS^FO0,122^A0N,3,3^FB800,1,0,C^FD{barcode}\\&^FS^FO7,125^MUd^BY3,2^BCN,220,N,N,N,N^FWN^FD{barcode}^FS^MUd^XZ",
+    sender_name=SENDER_NAME,
+    sender_telephone=SENDER_TELEPHONE,
+    reference="", # not yet implemented
+)
+
+def label_timestamp() -> tuple:
+    """
+    Returns the date and time printed on labels, which is computed once
+    for a whole batch.
+    """
     now = datetime.now()
-    time = now.strftime("%H:%M:%S")
-    date = now.strftime("%d/%m/%Y")
-    # really rudimentary string formatting for now
-    return "^XA^CI28^PON^MUm^FO0,21.75^GB777,0.25,0.25^FS^FO0,66.75^GB777,0.25,0.25^FS^FO0,0^LRY^GB187.5,2.5,6.25^FS^FO3,1.25^A0N,5^FDYURTİÇİ KARGO                                   GÖ^FS^LRN^FO80,6.75^A0N,2.25^FD{date}-{time}^FS^FO5,8.75^A0N,3.125^FDGÖNDEREN^FS^FO7,12.75^A0N,4^FD{sender_name}^FS^FO7,16.75^A0N,4^FDTEL: {sender_telephone}^FS^FO5,24.75^A0N,3.125^FDALICI^FS^FO7,29.625^A0N,4.75^FD{recipient_name}^FS^FO7,35^A0N,4.75^FB700,3,4,^FD{recipient_address}^FS^FO7,54.75^A0N,4^FDTEL: {recipient_telephone}^FS^FO50,59.75^A0N,5^FB400,1,0,R^FD{recipient_town} ({recipient_city})^FS^FO5,69.75^A0N,3.125^FDİÇERİK^FS^FO7,73.75^A0N,4^FD{contents}^FS^FO64,82.125^A0N,3,3^FDTALEP#^FS^FO48,82.125^A0N,6.625,5^FB400,1,0,R^FD{job_id}^FS^FO3,89.125^A0N,3,3^FDREF#^FS^FO12.875,89.125^A0N,6.625,5^FD{reference}^FS^FO64,89.125^A0N,3,3^FDİRSALİYE#^FS^FO48,89.125^A0N,6.625,5^FB400,1,0,R^FD{waybill_number}^FS^FO0,122^A0N,3,3^FB800,1,0,C^FD{barcode}\&^FS^FO7,125^MUd^BY3,2^BCN,220,N,N,N,N^FWN^FD{barcode}^FS^MUd^XZ".format(
-        date=date,
-        time=time,
-        sender_name=SENDER_NAME,
-        sender_telephone=SENDER_TELEPHONE,
-        recipient_name=shipment["receiverCustName"].upper(),
-        recipient_address=shipment["receiverAddress"].upper(),
-        recipient_telephone=prettify_phone_number(shipment["receiverPhone1"]),
-        recipient_town=shipment["townName"].upper(),
-        recipient_city=shipment["cityName"].upper(),
-        contents=shipment["description"].upper(),
-        job_id=job_id,
-        reference="", # not yet implemented
-        waybill_number=str(shipment["waybillNo"]).upper(),
-        barcode=shipment["cargoKey"].upper(),
-    )
+    return now.strftime("%d/%m/%Y"), now.strftime("%H:%M:%S")
+
+def generate_zpl_label(shipment: dict, job_id: str, timestamp: tuple = None) -> str:
+    date, time = timestamp or label_timestamp()
+    return ZPL_LABEL.render({
+        "date": date,
+        "time": time,
+        "recipient_name": shipment["receiverCustName"].upper(),
+        "recipient_address": shipment["receiverAddress"].upper(),
+        "recipient_telephone": prettify_phone_number(shipment["receiverPhone1"]),
+        "recipient_town": shipment["townName"].upper(),
+        "recipient_city": shipment["cityName"].upper(),
+        "contents": shipment["description"].upper(),
+        "job_id": job_id,
+        "waybill_number": str(shipment["waybillNo"]).upper(),
+        "barcode": shipment["cargoKey"].upper(),
+    })
+
+def chunked(items: list, size: int) -> list:
+    """
+    Splits a list into consecutive chunks of at most the given size.
+    """
+    return [items[_:_ + size] for _ in range(0, len(items), size)]
+
+def iter_chunked(items, size: int):
+    """
+    Splits an iterable into consecutive chunks of at most the given size,
+    reading only one chunk at a time.
+    """
+    items = iter(items)
+    chunk = list(islice(items, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(items, size))
+
+def encode_json(obj) -> bytes:
+    """
+    Encodes an object as UTF-8 JSON.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("utf-8")
+
+def decode_json(data):
+    """
+    Decodes a JSON document from bytes or a string.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def read_lines(stream, size: int = 65536):
+    """
+    Yields the lines of a request body, reading it in blocks of the
+    given size.
+    """
+    remainder = b""
+    for data in iter(lambda: stream.read(size), b""):
+        *lines, remainder = (remainder + data).split(b"\n")
+        yield from lines
+    if remainder:
+        yield remainder
+
+def read_shipments(data) -> list:
+    """
+    Decodes the shipments in a JSON request body, a list of shipment
+    objects or a single one. Raises 400 if the body isn't valid JSON, or
+    doesn't have any shipments.
+    """
+    try:
+        body = decode_json(data)
+    except ValueError:
+        raise falcon.HTTPBadRequest(title="400 Bad Request", description="Invalid JSON")
+    shipments = [body] if isinstance(body, dict) else body
+    if not isinstance(shipments, list) or not all(isinstance(_, dict) for _ in shipments):
+        raise falcon.HTTPBadRequest(title="400 Bad Request",
+                                    description="The body should be a shipment or a list of shipments")
+    if not shipments:
+        raise no_shipments()
+    return shipments
+
+def no_shipments(errors: list = ()) -> falcon.HTTPBadRequest:
+    """
+    Returns the error raised when a request body doesn't have any
+    shipments, giving the line of an NDJSON body that was invalid.
+    """
+    if errors:
+        description = "Invalid JSON on line {}".format(errors[0])
+    else:
+        description = "No shipments were provided"
+    return falcon.HTTPBadRequest(title="400 Bad Request", description=description)
+
+def read_ndjson(lines, errors: list):
+    """
+    Yields the objects on each line of an NDJSON body. Reading stops at
+    the first line that isn't a valid JSON object, whose number is added
+    to the list of errors.
+    """
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            obj = decode_json(line)
+        except ValueError:
+            obj = None
+        if not isinstance(obj, dict):
+            errors.append(number)
+            return
+        yield obj
+
+def peek_ndjson(objects, errors: list):
+    """
+    Reads the first object of an NDJSON body, so that a body without any
+    is rejected with 400 before the response is started, and returns all
+    the objects.
+    """
+    first = next(objects, None)
+    if first is None:
+        raise no_shipments(errors)
+    return chain([first], objects)
+
+def ndjson_line(key: str, obj: dict) -> bytes:
+    """
+    Encodes a single result of an NDJSON response.
+    """
+    return encode_json({ key: obj }) + b"\n"
+
+def as_dict(response) -> dict:
+    """
+    Serializes a zeep response, unless it was parsed into a dict already.
+    """
+    if isinstance(response, dict):
+        return response
+    return serialize_object(response, target_cls=dict)
+
+def strip_skip_values(shipment) -> dict:
+    """
+    Serializes a ShippingOrderVO object (or copies a shipment dict),
+    replacing SkipValues with empty strings.
+    """
+    shipment = serialize_object(shipment, target_cls=dict)
+    for key, value in shipment.items():
+        if value == xsd.SkipValue:
+            shipment[key] = ""
+    return shipment
+
+def missing(value) -> bool:
+    """
+    Returns whether a shipment field was left out or empty.
+    """
+    return value is None or value is xsd.SkipValue or not str(value).strip()
+
+def shipment_error(shipment) -> int:
+    """
+    Returns the code of the error Yurtiçi Kargo would reject a shipment
+    with, or None if it passes the checks that can be made locally.
+    """
+    if missing(shipment["cargoKey"]):
+        return 80859
+    if len(str(shipment["cargoKey"])) > CARGO_KEY_MAX_LENGTH:
+        return 82500
+    if not missing(shipment["invoiceKey"]) and len(str(shipment["invoiceKey"])) > INVOICE_KEY_MAX_LENGTH:
+        return 82501
+    if missing(shipment["receiverCustName"]):
+        return 60018
+    if missing(shipment["receiverAddress"]):
+        return 60019
+    return None
+
+class ShipmentValidator(object):
+    """
+    Rejects the shipments Yurtiçi Kargo would reject before they're sent,
+    along with shipments whose ID was already used in the same batch.
+    Rejected shipments are kept as failed results, with the code and the
+    message Yurtiçi Kargo would have given. A validator remembers the
+    IDs it has seen, so that it can check a stream as it's read.
+    """
+    def __init__(self):
+        self.seen = set()
+        self.rejected = []
+
+    def accepts(self, shipment) -> bool:
+        code = shipment_error(shipment)
+        if code is None:
+            if shipment["cargoKey"] in self.seen:
+                code = 60020
+            else:
+                self.seen.add(shipment["cargoKey"])
+        if code is None:
+            return True
+        self.rejected.append(dict(strip_skip_values(shipment), errCode=code,
+                                  errMessage=ERRORS_CREATE_SHIPMENT[code][2]))
+        return False
+
+    def validate(self, shipments: list) -> list:
+        """
+        Returns the shipments that were accepted.
+        """
+        return [_ for _ in shipments if self.accepts(_)]
+
+    def drain(self) -> list:
+        """
+        Returns the shipments rejected since the last call.
+        """
+        rejected, self.rejected = self.rejected, []
+        return rejected
+
+def build_shipments(req, body) -> list:
+    """
+    Builds a ShippingOrderVO object (or a dict, on the fast path) for
+    each shipment in the request body.
+    """
+    return [
+        req.context["shipment_type"](**parse_shipment(req, shipment))
+        for shipment in parameter_as_list(body)
+    ]
+
+def shipment_labels(shipments: list, yk_resp: dict, timestamp: tuple):
+    """
+    Yields the labels of the shipments in a chunk that were created
+    successfully.
+    """
+    if yk_resp["outFlag"] != "0":
+        return
+    shipments_by_key = { _["cargoKey"]: _ for _ in shipments }
+    for shipment in yk_resp["shippingOrderDetailVO"]:
+        if shipment["errCode"] is None:
+            yield generate_zpl_label(strip_skip_values(shipments_by_key[shipment["cargoKey"]]),
+                                     str(yk_resp["jobId"]), timestamp)
+
+def chunk_results(shipments: list, yk_resp: dict, timestamp: tuple):
+    """
+    Yields (created, shipment) pairs for the shipments of a chunk, with
+    the label added to the shipments that were created and the error to
+    the ones that weren't. Shipments of a chunk that was rejected as a
+    whole get the error of the chunk, and the status of its call if it
+    failed.
+    """
+    shipments_by_key = { _["cargoKey"]: strip_skip_values(_) for _ in shipments }
+
+    if yk_resp["outFlag"] != "0":
+        for shipment in shipments_by_key.values():
+            shipment["errCode"] = yk_resp.get("errCode")
+            shipment["errMessage"] = yk_resp.get("errMessage") or yk_resp.get("outResult")
+            shipment["status"] = yk_resp.get("status")
+            yield False, shipment
+        return
+
+    for shipment in yk_resp["shippingOrderDetailVO"]:
+        # if there aren't any errors
+        if shipment["errCode"] is None:
+            # generate label and add to the main shipment object
+            shipments_by_key[shipment["cargoKey"]]["label"] = generate_zpl_label(
+                shipments_by_key[shipment["cargoKey"]], str(yk_resp["jobId"]), timestamp)
+            yield True, shipments_by_key[shipment["cargoKey"]]
+        else:
+            # add data from the response object to the main shipment object
+            shipments_by_key[shipment["cargoKey"]]["errCode"] = shipment["errCode"]
+            shipments_by_key[shipment["cargoKey"]]["errMessage"] = shipment["errMessage"]
+            yield False, shipments_by_key[shipment["cargoKey"]]
+
+def failed_chunk(error: Exception) -> dict:
+    """
+    Returns a serialized response rejecting a whole chunk with the error
+    its call failed with, and the HTTP status the error maps to.
+    """
+    if isinstance(error, falcon.HTTPError):
+        status, message = error.status, error.description or error.title
+    else:
+        status, message = falcon.HTTP_502, repr(error)
+    return {
+        "outFlag": "1",
+        "outResult": message,
+        "errCode": None,
+        "errMessage": message,
+        "count": 0,
+        "jobId": None,
+        "shippingOrderDetailVO": None,
+        "status": status,
+    }
+
+def build_shipment_response(results: list, locale: str = DEFAULT_LOCALE,
+                            rejected: list = ()) -> tuple:
+    """
+    Given (ShippingOrderVO objects, serialized createShipment response)
+    pairs for each chunk of a batch and the shipments that were rejected
+    before being sent, returns the HTTP status and the body of the
+    response, with errors described in the locale. Shipments of a chunk
+    that was rejected as a whole, or whose call failed, are reported as
+    failed with the error of the chunk. If no chunk was accepted, the
+    status is that of the first error.
+    """
+    timestamp = label_timestamp()
+    resp_obj = {
+        "successful": [],
+        "failed": list(rejected),
+        "outFlag": "1",
+        "count": 0,
+        "jobId": None,
+        "jobIds": [],
+    }
+    for shipments, yk_resp in results:
+        resp_obj["jobIds"].append(yk_resp["jobId"])
+        if yk_resp["outFlag"] == "0":
+            resp_obj["outFlag"] = "0"
+            resp_obj["count"] += yk_resp["count"] or 0
+            if resp_obj["jobId"] is None:
+                resp_obj["jobId"] = yk_resp["jobId"]
+
+        for created, shipment in chunk_results(shipments, yk_resp, timestamp):
+            resp_obj["successful" if created else "failed"].append(shipment)
+    describe_shipment_failures(resp_obj, locale)
+
+    if resp_obj["outFlag"] == "0":
+        return falcon.HTTP_OK, resp_obj
+    return failure_status(resp_obj, results), resp_obj
+
+def parse_query(req) -> tuple:
+    """
+    Reads the queryShipment parameters from the request. Returns the
+    lookups to make as (keys, key type) pairs, followed by the 
+    addHistoricalData and onlyTracking flags.
+    """
+    shipment_id = req.get_param_as_list("shipment_id", None)
+    invoice_id = req.get_param_as_list("invoice_id", None)
+    add_historical_data = req.get_param_as_bool("add_historical_data", default=True)
+    tracking_url_only = req.get_param_as_bool("tracking_url_only", default=False)
+
+    if not any((shipment_id, invoice_id)):
+        raise falcon.HTTPBadRequest(title="400 Bad Request",
+                                    description="No identifier was provided")
+
+    lookups = []
+    if shipment_id is not None:
+        lookups.append((shipment_id, IDENTIFIER_SHIPMENT_ID))
+    if invoice_id is not None:
+        lookups.append((invoice_id, IDENTIFIER_INVOICE_ID))
+    return lookups, add_historical_data, tracking_url_only
+
+def delivery_key_field(key_type: int) -> str:
+    """
+    Returns the field of a delivery that holds keys of the given type.
+    """
+    return "cargoKey" if key_type == IDENTIFIER_SHIPMENT_ID else "invoiceKey"
+
+def select_deliveries(response: dict, keys: list, key_type: int) -> dict:
+    """
+    Returns a copy of a serialized queryShipment response that only
+    contains the deliveries for the given keys.
+    """
+    key_field = delivery_key_field(key_type)
+    keys = set(keys)
+    deliveries = [ _ for _ in response["shippingDeliveryDetailVO"] or [] if _[key_field] in keys ]
+    return dict(response, shippingDeliveryDetailVO=deliveries, count=len(deliveries))
+
+def select_batched_deliveries(responses: list, keys: list, key_type: int) -> dict:
+    """
+    Returns a serialized queryShipment response with the deliveries for
+    the given keys, from the responses of the batches they were looked up
+    in. If none of them was successful, the first one is returned.
+    """
+    responses = [select_deliveries(_, keys, key_type) for _ in responses]
+    return merge_query_responses(responses) or responses[0]
+
+def merge_query_responses(responses: list) -> dict:
+    """
+    Merges the serialized queryShipment responses of several lookups 
+    into a single response object. Unsuccessful responses are left out, 
+    and deliveries that were found by more than one lookup are only 
+    included once.
+    """
+    response_content = {}
+    seen = set()
+    # Error handling is not implemented yet
+    for response in responses:
+        if response["outFlag"] == SUCCESSFUL:
+            deliveries = response["shippingDeliveryDetailVO"] or []
+            if response_content == {}:
+                response_content = dict(response, shippingDeliveryDetailVO=[])
+            for delivery in deliveries:
+                key = (delivery["cargoKey"], delivery["invoiceKey"])
+                if key not in seen:
+                    seen.add(key)
+                    response_content["shippingDeliveryDetailVO"].append(delivery)
+    if response_content != {}:
+        response_content["count"] = len(response_content["shippingDeliveryDetailVO"])
+    return response_content
+
+def parse_cancellation(req, body) -> tuple:
+    """
+    Reads the keys of the shipments to cancel from the `shipment_id` and
+    `invoice_id` parameters of the request, and from the same fields of
+    the body if there is one. Returns the shipment IDs and the invoice 
+    IDs, without duplicates.
+    """
+    shipment_id = req.get_param_as_list("shipment_id", default=[])
+    invoice_id = req.get_param_as_list("invoice_id", default=[])
+    if body is not None:
+        if type(body) != dict:
+            raise falcon.HTTPBadRequest(title="400 Bad Request",
+                                        description="The body should be an object")
+        shipment_id += parameter_as_list(body.get("shipment_id", []))
+        invoice_id += parameter_as_list(body.get("invoice_id", []))
+
+    if not any((shipment_id, invoice_id)):
+        raise falcon.HTTPBadRequest(title="400 Bad Request",
+                                    description="No identifier was provided")
+    return list(dict.fromkeys(shipment_id)), list(dict.fromkeys(invoice_id))
+
+def parse_subscription(body) -> tuple:
+    """
+    Reads the shipment IDs to track and the URL to send their changes to
+    from the body of a subscription request. Returns the shipment IDs,
+    without duplicates, and the URL.
+    """
+    if type(body) != dict:
+        raise falcon.HTTPBadRequest(title="400 Bad Request",
+                                    description="The body should be an object")
+    shipment_id = parameter_as_list(body.get("shipment_id")) or []
+    if not shipment_id or not all(type(_) == str and _ for _ in shipment_id):
+        raise falcon.HTTPBadRequest(title="400 Bad Request",
+                                    description="No identifier was provided")
+    callback_url = body.get("callback_url")
+    url = urlsplit(callback_url) if type(callback_url) == str else None
+    if url is None or url.scheme not in ("http", "https") or not url.hostname:
+        raise falcon.HTTPBadRequest(title="400 Bad Request",
+                                    description="callback_url should be an HTTP or HTTPS URL")
+    # host names are checked when callbacks are sent, as they can resolve
+    # to other addresses by then
+    try:
+        address = ipaddress.ip_address(url.hostname)
+    except ValueError:
+        address = None
+    if address is not None and not callback_address_allowed(address):
+        raise falcon.HTTPBadRequest(title="400 Bad Request",
+                                    description="callback_url should have a public address")
+    return list(dict.fromkeys(shipment_id)), callback_url
+
+def callback_address_allowed(address) -> bool:
+    """
+    Returns whether callbacks can be sent to an IP address: public
+    addresses, and those in SUBSCRIPTION_CALLBACK_NETWORKS. Loopback,
+    private, link-local and other reserved addresses aren't allowed.
+    """
+    address = ipaddress.ip_address(address)
+    if any(address in _ for _ in SUBSCRIPTION_CALLBACK_NETWORKS):
+        return True
+    return address.is_global and not address.is_multicast
+
+def describe_error(descriptions: dict, code, locale: str) -> tuple:
+    """
+    Returns the HTTP status and the description of an upstream error code
+    in the locale, from one of the error descriptions in reference, or
+    (None, None) if the code isn't in it.
+    """
+    try:
+        return descriptions.get((int(code), locale), (None, None))
+    except (TypeError, ValueError):
+        return None, None
+
+def summarize_errors(failed: list, descriptions: dict, locale: str) -> list:
+    """
+    Counts the failed entries of a bulk response by error code, most
+    frequent first, with the status and the description of each code in
+    the locale.
+    """
+    counts = Counter(_.get("errCode") for _ in failed)
+    summary = []
+    for code, count in counts.most_common():
+        status, description = describe_error(descriptions, code, locale)
+        summary.append({"errCode": code, "status": status, "description": description, "count": count})
+    return summary
+
+def describe_failed_shipment(shipment: dict, locale: str) -> dict:
+    """
+    Adds the HTTP status and the description of its error in the locale
+    to a shipment that wasn't created. The description is kept apart
+    from the description of the shipment itself. Shipments without a
+    known error keep the status of the call that failed, if any.
+    """
+    status, shipment["errDescription"] = describe_error(
+        ERROR_DESCRIPTIONS_CREATE_SHIPMENT, shipment.get("errCode"), locale)
+    shipment["status"] = status or shipment.get("status")
+    return shipment
+
+def describe_shipment_failures(resp_obj: dict, locale: str) -> dict:
+    """
+    Describes the shipments of a createShipment response that weren't
+    created in the locale, and summarizes their errors.
+    """
+    for shipment in resp_obj["failed"]:
+        describe_failed_shipment(shipment, locale)
+    resp_obj["errors"] = summarize_errors(resp_obj["failed"], ERROR_DESCRIPTIONS_CREATE_SHIPMENT, locale)
+    return resp_obj
+
+def failure_status(resp_obj: dict, results: list) -> str:
+    """
+    Returns the status of a bulk response in which nothing succeeded:
+    that of the first error if it's a known one, or else that of the
+    first chunk whose call failed, or 500.
+    """
+    if resp_obj["failed"] and resp_obj["failed"][0]["status"]:
+        return resp_obj["failed"][0]["status"]
+    for _, yk_resp in results:
+        if yk_resp.get("status"):
+            return yk_resp["status"]
+    return falcon.HTTP_500
+
+def failed_cancellation(cargo_key, invoice_key, code, message) -> dict:
+    return {
+        "cargoKey": cargo_key,
+        "invoiceKey": invoice_key,
+        "errCode": code,
+        "errMessage": message,
+    }
+
+def resolve_invoice_keys(response: dict, invoice_ids: list) -> tuple:
+    """
+    Given the serialized queryShipment response of a lookup by invoice
+    ID, returns the invoice IDs of the shipments found keyed by their
+    shipment IDs, along with a failed cancellation for each invoice ID
+    that wasn't found.
+    """
+    invoice_keys = {}
+    if response and response["outFlag"] == SUCCESSFUL:
+        for delivery in response["shippingDeliveryDetailVO"] or []:
+            if delivery["errCode"] is None and delivery["cargoKey"] is not None:
+                invoice_keys[delivery["cargoKey"]] = delivery["invoiceKey"]
+    found = set(invoice_keys.values())
+    failures = [
+        failed_cancellation(None, _, 60017, None)
+        for _ in invoice_ids if _ not in found
+    ]
+    return invoice_keys, failures
+
+def cancellation_results(cargo_keys: list, yk_resp: dict, invoice_keys: dict):
+    """
+    Yields (cancelled, result) pairs for the keys of a cancelShipment 
+    chunk, with the error and its description added to the keys that 
+    weren't cancelled. Keys of a chunk that was rejected as a whole, or
+    whose call failed, get the error of the chunk. Keys missing from the
+    response are reported as failed, as it isn't known whether they were
+    cancelled.
+    """
+    if yk_resp["outFlag"] != "0":
+        for key in cargo_keys:
+            result = failed_cancellation(key, invoice_keys.get(key), yk_resp.get("errCode"),
+                                         yk_resp.get("errMessage") or yk_resp.get("outResult"))
+            result["status"] = yk_resp.get("status")
+            yield False, result
+        return
+
+    details = { _["cargoKey"]: _ for _ in yk_resp["shippingOrderDetailVO"] or [] }
+    for key in cargo_keys:
+        detail = details.get(key)
+        if detail is None:
+            yield False, failed_cancellation(key, invoice_keys.get(key), None,
+                                             "Yurtiçi Kargo didn't report the result of the cancellation")
+        elif detail.get("errCode") is None:
+            result = dict(detail)
+            if result.get("invoiceKey") is None:
+                result["invoiceKey"] = invoice_keys.get(key)
+            yield True, result
+        else:
+            yield False, failed_cancellation(key, detail.get("invoiceKey") or invoice_keys.get(key),
+                                             detail["errCode"], detail.get("errMessage"))
+
+def build_cancellation_response(results: list, invoice_keys: dict, failures: list,
+                                locale: str = DEFAULT_LOCALE) -> tuple:
+    """
+    Given (shipment IDs, serialized cancelShipment response) pairs for 
+    each chunk of a batch, the invoice IDs of the shipments that were 
+    looked up by invoice ID and the keys that failed before being sent,
+    returns the HTTP status and the body of the response, with errors
+    described in the locale. If nothing was cancelled, the status is
+    that of the first error.
+    """
+    resp_obj = {
+        "successful": [],
+        "failed": list(failures),
+        "outFlag": "1",
+        "count": 0,
+    }
+    for cargo_keys, yk_resp in results:
+        if yk_resp["outFlag"] == "0":
+            resp_obj["outFlag"] = "0"
+        for cancelled, result in cancellation_results(cargo_keys, yk_resp, invoice_keys):
+            resp_obj["successful" if cancelled else "failed"].append(result)
+    resp_obj["count"] = len(resp_obj["successful"])
+    for result in resp_obj["failed"]:
+        status, result["description"] = describe_error(
+            ERROR_DESCRIPTIONS_CANCEL_SHIPMENT, result["errCode"], locale)
+        result["status"] = status or result.get("status")
+    resp_obj["errors"] = summarize_errors(resp_obj["failed"], ERROR_DESCRIPTIONS_CANCEL_SHIPMENT, locale)
+
+    if resp_obj["successful"]:
+        return falcon.HTTP_OK, resp_obj
+    return failure_status(resp_obj, results), resp_obj